@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# (c) 2020 Sylvain Le Groux <slegroux@ccrma.stanford.edu>
+
+import click
+import gzip
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from slgasr.ngram import CompiledLM, Corpus, NGram
+
+DATA_FOLDER = str(Path(__file__).parent.parent / "data/tests")
+
+
+def dict_arpa(path:str)->dict:
+    # naive parser: {order: {words: (logprob, backoff)}}
+    lm = {}
+    ngrams = None
+    with (gzip.open(path, 'rt', encoding='utf-8') if path.endswith('.gz') else open(path, encoding='utf-8')) as f:
+        for line in f:
+            line = line.strip()
+            if line.endswith('-grams:'):
+                ngrams = lm.setdefault(int(line[1:line.index('-')]), {})
+            elif line and ngrams is not None and not line.startswith('\\'):
+                fields = line.split()
+                n = len(lm)
+                backoff = float(fields[n + 1]) if len(fields) > n + 1 else 0.0
+                ngrams[tuple(fields[1:n + 1])] = (float(fields[0]), backoff)
+    return(lm)
+
+
+def measure(load, path:str, repeat:int)->tuple:
+    # (best seconds, peak MB) of loads. memory is traced on a separate load, tracing slows python code down
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        load(path)
+        seconds.append(time.perf_counter() - start)
+    tracemalloc.start()
+    lm = load(path)
+    peak = tracemalloc.get_traced_memory()[1] / 1e6
+    tracemalloc.stop()
+    del lm
+    return(min(seconds), peak)
+
+
+@click.command()
+@click.argument("path", default=DATA_FOLDER + '/lm/brown_100.txt')
+@click.option("--order", default=3, help="order of the LM built when path is a corpus")
+@click.option("--repeat", default=3, help="number of loads per parser")
+def bench_arpa(path, order, repeat):
+    """Compare CompiledLM.from_arpa with a naive dict parser on an ARPA file, or on a corpus LM"""
+    with tempfile.TemporaryDirectory() as tmp:
+        if not path.endswith(('.arpa', '.arpa.gz')):
+            corpus = Corpus(path, add_bos=False, add_eos=False)
+            arpa = str(Path(tmp) / 'lm.arpa')
+            CompiledLM.build(NGram(corpus, order=order)).to_arpa(arpa)
+            path = arpa
+        parsers = {'from_arpa': CompiledLM.from_arpa, 'dict': dict_arpa}
+        results = {}
+        print("{:<12} {:>10} {:>10}".format('parser', 'load s', 'peak MB'))
+        for name, load in parsers.items():
+            results[name] = measure(load, path, repeat)
+            print("{:<12} {:>10.3f} {:>10.1f}".format(name, *results[name]))
+    print("dict / from_arpa: {:.1f}x load time, {:.1f}x peak memory".format(
+        results['dict'][0] / results['from_arpa'][0], results['dict'][1] / results['from_arpa'][1]))
+
+
+if __name__ == "__main__":
+    bench_arpa()
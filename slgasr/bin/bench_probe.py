@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# (c) 2020 Sylvain Le Groux <slegroux@ccrma.stanford.edu>
+
+import click
+import glob
+import importlib.util
+import shutil
+import subprocess
+import timeit
+from pathlib import Path
+from slgasr.probe import probe, torchaudio_info
+
+DATA_FOLDER = str(Path(__file__).parent.parent / "data/tests")
+
+
+def soxi(path:str)->float:
+    return(float(subprocess.check_output("soxi -D {0}".format(path), shell=True)))
+
+
+@click.command()
+@click.argument("data_folder", default=DATA_FOLDER)
+@click.option("--repeat", default=20, help="number of probes per file")
+def bench_probe(data_folder, repeat):
+    """Compare header probe with torchaudio.info and soxi on audio files"""
+    paths = [p for ext in ('wav', 'flac', 'mp3') for p in glob.glob(data_folder + '/**/*.' + ext, recursive=True)]
+    methods = {'probe': probe}
+    if importlib.util.find_spec('torchaudio'):
+        methods['torchaudio'] = torchaudio_info
+    if shutil.which('soxi'):
+        methods['soxi'] = soxi
+    totals = {name: 0.0 for name in methods}
+    print("{:<50} {:>10} ".format('file', 'duration') + ' '.join('{:>12}'.format(name + ' ms') for name in methods))
+    for path in sorted(paths):
+        timings = []
+        for name, method in methods.items():
+            t = timeit.timeit(lambda: method(path), number=repeat) / repeat
+            totals[name] += t
+            timings.append(t)
+        print("{:<50} {:>10.3f} ".format(Path(path).name[-50:], probe(path)['duration']) + \
+            ' '.join('{:>12.3f}'.format(t * 1000) for t in timings))
+    print("{:<61} ".format('total') + ' '.join('{:>12.3f}'.format(totals[name] * 1000) for name in methods))
+    for name in methods:
+        if name != 'probe':
+            print("probe is {:.1f}x faster than {}".format(totals[name] / totals['probe'], name))
+
+
+if __name__ == "__main__":
+    bench_probe()
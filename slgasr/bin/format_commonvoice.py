@@ -2,9 +2,9 @@
 # (c) 2020 slegroux@ccrma.stanford.edu
 
 import click
+import logging
 from slgasr.data import ASRDatasetCSV
 from pathlib import Path
-from IPython import embed
 
 # @click.option("--dataset", default="/home/syl20/data/es/commonvoice", help="commonvoice data folder")
 # @click.option("--output", default="/tmp/es/commonvoice", help="kaldi formatted data folder")
@@ -13,7 +13,10 @@ from IPython import embed
 @click.argument("src", default="/home/syl20/data/es/commonvoice")
 @click.argument("dst", default="/tmp/es/commonvoice")
 @click.option("--lang", default="es")
-def format_es_commonvoice(src, dst, lang):
+@click.option("--cache", default=None, help="sqlite file caching normalized sentences across runs")
+@click.option("--chunksize", default=None, type=int, help="stream tsv files by chunks of rows in bounded memory")
+@click.option("--catalog", default=None, help="folder of parquet catalogs per split, reused if they exist")
+def format_es_commonvoice(src, dst, lang, cache, chunksize, catalog):
     """Format commonvoice dataset into kaldi compatible data folder"""
     dataset_path = Path(src)
     formatted_dataset_path = Path(dst)
@@ -25,8 +28,20 @@ def format_es_commonvoice(src, dst, lang):
     }
 
     for k,v in paths.items():
-        ds = ASRDatasetCSV(paths[k], lang=lang, prepend_audio_path=str(audio_path.absolute()))
+        if chunksize:
+            ASRDatasetCSV.stream2kaldi(str(paths[k]), str(formatted_dataset_path / k), chunksize=chunksize, lang=lang,
+                prepend_audio_path=str(audio_path.absolute()), cache_path=cache)
+            continue
+        catalog_path = Path(catalog) / (k + '.parquet') if catalog else None
+        if catalog_path and catalog_path.exists():
+            ds = ASRDatasetCSV.load(str(catalog_path))
+        else:
+            ds = ASRDatasetCSV(paths[k], lang=lang, prepend_audio_path=str(audio_path.absolute()), cache_path=cache)
+            if catalog_path:
+                catalog_path.parent.mkdir(parents=True, exist_ok=True)
+                ds.save(str(catalog_path))
         ds.export2kaldi(str(formatted_dataset_path / k))
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
     format_es_commonvoice()
\ No newline at end of file
@@ -2,9 +2,9 @@
 # (c) 2020 Sylvain Le Groux <slegroux@ccrma.stanford.edu>
 
 import click
-from slgasr.data import ASRDataset, Audios, Transcripts, TranscriptsCSV
+import logging
+from slgasr.data import ASRDataset, Audios, TranscriptsCSV
 from pathlib import Path
-from IPython import embed
 # audios: test-clean/speakerid/chapter/speakerid-chapter-uttid.flac
 # tr: test-clean/speakerid/chapter/speakerid-chapter.trans.txt
 #   speakerid-chapter-uttid text
@@ -15,14 +15,21 @@ from IPython import embed
 @click.argument("transcript_path", default="/home/syl20/data/en/librispeech/LibriSpeech/dev-clean-2/*/*/*.trans.txt")
 @click.argument("dst_path", default="/tmp/en/minilibrispeech/dev-clean-2")
 @click.option("--lang", default="en")
+@click.option("--catalog", default=None, help="parquet catalog of the dataset, reused if it exists")
 
-def format_libri(audio_path, transcript_path, dst_path, lang):
+def format_libri(audio_path, transcript_path, dst_path, lang, catalog):
     """Format librispeech dataset into kaldi compatible data folder"""
-    a = Audios(audio_path, lang='en', country='US', sid_from_path=lambda x: Path(x).parents[1].name )
-    t = TranscriptsCSV(transcript_path, normalize=True, lang='en', country='US')
-    ds = ASRDataset(a.audios, t.transcripts)
+    if catalog and Path(catalog).exists():
+        ds = ASRDataset.load(catalog)
+    else:
+        a = Audios(audio_path, lang='en', country='US', sid_from_path=lambda x: Path(x).parents[1].name )
+        t = TranscriptsCSV(transcript_path, normalize=True, lang='en', country='US')
+        ds = ASRDataset(a.audios, t.transcripts)
+        if catalog:
+            ds.save(catalog)
     ds.export2kaldi(dst_path)
     
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
     format_libri()
\ No newline at end of file
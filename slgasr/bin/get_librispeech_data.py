@@ -20,25 +20,34 @@
 # test_other, train_clean_100, train_clean_360, train_other_500 or ALL
 # You can also put more than one data_set comma-separated:
 # --data_set=dev-clean,train-clean-100
+# --source=<local tarball, file:// url or extracted folder> processes a single data_set without openslr
+# tarballs are streamed: flac files are converted while the rest of the archive downloads
+# interrupted runs resume from the <data_set>.json.partial manifest
 
 import argparse
 import fnmatch
 import json
 import logging
 import os
-import subprocess
+import queue
 import tarfile
+import threading
 import urllib.request
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, ProcessPoolExecutor, wait
 
 from sox import Transformer
 from tqdm import tqdm
 
+from slgasr.probe import probe
+
 logging.basicConfig(level=logging.DEBUG)
 
 parser = argparse.ArgumentParser(description='LibriSpeech Data download')
 parser.add_argument("--data_root", required=True, default=None, type=str)
 parser.add_argument("--data_sets", default="dev_clean", type=str)
-args = parser.parse_args()
+parser.add_argument("--jobs", default=os.cpu_count(), type=int, help="number of conversion processes")
+parser.add_argument("--source", default=None, type=str,
+    help="local tarball, file:// url or extracted folder of a single data set to use instead of openslr")
 
 URLS = {
     'train-clean-100': ("http://www.openslr.org/resources/12/train-clean-100.tar.gz"),
@@ -53,101 +62,269 @@ URLS = {
 }
 
 
-def __maybe_download_file(destination: str, source: str):
+class _Prefetcher(object):
+    """
+    File-like reader filled by a background thread through a bounded queue of blocks,
+    so that downloading overlaps with extraction and conversion
+    """
+
+    def __init__(self, fileobj, block_size: int = 1 << 20, max_blocks: int = 64):
+        self._queue = queue.Queue(maxsize=max_blocks)
+        self._eof = False
+        self._thread = threading.Thread(target=self._fill, args=(fileobj, block_size), daemon=True)
+        self._thread.start()
+
+    def _fill(self, fileobj, block_size: int):
+        try:
+            while True:
+                block = fileobj.read(block_size)
+                self._queue.put(block)
+                if not block:
+                    break
+        except Exception as e:
+            self._queue.put(e)
+        finally:
+            fileobj.close()
+
+    def read(self, size: int = -1) -> bytes:
+        # blocks may be longer or shorter than size, tarfile streams handle both
+        if self._eof:
+            return b''
+        block = self._queue.get()
+        if isinstance(block, Exception):
+            raise block
+        if not block:
+            self._eof = True
+        return block
+
+
+def __open_source(source: str):
     """
-    Downloads source to destination if it doesn't exist.
-    If exists, skips download
+    Opens a tarball as a stream
     Args:
-        destination: local filepath
-        source: url of resource
+        source: url, file:// url or local path
     Returns:
+        file object
+    """
+    if os.path.exists(source):
+        return open(source, 'rb')
+    return urllib.request.urlopen(source)
+
+
+def __convert(files: tuple) -> float:
     """
-    source = URLS[source]
-    if not os.path.exists(destination):
-        logging.info("{0} does not exist. Downloading ...".format(destination))
-        urllib.request.urlretrieve(source, filename=destination + '.tmp')
-        os.rename(destination + '.tmp', destination)
-        logging.info("Downloaded {0}.".format(destination))
-    else:
-        logging.info("Destination {0} exists. Skipping.".format(destination))
-    return destination
-
-
-def __extract_file(filepath: str, data_dir: str):
-    try:
-        tar = tarfile.open(filepath)
-        tar.extractall(data_dir)
-        tar.close()
-    except Exception:
-        logging.info('Not extracting. Maybe already there?')
-
-
-def __process_data(data_folder: str, dst_folder: str, manifest_file: str):
+    Converts flac to wav in a worker process
+    Args:
+        files: (flac file, wav file)
+    Returns:
+        duration of the wav file in seconds
+    """
+    flac_file, wav_file = files
+    if not os.path.exists(wav_file):
+        # convert under a temporary name so that interrupted conversions are redone
+        tmp_file = wav_file[: -len(".wav")] + ".tmp.wav"
+        Transformer().build(flac_file, tmp_file)
+        os.replace(tmp_file, wav_file)
+    return probe(wav_file)['duration']
+
+
+def __read_checkpoint(checkpoint: str) -> set:
+    """
+    Reads audio files already in the manifest of an interrupted run and drops a truncated last line
+    Args:
+        checkpoint: partial manifest
+    Returns:
+        set of audio filepaths
+    """
+    done = set()
+    lines = []
+    if os.path.exists(checkpoint):
+        with open(checkpoint, encoding="utf-8") as fin:
+            for line in fin:
+                try:
+                    done.add(json.loads(line)['audio_filepath'])
+                    lines.append(line)
+                except (ValueError, KeyError):
+                    break
+        with open(checkpoint, 'w', encoding="utf-8") as fout:
+            fout.writelines(lines)
+    return done
+
+
+def __process_data(data_folder: str, dst_folder: str, manifest_file: str, jobs: int = 1):
     """
     Converts flac to wav and build manifests's json
     Args:
         data_folder: source with flac files
         dst_folder: where wav files will be stored
         manifest_file: where to store manifest
+        jobs: number of conversion processes
     Returns:
     """
-    print("process!")
+    if os.path.exists(manifest_file):
+        logging.info("Manifest {0} exists. Skipping.".format(manifest_file))
+        return
     if not os.path.exists(dst_folder):
         os.makedirs(dst_folder)
 
     files = []
     entries = []
-    print(data_folder)
     for root, dirnames, filenames in os.walk(data_folder):
         for filename in fnmatch.filter(filenames, '*.trans.txt'):
             files.append((os.path.join(root, filename), root))
-    print(files)
-    for transcripts_file, root in tqdm(files):
-        print(transcripts_file)
+    for transcripts_file, root in files:
         with open(transcripts_file, encoding="utf-8") as fin:
             for line in fin:
                 id, text = line[: line.index(" ")], line[line.index(" ") + 1 :]
-                transcript_text = text.lower().strip()
-
-                # Convert FLAC file to WAV
                 flac_file = os.path.join(root, id + ".flac")
-                wav_file = os.path.join(dst_folder, id + ".wav")
-                if not os.path.exists(wav_file):
-                    Transformer().build(flac_file, wav_file)
-                # check duration
-                duration = subprocess.check_output("soxi -D {0}".format(wav_file), shell=True)
+                if not os.path.exists(flac_file):
+                    logging.warning("{0} is missing. Skipping.".format(flac_file))
+                    continue
+                wav_file = os.path.abspath(os.path.join(dst_folder, id + ".wav"))
+                entries.append((flac_file, wav_file, text.lower().strip()))
+
+    # manifest lines are written as soon as files are converted and act as checkpoint
+    checkpoint = manifest_file + '.partial'
+    done = __read_checkpoint(checkpoint)
+    todo = [entry for entry in entries if entry[1] not in done]
+    logging.info("{0} files to convert, {1} already done".format(len(todo), len(entries) - len(todo)))
+    with open(checkpoint, 'a', encoding="utf-8") as fout, ProcessPoolExecutor(max_workers=jobs) as executor:
+        durations = executor.map(__convert, [(flac_file, wav_file) for flac_file, wav_file, _ in todo], chunksize=8)
+        for (flac_file, wav_file, transcript_text), duration in tqdm(zip(todo, durations), total=len(todo)):
+            entry = {}
+            entry['audio_filepath'] = wav_file
+            entry['duration'] = duration
+            entry['text'] = transcript_text
+            fout.write(json.dumps(entry) + '\n')
+            fout.flush()
+    __finalize_manifest(checkpoint, manifest_file)
+
+
+def __finalize_manifest(checkpoint: str, manifest_file: str):
+    """
+    Sorts the checkpoint by audio file into the final manifest
+    Args:
+        checkpoint: partial manifest
+        manifest_file: where to store manifest
+    Returns:
+    """
+    with open(checkpoint, encoding="utf-8") as fin:
+        lines = sorted(fin, key=lambda line: json.loads(line)['audio_filepath'])
+    with open(manifest_file + '.tmp', 'w', encoding="utf-8") as fout:
+        fout.writelines(lines)
+    os.replace(manifest_file + '.tmp', manifest_file)
+    os.remove(checkpoint)
+
+
+def __process_stream(source: str, data_root: str, dst_folder: str, manifest_file: str, jobs: int = 1):
+    """
+    Streams a tarball: flac files are extracted and sent to conversion workers as soon as they
+    arrive, manifest entries are written when both their wav and transcript are ready
+    Args:
+        source: url, file:// url or local path of the tarball
+        data_root: where the tarball is extracted
+        dst_folder: where wav files will be stored
+        manifest_file: where to store manifest
+        jobs: number of conversion processes
+    Returns:
+    """
+    if os.path.exists(manifest_file):
+        logging.info("Manifest {0} exists. Skipping.".format(manifest_file))
+        return
+    if not os.path.exists(dst_folder):
+        os.makedirs(dst_folder)
+
+    checkpoint = manifest_file + '.partial'
+    done = __read_checkpoint(checkpoint)
+    texts = {}
+    durations = {}
+    futures = {}
+    # bounds the number of extracted files waiting for a conversion worker
+    max_pending = 4 * jobs
+    progress = tqdm(unit=' files')
 
+    def write_ready(fout, ids):
+        for id in ids:
+            if id in texts and id in durations:
                 entry = {}
-                entry['audio_filepath'] = os.path.abspath(wav_file)
-                entry['duration'] = float(duration)
-                entry['text'] = transcript_text
-                entries.append(entry)
+                entry['audio_filepath'] = os.path.abspath(os.path.join(dst_folder, id + ".wav"))
+                entry['duration'] = durations.pop(id)
+                entry['text'] = texts.pop(id)
+                fout.write(json.dumps(entry) + '\n')
+                fout.flush()
+                progress.update()
 
-    with open(manifest_file, 'w') as fout:
-        for m in entries:
-            fout.write(json.dumps(m) + '\n')
+    def collect(fout, return_when):
+        finished, _ = wait(list(futures.values()), return_when=return_when)
+        ids = [id for id, future in futures.items() if future in finished]
+        for id in ids:
+            durations[id] = futures.pop(id).result()
+        write_ready(fout, ids)
+
+    with open(checkpoint, 'a', encoding="utf-8") as fout, ProcessPoolExecutor(max_workers=jobs) as executor, \
+            tarfile.open(fileobj=_Prefetcher(__open_source(source)), mode='r|gz') as tar:
+        for member in tar:
+            path = os.path.join(data_root, member.name)
+            if member.name.endswith('.flac'):
+                id = os.path.basename(member.name)[: -len(".flac")]
+                wav_file = os.path.abspath(os.path.join(dst_folder, id + ".wav"))
+                if wav_file in done:
+                    continue
+                if not (os.path.exists(path) and os.path.getsize(path) == member.size):
+                    tar.extract(member, data_root)
+                if len(futures) >= max_pending:
+                    collect(fout, FIRST_COMPLETED)
+                futures[id] = executor.submit(__convert, (path, wav_file))
+            elif member.name.endswith('.trans.txt'):
+                tar.extract(member, data_root)
+                with open(path, encoding="utf-8") as fin:
+                    for line in fin:
+                        id, text = line[: line.index(" ")], line[line.index(" ") + 1 :]
+                        if os.path.abspath(os.path.join(dst_folder, id + ".wav")) not in done:
+                            texts[id] = text.lower().strip()
+                write_ready(fout, list(durations))
+            else:
+                tar.extract(member, data_root)
+        if futures:
+            collect(fout, ALL_COMPLETED)
+        write_ready(fout, list(durations))
+    progress.close()
+    for id in texts:
+        logging.warning("{0} has a transcript but no audio. Skipping.".format(id))
+    for id in durations:
+        logging.warning("{0} has audio but no transcript. Skipping.".format(id))
+    __finalize_manifest(checkpoint, manifest_file)
 
 
 def main():
+    args = parser.parse_args()
     data_root = args.data_root
     data_sets = args.data_sets
 
     if data_sets == "ALL":
         data_sets = "dev-clean,dev-other,train-clean-100,train-clean-360,train-other-500,test-clean,test-other,dev-clean-2,train-clean-5"
 
+    if args.source and ',' in data_sets:
+        parser.error("--source can only be used with a single data set")
+
     for data_set in data_sets.split(','):
+        data_set = data_set.replace("_", "-")
         logging.info("\n\nWorking on: {0}".format(data_set))
-        filepath = os.path.join(data_root, data_set + ".tar.gz")
-        logging.info("Getting {0}".format(data_set))
-        __maybe_download_file(filepath, data_set)
-        logging.info("Extracting {0}".format(data_set))
-        __extract_file(filepath, data_root)
-        logging.info("Processing {0}".format(data_set))
-        __process_data(
-            os.path.join(os.path.join(data_root, "LibriSpeech"), data_set.replace("_", "-"),),
-            os.path.join(os.path.join(data_root, "LibriSpeech"), data_set.replace("_", "-"),) + "-wav",
-            os.path.join(data_root, data_set + ".json"),
-        )
+        dst_folder = os.path.join(os.path.join(data_root, "LibriSpeech"), data_set) + "-wav"
+        manifest_file = os.path.join(data_root, data_set + ".json")
+        if args.source and os.path.isdir(args.source):
+            logging.info("Processing {0}".format(args.source))
+            __process_data(args.source, dst_folder, manifest_file, args.jobs)
+        else:
+            # download, extraction & conversion all overlap
+            source = args.source
+            if source is None:
+                filepath = os.path.join(data_root, data_set + ".tar.gz")
+                source = filepath if os.path.exists(filepath) else URLS[data_set]
+            logging.info("Streaming {0}".format(source))
+            if not os.path.exists(data_root):
+                os.makedirs(data_root)
+            __process_stream(source, data_root, dst_folder, manifest_file, args.jobs)
     logging.info('Done!')
 
 
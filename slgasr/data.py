@@ -1,48 +1,209 @@
 # (c) 2020 Sylvain Le Groux <slegroux@ccrma.stanford.edu>
 
-from IPython import embed
 import glob
+from typing import Iterable, Iterator, List, Dict, TYPE_CHECKING
+from collections import OrderedDict
 from pathlib import Path
 import uuid
-import torchaudio
-import pandas as pd
-import spacy
 import os
-import swifter
 import logging
 import re
-import enchant
+import threading
+import time
+import hashlib
+import itertools
+from slgasr.probe import probe, pcm_layout
+from slgasr.fileio import file_stat
+from slgasr.kaldi import KaldiDataDir
+
+# heavy dependencies (pandas, torchaudio, spacy, enchant) are imported where they are used
+# to keep `import slgasr.data` cheap for short-lived jobs
+if TYPE_CHECKING:
+    import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# spacy models & enchant dictionaries per ISO 639-1 language code
+LANGUAGES = {
+    'es': ("es_core_news_sm", "es_ES"),
+    'en': ("en_core_web_sm", "en_US"),
+    'it': ("it_core_news_sm", "it"),
+    'pt': ("pt_core_news_sm", "pt_BR"),
+    'fr': ("fr_core_news_sm", "fr_FR"),
+}
+
+# only part-of-speech tags are used for normalization
+SPACY_EXCLUDE = ['parser', 'ner', 'lemmatizer', 'senter', 'textcat', 'entity_linker', 'entity_ruler']
+
+# normalized sentences kept in the in-memory LRU of each normalizer returned by get_normalizer
+CACHE_SIZE = 100000
+
+class NormalizationCache(object):
+    # two tiers: bounded in-memory LRU in front of an optional sqlite store on disk
+    def __init__(self, size:int=CACHE_SIZE, path:str=None):
+        self._size = size
+        self._path = path
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if self._path:
+            import sqlite3
+            self._db = sqlite3.connect(self._path, timeout=60, check_same_thread=False)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('CREATE TABLE IF NOT EXISTS normalized (key TEXT PRIMARY KEY, text TEXT)')
+            self._db.commit()
+
+    def get_many(self, keys:List[str])->Dict[str, str]:
+        found = {}
+        with self._lock:
+            for key in keys:
+                if key in self._memory:
+                    self._memory.move_to_end(key)
+                    found[key] = self._memory[key]
+                    self.hits += 1
+            missing = [key for key in dict.fromkeys(keys) if key not in found]
+            if self._db is not None and missing:
+                # sqlite caps the number of bound parameters per statement
+                for i in range(0, len(missing), 500):
+                    chunk = missing[i:i+500]
+                    rows = self._db.execute('SELECT key, text FROM normalized WHERE key IN ({})'.format(
+                        ','.join('?'*len(chunk))), chunk).fetchall()
+                    for key, text in rows:
+                        found[key] = text
+                        self._remember(key, text)
+                        self.disk_hits += 1
+            self.misses += sum(1 for key in keys if key not in found)
+        return(found)
+
+    def put_many(self, items:Dict[str, str]):
+        with self._lock:
+            for key, text in items.items():
+                self._remember(key, text)
+            if self._db is not None and items:
+                self._db.executemany('INSERT OR REPLACE INTO normalized VALUES (?, ?)', items.items())
+                self._db.commit()
+
+    def _remember(self, key:str, text:str):
+        if self._size:
+            self._memory[key] = text
+            self._memory.move_to_end(key)
+            if len(self._memory) > self._size:
+                self._memory.popitem(last=False)
+
+    def info(self)->dict:
+        with self._lock:
+            return({'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                    'size': len(self._memory), 'max_size': self._size, 'path': self._path})
+
+    @property
+    def path(self)->str:
+        return(self._path)
 
-logging.basicConfig(level=logging.DEBUG)
 
 class TextNormalizer(object):
-    def __init__(self, lang:str='en', country:str='US'):
+    def __init__(self, lang:str='en', country:str='US', cache_size:int=0, cache_path:str=None):
         # https://en.wikipedia.org/wiki/IETF_language_tag
         # ISO 639-1
         self._lang = lang
-        if self._lang=='es':
-            self._nlp = spacy.load("es_core_news_sm") 
-            self._dictionary = enchant.Dict("es_ES")
-        elif self._lang=='en':
-            self._nlp = spacy.load("en_core_web_sm")
-            self._dictionary = enchant.Dict("en_US")
-        elif self._lang=='it':
-            self._nlp = spacy.load("it_core_news_sm")
-            self._dictionary = enchant.Dict("it")
-        elif self._lang=='pt':
-            self._nlp = spacy.load("pt_core_news_sm")
-            self._dictionary = enchant.Dict("pt_BR")
-        elif self._lang=='fr':
-            self._nlp = spacy.load("fr_core_news_sm")
-            self._dictionary = enchant.Dict("fr_FR")
-        else:
+        if self._lang not in LANGUAGES:
             raise Exception("language {} is not supported yet".format(self._lang))
+        import spacy
+        import enchant
+        model, dictionary = LANGUAGES[self._lang]
+        self._nlp = spacy.load(model, exclude=SPACY_EXCLUDE)
+        self._dictionary = enchant.Dict(dictionary)
         self._country = country
+        self._version = None
+        self._cache = None
+        if cache_size or cache_path:
+            self.set_cache(cache_size, cache_path)
+
+    def set_cache(self, size:int=CACHE_SIZE, path:str=None):
+        self._cache = NormalizationCache(size, path)
+
+    def cache_info(self)->dict:
+        if self._cache is None:
+            return(None)
+        return(self._cache.info())
+
+    @property
+    def cache_path(self)->str:
+        if self._cache is None:
+            return(None)
+        return(self._cache.path)
+
+    def cache_lookup(self, texts:List[str])->Dict[str, str]:
+        # normalized version of the texts already in cache
+        if self._cache is None:
+            return({})
+        keys = [self._cache_key(text) for text in texts]
+        found = self._cache.get_many(keys)
+        return({text: found[key] for key, text in zip(keys, texts) if key in found})
+
+    def cache_update(self, normalized:Dict[str, str]):
+        if self._cache is not None:
+            self._cache.put_many({self._cache_key(text): norm for text, norm in normalized.items()})
+
+    @property
+    def version(self)->str:
+        # fingerprint of the normalization rules, spacy model & dictionary so that
+        # cached results are invalidated whenever any of them change
+        if self._version is None:
+            import inspect
+            try:
+                rules = inspect.getsource(TextNormalizer)
+            except (OSError, TypeError):
+                rules = ''
+            fingerprint = [rules, self._nlp.meta.get('name', ''), self._nlp.meta.get('version', ''),
+                ' '.join(self._nlp.pipe_names), self._dictionary.tag]
+            self._version = hashlib.sha1('\0'.join(fingerprint).encode('utf-8')).hexdigest()
+        return(self._version)
+
+    def _cache_key(self, text:str)->str:
+        return(hashlib.sha1('\0'.join([self.version, self._lang, text]).encode('utf-8')).hexdigest())
     
     def normalize(self, text:str)->str:
+        if self._cache is not None:
+            return(self._normalize_cached([text])[0])
+        return(self._normalize(text))
+
+    def _normalize(self, text:str)->str:
         text = self.remove_brackets(text)
         text = self.remove_newline(text)
         text = self.remove_punc(text)
+        return(self._finalize(text))
+
+    def normalize_batch(self, texts:Iterable[str], batch_size:int=1000)->Iterator[str]:
+        if self._cache is None:
+            yield from self._normalize_batch(texts, batch_size)
+            return
+        texts = iter(texts)
+        block = list(itertools.islice(texts, batch_size))
+        while block:
+            yield from self._normalize_cached(block, batch_size)
+            block = list(itertools.islice(texts, batch_size))
+
+    def _normalize_batch(self, texts:Iterable[str], batch_size:int=1000)->Iterator[str]:
+        # same steps as normalize but streams docs through spacy in batches
+        texts = (self.remove_newline(self.remove_brackets(text)) for text in texts)
+        for doc in self._nlp.pipe(texts, batch_size=batch_size):
+            yield self._finalize(self._remove_punc_doc(doc))
+
+    def _normalize_cached(self, texts:List[str], batch_size:int=1000)->List[str]:
+        keys = [self._cache_key(text) for text in texts]
+        found = self._cache.get_many(keys)
+        # only normalize each missing text once
+        todo = {key: text for key, text in zip(keys, texts) if key not in found}
+        if todo:
+            normalized = dict(zip(todo.keys(), self._normalize_batch(todo.values(), batch_size)))
+            self._cache.put_many(normalized)
+            found.update(normalized)
+        return([found[key] for key in keys])
+
+    def _finalize(self, text:str)->str:
         text = self.remove_extra_spaces(text)
         text = text.lstrip()
         text = self.reformat_abbv(text)
@@ -66,7 +227,9 @@ class TextNormalizer(object):
         return(re.sub(pattern, '._', sentence))
 
     def remove_punc(self, sentence:str)-> str:
-        doc = self._nlp(sentence)
+        return(self._remove_punc_doc(self._nlp(sentence)))
+
+    def _remove_punc_doc(self, doc)-> str:
         res = [(w.text, w.pos_) for w in doc]
         return(' '.join([w.lower() for w,att  in res if att!= 'PUNCT']))
     
@@ -80,6 +243,7 @@ class TextNormalizer(object):
         return(sentence)
 
     def remove_en_language(self, sentence:str)-> str:
+        import enchant
         d = enchant.Dict("en_US")
         for word in sentence.split():
             if d.check(word):
@@ -95,7 +259,82 @@ class TextNormalizer(object):
                 f.write(t)
                 f.truncate()
         except IOError as e:
-            logging.error(e, exc_info=True)
+            logger.error(e, exc_info=True)
+
+
+# process-wide normalizers shared by transcripts & datasets, loaded on first use
+_normalizers = {}
+_normalizers_load_time = {}
+_normalizers_lock = threading.Lock()
+
+def get_normalizer(lang:str='en', country:str='US', cache_path:str=None, cache_size:int=CACHE_SIZE)->TextNormalizer:
+    # normalization only depends on the language: one normalizer per lang, whatever the country
+    # cache_size: normalized sentences kept in memory, 0 for no in-memory cache. it applies when the normalizer
+    # is loaded or when its cache path changes
+    key = lang
+    with _normalizers_lock:
+        if key not in _normalizers:
+            start = time.perf_counter()
+            _normalizers[key] = TextNormalizer(lang, country or 'US', cache_size=cache_size, cache_path=cache_path)
+            _normalizers_load_time[key] = time.perf_counter() - start
+            logger.info("loaded {} normalizer in {:.2f}s".format(key, _normalizers_load_time[key]))
+        normalizer = _normalizers[key]
+        if cache_path and normalizer.cache_path != cache_path:
+            normalizer.set_cache(cache_size, cache_path)
+        return(normalizer)
+
+def normalizer_stats()->dict:
+    # load time in seconds per lang
+    with _normalizers_lock:
+        return(dict(_normalizers_load_time))
+
+
+# normalizer of a worker process, loaded once by the pool initializer
+_worker_normalizer = None
+
+def _init_normalizer_worker(lang:str, country:str):
+    global _worker_normalizer
+    _worker_normalizer = TextNormalizer(lang, country)
+
+def _normalize_chunk(texts:List[str], batch_size:int)->List[str]:
+    return(list(_worker_normalizer.normalize_batch(texts, batch_size=batch_size)))
+
+def normalizer_pool(lang:str='en', country:str='US', n_jobs:int=None)->'ProcessPoolExecutor':
+    # workers load the language model once, the pool can be reused across normalize_texts calls
+    from concurrent.futures import ProcessPoolExecutor
+    return(ProcessPoolExecutor(max_workers=n_jobs or os.cpu_count(), initializer=_init_normalizer_worker,
+        initargs=(lang, country)))
+
+def normalize_texts(texts:List[str], lang:str='en', country:str='US', n_jobs:int=1, batch_size:int=1000,
+        chunk_size:int=None, cache_path:str=None, executor:'ProcessPoolExecutor'=None)->List[str]:
+    # executor: pool of normalizer_pool(lang, country, n_jobs) to reuse, otherwise one is created per call
+    import contextlib
+    if n_jobs is None or n_jobs < 1:
+        n_jobs = os.cpu_count()
+    if n_jobs == 1:
+        normalizer = get_normalizer(lang, country, cache_path=cache_path)
+        return(list(normalizer.normalize_batch(texts, batch_size=batch_size)))
+
+    # dedup & cache lookups happen here so that workers only see unseen sentences
+    # the language model is only loaded in this process when a persistent cache is used
+    normalizer = get_normalizer(lang, country, cache_path=cache_path) if cache_path else None
+    unique = list(dict.fromkeys(texts))
+    normalized = normalizer.cache_lookup(unique) if normalizer else {}
+    todo = [text for text in unique if text not in normalized]
+    if not chunk_size:
+        # a few contiguous chunks per worker to even out the load
+        chunk_size = max(batch_size, -(-len(todo) // (4 * n_jobs)))
+    chunks = [todo[i:i+chunk_size] for i in range(0, len(todo), chunk_size)]
+    if chunks:
+        pool = normalizer_pool(lang, country, min(n_jobs, len(chunks))) if executor is None else None
+        with pool or contextlib.nullcontext(executor) as executor:
+            for chunk, results in zip(chunks, executor.map(_normalize_chunk, chunks, itertools.repeat(batch_size))):
+                new = dict(zip(chunk, results))
+                if normalizer:
+                    normalizer.cache_update(new)
+                normalized.update(new)
+    return([normalized[text] for text in texts])
+
 
 class SpeechAsset():
     def __init__(self, path:str, lang:str='en', country:str='US', sid:str=None):
@@ -141,13 +380,11 @@ class SpeechAsset():
 class Transcript(SpeechAsset):
     def __init__(self, path:str, lang:str='en', country:str='US', normalize:bool=True, sid:str=None, encoding='utf-8'):
         SpeechAsset.__init__(self,path=path, lang=lang, country=country, sid=sid)
-        self._normalizer = TextNormalizer(self._lang)
         self._encoding = encoding
         with open(self._path, encoding=self._encoding) as f:
-            if normalize:
-                self._text = self._normalizer.normalize(f.readline().strip())
-            else:
-                self._text = f.readline().strip()
+            self._text = f.readline().strip()
+        if normalize:
+            self._text = get_normalizer(self._lang, self._country).normalize(self._text)
 
     def asdict(self):
         return {'text': self._text,
@@ -170,26 +407,58 @@ class Transcript(SpeechAsset):
     
 
 class Audio(SpeechAsset):
-    def __init__(self, path:str, lang:str='en', country:str='US', sid:str=None):
+    def __init__(self, path:str, lang:str='en', country:str='US', sid:str=None, load_data:bool=False, info:dict=None):
         SpeechAsset.__init__(self,path=path, lang=lang, country=country, sid=sid)
-        (self._data, self._sr) = Audio.get_data(path)
-        self._duration = Audio.get_duration(path)
+        # waveform is only decoded on first access of data
+        self._data = None
+        if info is None:
+            info = Audio.get_info(path)
+        self._sr = info['sr']
+        self._channels = info['channels']
+        self._frames = info['frames']
+        self._duration = info['duration']
+        self._codec = info['codec']
+        if load_data:
+            self.load()
+
+    def asdict(self, data:bool=True):
+        d = {'audio': self,
+             'sr': self._sr,
+             'channels': self._channels,
+             'frames': self._frames,
+             'duration': self._duration,
+             'codec': self._codec,
+             'path': str(self._path),
+             'lang': self._lang,
+             'country': self._country,
+             'id': self._id,
+             'uuid': self._uuid,
+             'sid': self._sid,
+             }
+        if data:
+            d['data'] = self.data
+        return(d)
+
+    def load(self):
+        if self._data is None:
+            (self._data, sr) = Audio.get_data(str(self._path))
+        return(self._data)
+
+    def unload(self):
+        self._data = None
+
+    def memmap(self):
+        # zero-copy (frames, channels) int16 view of 16 bit PCM wav files, None for other formats
+        import numpy as np
+        layout = pcm_layout(str(self._path))
+        if layout is None:
+            return(None)
+        return(np.memmap(str(self._path), dtype='<i2', mode='r', offset=layout['offset'],
+            shape=(layout['frames'], layout['channels'])))
 
-    def asdict(self):
-        return {'data': self._data,
-                'sr': self._sr,
-                'duration': self._duration,
-                'path': str(self._path),
-                'lang': self._lang,
-                'country': self._country,
-                'id': self._id,
-                'uuid': self._uuid,
-                'sid': self._sid,
-                }        
-    
     @property
     def data(self):
-        return(self._data)
+        return(self.load())
 
     @property
     def sr(self):
@@ -199,30 +468,114 @@ class Audio(SpeechAsset):
     def duration(self):
         return(self._duration)
 
+    @property
+    def channels(self)->int:
+        return(self._channels)
+
+    @property
+    def frames(self)->int:
+        return(self._frames)
+
+    @property
+    def codec(self)->str:
+        return(self._codec)
+
     @staticmethod
     def get_data(filename:str):
+        import torchaudio
         try:
             return(torchaudio.load(filename))
         except IOError as e:
-            logging.exception(str(e))
+            logger.exception(str(e))
             return(None,None)            
 
+    @staticmethod
+    def get_info(filename:str)->dict:
+        # header metadata without decoding the waveform
+        return(probe(str(filename)))
+
     @staticmethod
     def get_duration(filename:str)->float:
-        try:
-            info = torchaudio.info(filename)
-            duration = info[0].length / info[0].rate
-            return(duration)
-        except IOError as e:
-            logging.exception(str(e))
-            return(None)
+        return(Audio.get_info(filename)['duration'])
+
+
+class AudioInfoCache(object):
+    # header metadata of audio files, reused as long as their (path, size, mtime) are unchanged
+    FIELDS = ['sr', 'channels', 'frames', 'duration', 'codec']
+
+    def __init__(self, path:str):
+        import sqlite3
+        self._path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self._path, timeout=60, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS audio_info (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, '
+            'sr INTEGER, channels INTEGER, frames INTEGER, duration REAL, codec TEXT)')
+        self._db.commit()
+
+    def get_many(self, stats:Dict[str, tuple])->Dict[str, dict]:
+        # stats: path -> (size, mtime)
+        found = {}
+        paths = list(stats)
+        with self._lock:
+            for i in range(0, len(paths), 500):
+                chunk = paths[i:i+500]
+                rows = self._db.execute('SELECT * FROM audio_info WHERE path IN ({})'.format(
+                    ','.join('?'*len(chunk))), chunk).fetchall()
+                for row in rows:
+                    if stats[row[0]] == (row[1], row[2]):
+                        found[row[0]] = dict(zip(AudioInfoCache.FIELDS, row[3:]))
+        return(found)
+
+    def put_many(self, infos:Dict[str, tuple]):
+        # infos: path -> ((size, mtime), info)
+        rows = [(path, size, mtime) + tuple(info[k] for k in AudioInfoCache.FIELDS)
+            for path, ((size, mtime), info) in infos.items()]
+        with self._lock:
+            self._db.executemany('INSERT OR REPLACE INTO audio_info VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __enter__(self)->'AudioInfoCache':
+        return(self)
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def probe_audio_files(paths:List[str], n_jobs:int=8, cache_path:str=None)->List[dict]:
+    # header metadata of many files probed concurrently, in the order of paths
+    from concurrent.futures import ThreadPoolExecutor
+    import contextlib
+    paths = [os.path.abspath(path) for path in paths]
+    # missing files (broken links, deleted since listed) are never cached & get empty infos from probe
+    stats = {path: file_stat(path) for path in paths}
+    with (AudioInfoCache(cache_path) if cache_path else contextlib.nullcontext()) as cache:
+        infos = cache.get_many(stats) if cache else {}
+        todo = [path for path in dict.fromkeys(paths) if path not in infos]
+        if todo:
+            with ThreadPoolExecutor(max_workers=max(1, n_jobs)) as executor:
+                probed = dict(zip(todo, executor.map(Audio.get_info, todo)))
+            infos.update(probed)
+            if cache:
+                # failed probes are retried next time
+                cache.put_many({path: (stats[path], info) for path, info in probed.items() if info['sr'] is not None})
+    logger.info("probed {} audio files, {} from cache".format(len(todo), len(paths) - len(todo)))
+    return([infos[path] for path in paths])
 
 
 class Transcripts(object):
-    def __init__(self, regex:str, normalize:bool=True, lang:str='en', country:str=None):
+    def __init__(self, regex:str, normalize:bool=True, lang:str='en', country:str=None, cache_path:str=None, n_jobs:int=1):
+        import pandas as pd
         self._paths = glob.glob(regex)
         # convert list of dicts into df
-        self._transcripts = pd.DataFrame([Transcript(path, normalize=normalize, lang=lang, country=country).asdict() for path in self._paths])
+        self._transcripts = pd.DataFrame([Transcript(path, normalize=False, lang=lang, country=country).asdict() for path in self._paths])
+        if normalize and len(self._transcripts):
+            self._transcripts['text'] = normalize_texts(self._transcripts['text'].tolist(), lang, country,
+                n_jobs=n_jobs, cache_path=cache_path)
     
     @property
     def transcripts(self):
@@ -230,8 +583,10 @@ class Transcripts(object):
 
 
 class TranscriptsCSV(Transcripts):
-    def __init__(self, regex:str, normalize:bool=True, lang:str='en', country:str=None):
+    def __init__(self, regex:str, normalize:bool=True, lang:str='en', country:str=None, batch_size:int=1000, cache_path:str=None,
+                n_jobs:int=1):
         # Transcripts.__init__(self, regex=regex, normalize=normalize, lang=lang, country=country)
+        import pandas as pd
         self._paths = glob.glob(regex)
         self._transcripts = pd.DataFrame()
 
@@ -245,72 +600,145 @@ class TranscriptsCSV(Transcripts):
             self._transcripts = self._transcripts.append(tmp, ignore_index=True)
 
         if normalize:
-            normalizer = TextNormalizer(lang)
-            self._transcripts['text'] = self._transcripts['text'].swifter.apply(normalizer.normalize)
+            self._transcripts['text'] = normalize_texts(self._transcripts['text'].tolist(), lang, country,
+                n_jobs=n_jobs, batch_size=batch_size, cache_path=cache_path)
 
 
 class Audios(object):
-    def __init__(self, regex:str, lang:str='en', country:str='US', sid_from_path=None):
+    def __init__(self, regex:str, lang:str='en', country:str='US', sid_from_path=None, load_data:bool=False,
+                n_jobs:int=8, cache_path:str=None):
+        import pandas as pd
         self._paths = glob.glob(regex)
+        infos = probe_audio_files(self._paths, n_jobs=n_jobs, cache_path=cache_path)
         # convert list of dicts into df
+        # audio column holds lazy Audio handles, data column decoded waveforms only if load_data
         if sid_from_path:
-            self._audios = pd.DataFrame([Audio(path, lang=lang, country=country, sid=sid_from_path(path)).asdict() for path in self._paths])
+            self._audios = pd.DataFrame([Audio(path, lang=lang, country=country, sid=sid_from_path(path), load_data=load_data, info=info).asdict(data=load_data) for path, info in zip(self._paths, infos)])
         else:
-            self._audios = pd.DataFrame([Audio(path, lang=lang, country=country).asdict() for path in self._paths])
+            self._audios = pd.DataFrame([Audio(path, lang=lang, country=country, load_data=load_data, info=info).asdict(data=load_data) for path, info in zip(self._paths, infos)])
     
     @property
     def audios(self):
         return(self._audios)
 
 
+# rows per parquet row group: granularity of predicate pushdown in ASRDataset.load
+PARQUET_ROW_GROUP_SIZE = 65536
+# string columns with few distinct values, stored as dictionaries
+DICTIONARY_COLUMNS = ['sid', 'lang', 'country', 'codec']
+
+# namespace of utterance uuids
+UTTERANCE_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, 'https://github.com/slegroux/slgASR')
+
+def utterance_uuids(sids:List[str], audio_paths:List[str], texts:List[str])->List[str]:
+    # deterministic ids: the same utterance gets the same id in every run, so exports can be incremental
+    return([str(uuid.uuid5(UTTERANCE_NAMESPACE, '{}\t{}\t{}'.format(sid, audio_path, text)))
+        for sid, audio_path, text in zip(sids, audio_paths, texts)])
+
+def kaldi_wav_template(ext:str='wav', sr:int=16000)->str:
+    # wav.scp entry converting audio files to 16 bit mono wav on the fly
+    if ext in ('wav', 'sph'):
+        return('sox {} -t wav -r ' + str(sr) + ' -c 1 -b 16 - |')
+    elif ext == 'flac':
+        # TODO(slg): check sr param for flac
+        return('flac -c -d -s {} |')
+    return('{}')
+
 class ASRDataset():
-    def __init__(self, audios:pd.DataFrame, transcripts:pd.DataFrame, audio_cols=['id', 'sid', 'path', 'data', 'sr', 'lang', 'country'], transcripts_cols=['id','text','path'], join='id'):
+    def __init__(self, audios:'pd.DataFrame', transcripts:'pd.DataFrame', audio_cols=['id', 'sid', 'path', 'audio', 'sr', 'duration', 'lang', 'country'], transcripts_cols=['id','text','path'], join='id'):
+        import pandas as pd
         self._transcripts = transcripts
         self._audios = audios
         df = pd.merge(self._transcripts[transcripts_cols], self._audios[audio_cols], on='id')
-        df['uuid'] = [str(uuid.uuid4()) for x in range(df.shape[0])]
         df.rename(columns={'path_x':'transcript_path', 'path_y':'audio_path'}, inplace=True)
+        df['uuid'] = utterance_uuids(df['sid'].tolist(), df['audio_path'].tolist(), df['text'].tolist())
+        n = df.shape[0]
+        df = df.drop_duplicates(subset=['uuid'])
+        if df.shape[0] < n:
+            logger.warning("dropped {} duplicated utterances".format(n - df.shape[0]))
         self._df = df
     
-    def export2kaldi(self, dir_path:str, sr:int=16000, ext:str='wav'):
-        path = Path(dir_path)
-        try:
-            path.mkdir(parents=True, exist_ok=False)
-        except FileExistsError as e:
-            logging.exception(str(e))
-        else:
-            logging.info("Folder created")
-        
-        # kaldi needs uuid that starts by sid for sorting
+    def export2kaldi(self, dir_path:str, sr:int=16000, ext:str='wav', utt2dur:bool=True, materialize:bool=False,
+            n_jobs:int=1, archive:bool=False, incremental:bool=True)->Dict[str, List[str]]:
+        # materialize converts the audio once to 16 bit PCM wav files (or a wav.ark if archive)
+        # instead of writing sox/flac pipes to wav.scp
+        # incremental compares with the manifest of the previous export in dir_path & only materializes
+        # added or changed utterances. returns the utterance ids added, changed & removed
+        # kaldi needs utterance ids that start by sid for sorting
         # http://kaldi-asr.org/doc/data_prep.html
-        # convert uuid type to string to be able to add sid to it
-        self._df['uuid'] = self._df['sid'] + '-' + self._df['uuid']
-        # hard copy otherwise it's just a view and then cannot reassign col values
-
-        wav_scp = self._df[['uuid', 'audio_path']].copy()
-        if ext == 'wav':
-            wav_scp['audio_path'] = 'sox ' + wav_scp.audio_path + ' -t wav -r ' + str(sr) + ' -c 1 -b 16 - |'
-        elif ext == 'sph':
-            wav_scp['audio_path'] = 'sox ' + wav_scp.audio_path + ' -t wav -r ' + str(sr) + ' -c 1 -b 16 - |'
-        elif ext == 'flac':
-            # TODO(slg): check sr param for flac
-            wav_scp['audio_path'] = 'flac -c -d -s ' + wav_scp.audio_path + ' |'
-        try:
-            wav_scp.to_csv(os.path.join(dir_path,'wav.scp'), sep=' ', index=False, header=None)
-            TextNormalizer.remove_double_quote_from_file(os.path.join(dir_path,'wav.scp'))
-        except IOError as e:
-            logging.exception(str(e))
-        utt2spk = self._df[['uuid','sid']]
+        sids = self._df['sid'].tolist()
+        utt_ids = [sid + '-' + uuid for sid, uuid in zip(sids, self._df['uuid'].tolist())]
+        wav_template = '{}' if materialize else kaldi_wav_template(ext, sr)
+        durations = None
+        if utt2dur and 'duration' in self._df.columns:
+            durations = self._df['duration'].tolist()
+        delta = {'added': [], 'changed': [], 'removed': []}
         try:
-            utt2spk.to_csv(os.path.join(dir_path, 'utt2spk'), sep=' ', index=False, header=None)
-        except IOError as e:
-            logging.exception(str(e))
-        text = self._df[['uuid','text']]
-        try:
-            text.to_csv(os.path.join(dir_path, 'text'), sep=' ', index=False, header=None)
-            TextNormalizer.remove_double_quote_from_file(os.path.join(dir_path,'text'))
+            data_dir = KaldiDataDir(dir_path)
+            audio_paths = self._df['audio_path'].tolist()
+            stats = [file_stat(path) for path in audio_paths]
+            params = {'sr': sr, 'ext': ext, 'materialize': materialize, 'archive': archive}
+            owned = data_dir.materialized_files()
+            previous_params, previous = data_dir.read_manifest() if incremental else ({}, {})
+            entries = [None] * len(utt_ids)
+            todo = []
+            for i, utt in enumerate(utt_ids):
+                old = previous.pop(utt, None)
+                if old is not None and old[1] == stats[i] and previous_params == params:
+                    entries[i] = old[2]
+                    continue
+                delta['added' if old is None else 'changed'].append(utt)
+                todo.append(i)
+            delta['removed'] = sorted(previous)
+            if materialize:
+                if todo:
+                    new = data_dir.materialize([utt_ids[i] for i in todo], [audio_paths[i] for i in todo], sr=sr,
+                        n_jobs=n_jobs, archive=archive, ark_name=data_dir.next_ark_name())
+                    for i, entry in zip(todo, new):
+                        entries[i] = entry
+            else:
+                entries = audio_paths
+            data_dir.write(utt_ids, sids, entries, self._df['text'].tolist(),
+                durations=durations, wav_template=wav_template)
+            if materialize:
+                data_dir.prune(entries, owned)
+            data_dir.write_manifest(params, utt_ids, audio_paths, stats, entries)
+            logger.info("exported {} utterances: {} added, {} changed, {} removed".format(len(utt_ids),
+                len(delta['added']), len(delta['changed']), len(delta['removed'])))
         except IOError as e:
-            logging.exception(str(e))
+            logger.exception(str(e))
+        return(delta)
+
+    def save(self, path:str, row_group_size:int=PARQUET_ROW_GROUP_SIZE):
+        # parquet catalog of the dataset, audio handles are not stored
+        import pyarrow as pa
+        import pyarrow.compute as pc
+        import pyarrow.parquet as pq
+        df = self._df.drop(columns=[col for col in ['audio'] if col in self._df.columns])
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        # low cardinality strings are kept dictionary encoded in arrow & pandas (categoricals) too
+        for col in DICTIONARY_COLUMNS:
+            i = table.schema.get_field_index(col)
+            if i >= 0 and pa.types.is_string(table.schema.field(i).type):
+                table = table.set_column(i, col, pc.dictionary_encode(table.column(i)))
+        pq.write_table(table, path, row_group_size=row_group_size, use_dictionary=True)
+        logger.info("saved {} utterances to {}".format(len(df), path))
+
+    @classmethod
+    def load(cls, path:str, columns:List[str]=None, filters:list=None)->'ASRDataset':
+        # columns: projection, e.g. ['uuid', 'audio_path', 'duration']
+        # filters: predicates pushed down to row groups, e.g. [('duration', '<', 20)]
+        # only the file read is memory-mapped: compressed pages are decoded to arrow buffers on the heap. the
+        # conversion to pandas releases each arrow column once converted & keeps one block per column, so numeric
+        # columns without nulls are not copied & peak memory stays about one copy of the decoded catalog
+        import pyarrow.parquet as pq
+        table = pq.read_table(path, columns=columns, filters=filters, memory_map=True)
+        dataset = cls.__new__(cls)
+        dataset._audios = None
+        dataset._transcripts = None
+        dataset._df = table.to_pandas(split_blocks=True, self_destruct=True)
+        del table
+        return(dataset)
 
     @property
     def dataset(self):
@@ -325,29 +753,83 @@ class ASRDatasetCSV(ASRDataset):
                 skipinitialspace:bool=True,
                 name:str='common_voice',
                 prepend_audio_path:str='',
-                normalize:bool=True):
-    
+                normalize:bool=True,
+                batch_size:int=1000,
+                cache_path:str=None,
+                n_jobs:int=1,
+                chunksize:int=None):
+        # chunksize reads the csv in chunks of rows, see iter_chunks
+        import pandas as pd
         self._csv_path = path
+        chunks = list(ASRDatasetCSV.iter_chunks(path, map=map, sep=sep, lang=lang, header=header,
+            skipinitialspace=skipinitialspace, prepend_audio_path=prepend_audio_path, normalize=normalize,
+            batch_size=batch_size, cache_path=cache_path, n_jobs=n_jobs, chunksize=chunksize))
+        if not chunks:
+            self._df = pd.DataFrame(columns=list(map) + ['uuid'])
+        else:
+            self._df = pd.concat(chunks) if len(chunks) > 1 else chunks[0]
 
-        df = pd.read_csv(self._csv_path, sep=sep, header=header, skipinitialspace=skipinitialspace, error_bad_lines=False)    
+    @staticmethod
+    def iter_chunks(path:str,
+                map:dict={'sid':'client_id','country':'accent','audio_path':'path','text':'sentence'},
+                sep:str='\t',
+                lang:str='en',
+                header:int=0,
+                skipinitialspace:bool=True,
+                prepend_audio_path:str='',
+                normalize:bool=True,
+                batch_size:int=1000,
+                cache_path:str=None,
+                n_jobs:int=1,
+                chunksize:int=100000)->Iterator['pd.DataFrame']:
+        # streams the csv as dataframes of at most chunksize rows (whole file if None), deduplicated on
+        # (text, sid) across chunks with a set of 64 bit hashes instead of keeping previous rows around
+        # with n_jobs != 1, one pool of normalizer workers is shared by all chunks
+        import numpy as np
+        import pandas as pd
         names = {value : key for (key, value) in map.items()}
-        df.rename(columns=names, inplace=True)
-
-        df['uuid'] = [str(uuid.uuid4()) for x in range(df.shape[0])]
-        df['audio_path'] = df['audio_path'].swifter.apply(lambda x: prepend_audio_path + '/' + x)
+        seen = set()
+        reader = pd.read_csv(path, sep=sep, header=header, skipinitialspace=skipinitialspace, error_bad_lines=False,
+            chunksize=chunksize)
+        executor = normalizer_pool(lang, n_jobs=n_jobs) if normalize and n_jobs != 1 else None
+        try:
+            for df in ([reader] if chunksize is None else reader):
+                df = df.rename(columns=names)
+                df['audio_path'] = prepend_audio_path + '/' + df['audio_path']
+
+                if 'sid' not in df.columns:
+                    df['sid'] = [Path(x).parent.name for x in df['audio_path'].tolist()]
+
+                if normalize:
+                    df['text'] = normalize_texts(df['text'].tolist(), lang, n_jobs=n_jobs, batch_size=batch_size,
+                        cache_path=cache_path, executor=executor)
+                df['uuid'] = utterance_uuids(df['sid'].tolist(), df['audio_path'].tolist(), df['text'].tolist())
+
+                keep = []
+                for text, sid in zip(df['text'].tolist(), df['sid'].tolist()):
+                    key = hashlib.blake2b((str(text) + '\t' + str(sid)).encode('utf-8'), digest_size=8).digest()
+                    keep.append(key not in seen)
+                    seen.add(key)
+                # a boolean mask: an empty list would select columns
+                df = df.loc[np.asarray(keep, dtype=bool)]
+                df = df.replace("",float("NaN"))
+                df = df.dropna(subset=['text'])
+                yield(df)
+        finally:
+            if executor:
+                executor.shutdown()
 
-        if 'sid' not in df.columns:
-            df['sid'] = df.audio_path.apply(lambda x: Path(x).parent.name)
+    @staticmethod
+    def stream2kaldi(path:str, dir_path:str, sr:int=16000, ext:str='wav', chunksize:int=100000, **kwargs)->int:
+        # csv to kaldi data dir in bounded memory: chunks go straight to sorted runs merged by the kaldi writer
+        # kwargs are passed to iter_chunks. returns the number of utterances written
+        def utterances():
+            for df in ASRDatasetCSV.iter_chunks(path, chunksize=chunksize, **kwargs):
+                sids = df['sid'].tolist()
+                utt_ids = [sid + '-' + uuid for sid, uuid in zip(sids, df['uuid'].tolist())]
+                yield(utt_ids, sids, df['audio_path'].tolist(), df['text'].tolist())
+        return(KaldiDataDir(dir_path).write_chunks(utterances(), wav_template=kaldi_wav_template(ext, sr)))
 
-        if normalize:
-            normalizer = TextNormalizer(lang)
-            df['text'] = df['text'].swifter.apply(normalizer.normalize)
-        
-        df = df.drop_duplicates(subset=['text','sid'])
-        df.replace("",float("NaN"), inplace=True)
-        df.dropna(subset=['text'],inplace=True)
-        self._df = df
-    
     @property
-    def df(self)->pd.DataFrame:
+    def df(self)->'pd.DataFrame':
         return(self._df)
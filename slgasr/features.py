@@ -0,0 +1,235 @@
+# (c) 2020 Sylvain Le Groux <slegroux@ccrma.stanford.edu>
+
+# kaldi compatible fbank/mfcc features computed with torchaudio.compliance.kaldi & stored in sharded kaldi
+# binary archives (feats-*.ark) that are read memory-mapped. utterances are assigned to shards by uuid and
+# shards are named after the hash of the feature config & of the audio files of their utterances, so that
+# later builds only recompute shards whose audio or config changed. feats.scp & per speaker cmvn.ark/cmvn.scp
+# are written next to the shards, keyed like the utterances & speakers of ASRDataset.export2kaldi
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import struct
+from pathlib import Path
+from typing import Dict, List
+from slgasr.fileio import MemmapCache, bounded_map, file_stat, load_pcm16
+from slgasr.kaldi import BUFFER_SIZE, kaldi_order
+
+logger = logging.getLogger(__name__)
+
+FEATURES = ('fbank', 'mfcc')
+# default number of utterances per shard. a fixed n_shards keeps shards reusable as a dataset grows
+UTTS_PER_SHARD = 10000
+# matrices in archives start on multiples of ALIGNMENT bytes so that they can be viewed as float32 arrays
+ALIGNMENT = 16
+# size of the binary header of a kaldi matrix: \0B, FM/DM, int32 rows & int32 cols
+MATRIX_HEADER_SIZE = 15
+
+
+def feature_config(feature:str='fbank', sr:int=16000, **options)->dict:
+    # everything features depend on: cached shards are only reused for the same config
+    import torchaudio
+    if feature not in FEATURES:
+        raise ValueError("unknown feature {}, expected one of {}".format(feature, FEATURES))
+    return({'feature': feature, 'sr': sr, 'options': options, 'torchaudio': torchaudio.__version__})
+
+
+def compute_features(path:str, config:dict)->'np.ndarray':
+    import torch
+    from torchaudio.compliance import kaldi
+    samples = load_pcm16(path, config['sr'])
+    # kaldi works on 16 bit sample values, not on floats in [-1, 1]
+    waveform = torch.from_numpy(samples.astype('float32')).unsqueeze(0)
+    compute = kaldi.fbank if config['feature'] == 'fbank' else kaldi.mfcc
+    return(compute(waveform, sample_frequency=config['sr'], **config['options']).numpy())
+
+
+def _compute_features(args):
+    return(compute_features(*args))
+
+
+def write_matrix(f, key:str, matrix:'np.ndarray')->int:
+    # kaldi binary matrix entry of a float32 (FM) or float64 (DM) matrix. the entry is preceded by newlines,
+    # which kaldi skips before keys, so that the data is aligned. returns the scp offset of the matrix
+    code = b'DM ' if matrix.dtype.itemsize == 8 else b'FM '
+    key = key.encode('utf-8') + b' '
+    f.write(b'\n' * (-(f.tell() + len(key) + MATRIX_HEADER_SIZE) % ALIGNMENT))
+    f.write(key)
+    offset = f.tell()
+    rows, cols = matrix.shape
+    f.write(b'\0B' + code + b'\4' + struct.pack('<i', rows) + b'\4' + struct.pack('<i', cols))
+    f.write(matrix.astype('<f8' if code == b'DM ' else '<f4').tobytes())
+    return(offset)
+
+
+class FeatureStore(object):
+    def __init__(self, path:str):
+        import numpy as np
+        self._path = Path(path)
+        with open(str(self._path / 'meta.json')) as f:
+            meta = json.load(f)
+        self._config = meta['config']
+        self._dim = meta['dim']
+        self._shard_names = meta['shards']
+        uuids, shard, offset, frames = [], [], [], []
+        self._cmvn = {}
+        for i, name in enumerate(self._shard_names):
+            index = np.load(str(self._path / (name + '.npz')))
+            uuids.append(index['uuids'])
+            shard.append(np.full(len(index['uuids']), i, dtype=np.int32))
+            offset.append(index['offset'])
+            frames.append(index['frames'])
+            for sid, stats in zip(index['sids'].tolist(), index['cmvn']):
+                self._cmvn[sid] = self._cmvn.get(sid, 0) + stats
+        self._uuids = np.concatenate(uuids) if uuids else np.array([], dtype=str)
+        self._shard = np.concatenate(shard) if shard else np.array([], dtype=np.int32)
+        self._offset = np.concatenate(offset) if offset else np.array([], dtype=np.int64)
+        self._frames = np.concatenate(frames) if frames else np.array([], dtype=np.int64)
+        self._rows = {uuid: i for i, uuid in enumerate(self._uuids.tolist())}
+        self._memmaps = MemmapCache('u1')
+
+    @classmethod
+    def build(cls, dataset, path:str, feature:str='fbank', sr:int=16000, n_jobs:int=1, n_shards:int=None,
+            **options)->'FeatureStore':
+        # dataset: ASRDataset or its dataframe with uuid, sid & audio_path columns
+        # options are passed to torchaudio.compliance.kaldi.fbank/mfcc, e.g. num_mel_bins=80
+        import numpy as np
+        df = dataset.dataset if hasattr(dataset, 'dataset') else dataset
+        uuids = df['uuid'].tolist()
+        sids = df['sid'].tolist()
+        audio_paths = df['audio_path'].tolist()
+        utt_ids = [sid + '-' + uuid for sid, uuid in zip(sids, uuids)]
+        out = Path(path)
+        out.mkdir(parents=True, exist_ok=True)
+        config = feature_config(feature, sr, **options)
+        config_hash = hashlib.sha1(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()
+
+        if not n_shards:
+            n_shards = max(1, -(-len(uuids) // UTTS_PER_SHARD))
+        members = {}
+        for i, uuid in enumerate(uuids):
+            shard = int(hashlib.sha1(uuid.encode('utf-8')).hexdigest()[:8], 16) % n_shards
+            members.setdefault(shard, []).append(i)
+        shards = {}
+        for shard, rows in sorted(members.items()):
+            rows = [rows[j] for j in kaldi_order([utt_ids[i] for i in rows])]
+            key = hashlib.sha1(config_hash.encode('utf-8'))
+            for i in rows:
+                key.update('{}\t{}\t{}\t{}\n'.format(utt_ids[i], audio_paths[i], *file_stat(audio_paths[i])).encode('utf-8'))
+            shards['feats-' + key.hexdigest()[:20]] = rows
+        todo = [name for name in shards if not (out / (name + '.npz')).exists()]
+
+        jobs = [(audio_paths[i], config) for name in todo for i in shards[name]]
+        results = bounded_map(_compute_features, jobs, n_jobs)
+        try:
+            for name in todo:
+                rows = shards[name]
+                offset = np.zeros(len(rows), dtype=np.int64)
+                frames = np.zeros(len(rows), dtype=np.int64)
+                cmvn = {}
+                with open(str(out / (name + '.ark.tmp')), 'wb', buffering=BUFFER_SIZE) as f:
+                    for j, i in enumerate(rows):
+                        feats = next(results)
+                        offset[j] = write_matrix(f, utt_ids[i], feats) + MATRIX_HEADER_SIZE
+                        frames[j] = len(feats)
+                        # kaldi cmvn stats: sums & frame count, sums of squares
+                        stats = cmvn.setdefault(sids[i], np.zeros((2, feats.shape[1] + 1)))
+                        stats[0, :-1] += feats.sum(axis=0, dtype=np.float64)
+                        stats[0, -1] += len(feats)
+                        stats[1, :-1] += np.square(feats, dtype=np.float64).sum(axis=0)
+                os.replace(str(out / (name + '.ark.tmp')), str(out / (name + '.ark')))
+                # the index is written last: it marks the shard as complete
+                np.savez(str(out / (name + '.npz')), uuids=np.array([uuids[i] for i in rows], dtype=str),
+                    utt_ids=np.array([utt_ids[i] for i in rows], dtype=str), offset=offset, frames=frames,
+                    sids=np.array(list(cmvn), dtype=str), cmvn=np.array(list(cmvn.values())))
+        finally:
+            results.close()
+
+        dim = 0
+        feats_scp = []
+        for name in shards:
+            index = np.load(str(out / (name + '.npz')))
+            if len(index['cmvn']):
+                dim = index['cmvn'].shape[2] - 1
+            ark = str((out / (name + '.ark')).absolute())
+            feats_scp += [(utt, '{}:{}'.format(ark, offset - MATRIX_HEADER_SIZE))
+                for utt, offset in zip(index['utt_ids'].tolist(), index['offset'].tolist())]
+        feats_scp.sort()
+        with open(str(out / 'feats.scp'), 'w', encoding='utf-8', buffering=BUFFER_SIZE) as f:
+            for utt, entry in feats_scp:
+                f.write(utt + ' ' + entry + '\n')
+        with open(str(out / 'meta.json'), 'w') as f:
+            json.dump({'config': config, 'config_hash': config_hash, 'dim': dim, 'shards': list(shards)}, f)
+        for stale in set(p.name.split('.')[0] for p in out.glob('feats-*')) - set(shards):
+            for p in out.glob(stale + '.*'):
+                p.unlink()
+        store = cls(path)
+        store._write_cmvn()
+        logger.info("{} features of {} utterances in {} shards, {} computed".format(feature, len(uuids),
+            len(shards), len(todo)))
+        return(store)
+
+    def _write_cmvn(self):
+        ark = str((self._path / 'cmvn.ark').absolute())
+        with open(ark, 'wb', buffering=BUFFER_SIZE) as f, open(str(self._path / 'cmvn.scp'), 'w', encoding='utf-8') as scp:
+            for sid in sorted(self._cmvn):
+                scp.write('{} {}:{}\n'.format(sid, ark, write_matrix(f, sid, self._cmvn[sid])))
+
+    def to_kaldi(self, dir_path:str):
+        # feats.scp & cmvn.scp of a data dir written by export2kaldi for the same dataset
+        for name in ['feats.scp', 'cmvn.scp']:
+            shutil.copy(str(self._path / name), str(Path(dir_path) / name))
+
+    def _memmap(self, shard:int)->'np.memmap':
+        return(self._memmaps.get(str(self._path / (self._shard_names[shard] + '.ark'))))
+
+    def get_array(self, uuid:str)->'np.ndarray':
+        # (frames, dim) float32 view on the archive
+        i = self._rows[uuid]
+        start = self._offset[i]
+        size = self._frames[i] * self._dim * 4
+        return(self._memmap(self._shard[i])[start:start + size].view('<f4').reshape(-1, self._dim))
+
+    def __getitem__(self, uuid:str)->'torch.Tensor':
+        import torch
+        return(torch.from_numpy(self.get_array(uuid)))
+
+    def __contains__(self, uuid:str)->bool:
+        return(uuid in self._rows)
+
+    def __len__(self)->int:
+        return(len(self._uuids))
+
+    def frames(self, uuid:str)->int:
+        return(int(self._frames[self._rows[uuid]]))
+
+    def cmvn_stats(self, sid:str=None)->'np.ndarray':
+        # kaldi (2, dim + 1) stats of a speaker, or of all speakers
+        if sid is not None:
+            return(self._cmvn[sid])
+        return(sum(self._cmvn.values()))
+
+    def apply_cmvn(self, feats:'np.ndarray', sid:str=None, norm_vars:bool=False)->'np.ndarray':
+        import numpy as np
+        stats = self.cmvn_stats(sid)
+        count = stats[0, -1]
+        mean = stats[0, :-1] / count
+        feats = feats - mean.astype(np.float32)
+        if norm_vars:
+            std = np.sqrt(np.maximum(stats[1, :-1] / count - mean ** 2, 1e-10))
+            feats = feats / std.astype(np.float32)
+        return(feats)
+
+    @property
+    def uuids(self)->List[str]:
+        return(self._uuids.tolist())
+
+    @property
+    def dim(self)->int:
+        return(self._dim)
+
+    @property
+    def config(self)->Dict:
+        return(self._config)
@@ -0,0 +1,93 @@
+# (c) 2020 Sylvain Le Groux <slegroux@ccrma.stanford.edu>
+
+# file helpers shared by the kaldi writer & the stores: 16 bit pcm decoding, per process memmaps of shard
+# files, file stats to detect changes & an order preserving process pool map with bounded memory
+
+import os
+from collections import deque
+from typing import Iterable, Iterator, Tuple
+from slgasr.probe import pcm_layout
+
+# results pending per pool worker in bounded_map
+PENDING_PER_JOB = 4
+
+
+def file_stat(path:str)->Tuple[int, int]:
+    # (size, mtime_ns) to detect changed files, (-1, -1) for missing ones
+    try:
+        st = os.stat(path)
+        return((st.st_size, st.st_mtime_ns))
+    except OSError:
+        return((-1, -1))
+
+
+class MemmapCache(object):
+    # memmaps of the shard files of a store, opened lazily & per process: the cache is dropped after a fork
+    # or pickling, so stores can be shared with DataLoader workers
+    def __init__(self, dtype:str):
+        self._dtype = dtype
+        self._pid = None
+        self._maps = {}
+
+    def get(self, path:str)->'np.memmap':
+        import numpy as np
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._maps = {}
+        if path not in self._maps:
+            # copy-on-write mode gives writable arrays torch accepts without copying
+            self._maps[path] = np.memmap(path, dtype=self._dtype, mode='c')
+        return(self._maps[path])
+
+    def __getstate__(self):
+        return({'_dtype': self._dtype, '_pid': None, '_maps': {}})
+
+
+def load_pcm16(path:str, sr:int=16000)->'np.ndarray':
+    # mono 16 bit samples at sample rate sr
+    import numpy as np
+    layout = pcm_layout(path)
+    if layout is not None and layout['sr'] == sr and layout['channels'] == 1:
+        # already in the target format: no decoding
+        return(np.fromfile(path, dtype='<i2', count=layout['frames'], offset=layout['offset']))
+    import torch
+    import torchaudio
+    waveform, orig_sr = torchaudio.load(path)
+    waveform = waveform.mean(dim=0)
+    if orig_sr != sr:
+        waveform = torchaudio.functional.resample(waveform, orig_sr, sr)
+    return((waveform.clamp(-1.0, 1.0) * 32767).round().to(torch.int16).numpy())
+
+
+def bounded_map(fn, jobs:Iterable, n_jobs:int=1)->Iterator:
+    # fn over jobs, results in order, in a pool of n_jobs processes. at most PENDING_PER_JOB * n_jobs jobs are
+    # in flight, so results (e.g. whole wavs) do not pile up in memory when the consumer is slower than the pool
+    if n_jobs <= 1:
+        yield from map(fn, jobs)
+        return
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        window = deque()
+        for job in jobs:
+            window.append(executor.submit(fn, job))
+            if len(window) >= PENDING_PER_JOB * n_jobs:
+                yield(window.popleft().result())
+        while window:
+            yield(window.popleft().result())
+
+
+def bounded_map(fn, jobs:Iterable, n_jobs:int=1)->Iterator:
+    # fn over jobs, results in order, in a pool of n_jobs processes. at most PENDING_PER_JOB * n_jobs jobs are
+    # in flight, so results (e.g. whole wavs) do not pile up in memory when the consumer is slower than the pool
+    if n_jobs <= 1:
+        yield from map(fn, jobs)
+        return
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        window = deque()
+        for job in jobs:
+            window.append(executor.submit(fn, job))
+            if len(window) >= PENDING_PER_JOB * n_jobs:
+                yield(window.popleft().result())
+        while window:
+            yield(window.popleft().result())
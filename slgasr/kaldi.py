@@ -0,0 +1,241 @@
+# (c) 2020 Sylvain Le Groux <slegroux@ccrma.stanford.edu>
+
+# kaldi data directories: http://kaldi-asr.org/doc/data_prep.html
+
+import heapq
+import io
+import itertools
+import json
+import logging
+import os
+import shutil
+import tempfile
+import wave
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Sequence, Tuple
+from slgasr.fileio import bounded_map, load_pcm16
+
+logger = logging.getLogger(__name__)
+
+# write buffer per output file
+BUFFER_SIZE = 1 << 20
+
+# record of the last export in a data dir: utterance, audio path & stat, wav.scp entry
+MANIFEST = 'export.tsv'
+
+
+def kaldi_order(keys:Sequence[str])->List[int]:
+    # indices sorting keys like `LC_ALL=C sort`: python compares code points, i.e. utf-8 byte order
+    return(sorted(range(len(keys)), key=keys.__getitem__))
+
+
+def single_line(text:str)->str:
+    # kaldi files are line based
+    return(' '.join(str(text).split()))
+
+
+def entry_file(entry:str)->str:
+    # file behind a wav.scp entry: the wav itself or the archive of an ark:offset entry
+    path, _, offset = entry.rpartition(':')
+    return(path if path.endswith('.ark') and offset.isdigit() else entry)
+
+
+def write_wav(f, samples:'np.ndarray', sr:int=16000):
+    # f: path or binary file object
+    with wave.open(f, 'wb') as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(sr)
+        w.writeframes(samples.astype('<i2').tobytes())
+
+
+def _materialize(args)->bytes:
+    # runs in pool workers: writes the wav file or returns its bytes when dst is None
+    src, dst, sr = args
+    samples = load_pcm16(src, sr)
+    if dst is not None:
+        write_wav(dst, samples, sr)
+        return(None)
+    buf = io.BytesIO()
+    write_wav(buf, samples, sr)
+    return(buf.getvalue())
+
+
+class KaldiDataDir(object):
+    def __init__(self, path:str):
+        self._path = Path(path)
+        self._path.mkdir(parents=True, exist_ok=True)
+
+    def _write_utterances(self, rows:Iterable[Tuple], wav_template:str, durations:bool)->Iterator[Tuple[str, str]]:
+        # writes rows of (utt, sid, audio_path, text, duration) given in kaldi order to every per utterance file
+        # in a single pass, yielding (utt, sid) once written
+        files = ['wav.scp', 'text', 'utt2spk']
+        if durations:
+            files += ['utt2dur', 'reco2dur']
+        handles = {name: open(str(self._path / name), 'w', encoding='utf-8', buffering=BUFFER_SIZE) for name in files}
+        try:
+            for utt, sid, audio_path, text, duration in rows:
+                handles['wav.scp'].write(utt + ' ' + wav_template.format(audio_path) + '\n')
+                handles['text'].write(utt + ' ' + single_line(text) + '\n')
+                handles['utt2spk'].write(utt + ' ' + sid + '\n')
+                if durations:
+                    # recordings are not segmented: one recording per utterance
+                    line = '{} {:.4f}\n'.format(utt, duration)
+                    handles['utt2dur'].write(line)
+                    handles['reco2dur'].write(line)
+                yield(utt, sid)
+        finally:
+            for f in handles.values():
+                f.close()
+
+    def write(self, utt_ids:Sequence[str], sids:Sequence[str], audio_paths:Sequence[str], texts:Sequence[str],
+            durations:Sequence[float]=None, wav_template:str='{}'):
+        # single pass over the utterances in kaldi order, writing every file at once
+        # wav_template formats audio paths into wav.scp entries, e.g. 'sox {} -t wav - |'
+        # utt2dur & reco2dur are left out when a duration is missing (None or nan, e.g. failed probes)
+        order = kaldi_order(utt_ids)
+        if durations is not None:
+            missing = sum(1 for duration in durations if duration is None or duration != duration)
+            if missing:
+                logger.warning("{} utterances without duration, utt2dur & reco2dur are not written".format(missing))
+                durations = None
+                for name in ['utt2dur', 'reco2dur']:
+                    if (self._path / name).exists():
+                        (self._path / name).unlink()
+        rows = ((utt_ids[i], sids[i], audio_paths[i], texts[i], durations[i] if durations is not None else None)
+            for i in order)
+        spk2utt = {}
+        for utt, sid in self._write_utterances(rows, wav_template, durations is not None):
+            spk2utt.setdefault(sid, []).append(utt)
+        with open(str(self._path / 'spk2utt'), 'w', encoding='utf-8', buffering=BUFFER_SIZE) as f:
+            for sid in sorted(spk2utt):
+                f.write(sid + ' ' + ' '.join(spk2utt[sid]) + '\n')
+        logger.info("wrote {} utterances of {} speakers to {}".format(len(order), len(spk2utt), self._path))
+
+    def write_chunks(self, chunks:Iterable[Tuple[Sequence[str], Sequence[str], Sequence[str], Sequence[str]]],
+            wav_template:str='{}')->int:
+        # bounded memory version of write for chunks of (utt_ids, sids, audio_paths, texts): each chunk is sorted
+        # & spilled to a run file, runs are then merged into the data dir. utterance ids must start by their sid
+        # (as kaldi requires) so that speakers are contiguous & spk2utt can be streamed too
+        runs_dir = tempfile.mkdtemp(prefix='.runs-', dir=str(self._path))
+        try:
+            runs = []
+            for utt_ids, sids, audio_paths, texts in chunks:
+                runs.append(str(Path(runs_dir) / 'run-{:05d}.tsv'.format(len(runs))))
+                with open(runs[-1], 'w', encoding='utf-8', buffering=BUFFER_SIZE) as f:
+                    for i in kaldi_order(utt_ids):
+                        f.write('\t'.join((utt_ids[i], sids[i], audio_paths[i], single_line(texts[i]))) + '\n')
+            handles = [open(run, encoding='utf-8', buffering=BUFFER_SIZE) for run in runs]
+            try:
+                lines = heapq.merge(*handles, key=lambda line: line[:line.index('\t')])
+                rows = (line[:-1].split('\t', 3) + [None] for line in lines)
+                n, speakers = self._write_spk2utt(self._write_utterances(rows, wav_template, False))
+            finally:
+                for f in handles:
+                    f.close()
+        finally:
+            shutil.rmtree(runs_dir)
+        logger.info("wrote {} utterances of {} speakers from {} runs to {}".format(n, speakers, len(runs), self._path))
+        return(n)
+
+    def _write_spk2utt(self, utterances:Iterable[Tuple[str, str]])->Tuple[int, int]:
+        # speakers of utterances in kaldi order are contiguous: one line per run of the same sid
+        n = 0
+        seen = set()
+        current, utts = None, []
+        with open(str(self._path / 'spk2utt'), 'w', encoding='utf-8', buffering=BUFFER_SIZE) as f:
+            for utt, sid in itertools.chain(utterances, [(None, None)]):
+                if sid != current:
+                    if current is not None:
+                        f.write(current + ' ' + ' '.join(utts) + '\n')
+                    if sid in seen:
+                        raise ValueError("utterances of speaker {} are not contiguous, utterance ids must start by the sid".format(sid))
+                    current, utts = sid, []
+                if sid is not None:
+                    seen.add(sid)
+                    utts.append(utt)
+                    n += 1
+        return(n, len(seen))
+
+    def materialize(self, utt_ids:Sequence[str], audio_paths:Sequence[str], sr:int=16000, n_jobs:int=1,
+            archive:bool=False, ark_name:str='wav.ark')->List[str]:
+        # decode, downmix & resample every file once into 16 bit PCM wavs, either one file per utterance
+        # under wavs/ or concatenated in the ark_name archive. returns wav.scp entries aligned with utt_ids
+        order = kaldi_order(utt_ids)
+        if archive:
+            ark = str((self._path / ark_name).absolute())
+            jobs = [(audio_paths[i], None, sr) for i in order]
+        else:
+            wavs = self._path / 'wavs'
+            wavs.mkdir(exist_ok=True)
+            dsts = {i: str((wavs / (utt_ids[i] + '.wav')).absolute()) for i in order}
+            jobs = [(audio_paths[i], dsts[i], sr) for i in order]
+        results = bounded_map(_materialize, jobs, n_jobs)
+        entries = [None] * len(order)
+        try:
+            if archive:
+                # kaldi wav archives: "<utt> " followed by the wav file, scp entries point at the RIFF header
+                with open(ark, 'wb', buffering=BUFFER_SIZE) as f:
+                    for i, data in zip(order, results):
+                        f.write(utt_ids[i].encode('utf-8') + b' ')
+                        entries[i] = '{}:{}'.format(ark, f.tell())
+                        f.write(data)
+            else:
+                for i, _ in zip(order, results):
+                    entries[i] = dsts[i]
+        finally:
+            results.close()
+        logger.info("materialized {} utterances in {}".format(len(order), self._path))
+        return(entries)
+
+    def next_ark_name(self)->str:
+        # archives are never rewritten by incremental exports: new utterances go to a new one
+        n = 0
+        while (self._path / 'wav-{:05d}.ark'.format(n)).exists():
+            n += 1
+        return('wav-{:05d}.ark'.format(n))
+
+    def prune(self, entries:Iterable[str], owned:Iterable[str]):
+        # removes files materialized by a previous export (owned, see materialized_files) no longer referenced by
+        # wav.scp entries. other files of the data dir, e.g. the source wavs of a corpus, are never touched
+        referenced = set(entry_file(entry) for entry in entries)
+        removed = 0
+        for path in set(owned) - referenced:
+            if os.path.exists(path):
+                os.unlink(path)
+                removed += 1
+        if removed:
+            logger.info("removed {} stale audio files from {}".format(removed, self._path))
+
+    def read_manifest(self)->Tuple[dict, Dict[str, Tuple[str, Tuple[int, int], str]]]:
+        # export parameters & utt -> (audio_path, (size, mtime_ns), entry) of the previous export
+        path = self._path / MANIFEST
+        if not path.exists():
+            return({}, {})
+        utterances = {}
+        with open(str(path), encoding='utf-8', buffering=BUFFER_SIZE) as f:
+            params = json.loads(f.readline()[1:])
+            for line in f:
+                utt, audio_path, size, mtime, entry = line[:-1].split('\t')
+                utterances[utt] = (audio_path, (int(size), int(mtime)), entry)
+        return(params, utterances)
+
+    def materialized_files(self)->List[str]:
+        # audio files written to the data dir by the previous export, according to its manifest
+        params, utterances = self.read_manifest()
+        if not params.get('materialize'):
+            return([])
+        return(sorted(set(entry_file(entry) for _, _, entry in utterances.values())))
+
+    def write_manifest(self, params:dict, utt_ids:Sequence[str], audio_paths:Sequence[str],
+            stats:Sequence[Tuple[int, int]], entries:Sequence[str]):
+        tmp = self._path / (MANIFEST + '.tmp')
+        with open(str(tmp), 'w', encoding='utf-8', buffering=BUFFER_SIZE) as f:
+            f.write('#' + json.dumps(params, sort_keys=True) + '\n')
+            for i in kaldi_order(utt_ids):
+                f.write('{}\t{}\t{}\t{}\t{}\n'.format(utt_ids[i], audio_paths[i], stats[i][0], stats[i][1], entries[i]))
+        os.replace(str(tmp), str(self._path / MANIFEST))
+
+    @property
+    def path(self)->str:
+        return(str(self._path))
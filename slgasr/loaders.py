@@ -0,0 +1,215 @@
+# (c) 2020 Sylvain Le Groux <slegroux@ccrma.stanford.edu>
+
+# torch datasets over ASRDataset. items are (waveform, sr, text, uuid) tuples with float waveforms of
+# shape (1, frames) in [-1, 1] at sample rate sr, read from a WaveformStore when one is given
+
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Sequence, Tuple
+import numpy as np
+import torch
+from torch.utils.data import Dataset, IterableDataset, Sampler, get_worker_info
+from slgasr.fileio import load_pcm16
+
+logger = logging.getLogger(__name__)
+
+# audio files read ahead by each iterable dataset worker
+PREFETCH = 16
+# default number of equal count duration buckets
+N_BUCKETS = 10
+
+
+def distributed_info()->Tuple[int, int]:
+    # (rank, world size), (0, 1) outside of distributed training
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        return(torch.distributed.get_rank(), torch.distributed.get_world_size())
+    return(0, 1)
+
+
+def worker_info()->Tuple[int, int]:
+    # (worker id, number of workers) of the current dataloader process, (0, 1) in the main process
+    worker = get_worker_info()
+    return((worker.id, worker.num_workers) if worker is not None else (0, 1))
+
+
+def collate_pad(batch:List[tuple])->tuple:
+    # (waveforms (batch, frames) zero padded, lengths, sr, texts, uuids)
+    waveforms, srs, texts, uuids = zip(*batch)
+    lengths = torch.tensor([w.shape[-1] for w in waveforms])
+    padded = torch.zeros(len(waveforms), int(lengths.max()))
+    for i, w in enumerate(waveforms):
+        padded[i, :w.shape[-1]] = w[0]
+    return(padded, lengths, srs[0], list(texts), list(uuids))
+
+
+class _Columns(object):
+    def __init__(self, dataset, sr:int=16000, store=None):
+        # dataset: ASRDataset or its dataframe with uuid, audio_path & text columns
+        # columns are kept as numpy arrays: no dataframe access per item
+        df = dataset.dataset if hasattr(dataset, 'dataset') else dataset
+        self._uuids = df['uuid'].to_numpy(dtype=object)
+        self._audio_paths = df['audio_path'].to_numpy(dtype=object)
+        self._texts = df['text'].to_numpy(dtype=object)
+        if store is not None and store.sr != sr:
+            raise ValueError("waveform store sample rate {} != {}".format(store.sr, sr))
+        self._sr = sr
+        self._store = store
+
+    def _load(self, n:int)->tuple:
+        if self._store is not None:
+            samples = self._store.get_array(self._uuids[n])
+        else:
+            samples = load_pcm16(self._audio_paths[n], self._sr)
+        waveform = torch.from_numpy(samples.astype(np.float32) / 32768).unsqueeze(0)
+        return(waveform, self._sr, self._texts[n], self._uuids[n])
+
+    def __len__(self)->int:
+        return(len(self._uuids))
+
+
+class ASRTorchDataset(_Columns, Dataset):
+    # map-style: shard with a (distributed) sampler
+    def __getitem__(self, n:int)->tuple:
+        return(self._load(n))
+
+
+class ASRIterableDataset(_Columns, IterableDataset):
+    def __init__(self, dataset, sr:int=16000, store=None, shuffle:bool=False, seed:int=0, prefetch:int=PREFETCH,
+            n_threads:int=4):
+        # each rank x worker reads its own deterministic shard of the (per epoch shuffled) utterances
+        # while n_threads load up to prefetch items ahead
+        super().__init__(dataset, sr, store)
+        self._shuffle = shuffle
+        self._seed = seed
+        self._epoch = 0
+        self._prefetch = max(1, prefetch)
+        self._n_threads = n_threads
+
+    def set_epoch(self, epoch:int):
+        self._epoch = epoch
+
+    def shard(self)->np.ndarray:
+        # indices of this process. every rank sees the same permutation, padded like DistributedSampler
+        # so that ranks get the same number of items. workers of a rank split its items unevenly, without padding
+        order = np.arange(len(self._uuids))
+        if self._shuffle:
+            order = np.random.default_rng(self._seed + self._epoch).permutation(order)
+        rank, world_size = distributed_info()
+        padding = -len(order) % world_size
+        if padding and len(order):
+            order = np.concatenate([order, np.resize(order, padding)])
+        worker_id, num_workers = worker_info()
+        return(order[rank::world_size][worker_id::num_workers])
+
+    def __iter__(self)->Iterator[tuple]:
+        indices = self.shard()
+        window = deque()
+        with ThreadPoolExecutor(max_workers=self._n_threads) as executor:
+            for n in indices:
+                window.append(executor.submit(self._load, n))
+                if len(window) >= self._prefetch:
+                    yield(window.popleft().result())
+            while window:
+                yield(window.popleft().result())
+
+
+class DurationBucketSampler(Sampler):
+    def __init__(self, durations:Sequence[float], max_seconds:float=None, max_frames:int=None, sr:int=16000,
+            boundaries:Sequence[float]=None, n_buckets:int=N_BUCKETS, shuffle:bool=True, seed:int=0,
+            num_replicas:int=None, rank:int=None):
+        # batch sampler grouping utterances of similar durations: batches are filled up to a padded budget,
+        # batch size x longest utterance, of max_seconds (or max_frames samples at sr). utterances longer than
+        # the budget get a batch of their own
+        # boundaries: upper durations of the buckets, by default n_buckets buckets of equal counts
+        # the duration sort & buckets are computed once, epochs only shuffle within & across buckets
+        # missing durations (None or nan, e.g. failed probes) count as the whole budget: one batch each
+        if (max_seconds is None) == (max_frames is None):
+            raise ValueError("either max_seconds or max_frames is required")
+        self._budget = max_seconds if max_seconds is not None else max_frames / sr
+        self._durations = np.asarray(durations, dtype=np.float64)
+        missing = np.isnan(self._durations)
+        if missing.any():
+            logger.warning("{} utterances without duration get a batch of their own".format(int(missing.sum())))
+            self._durations = np.where(missing, self._budget, self._durations)
+        order = np.argsort(self._durations, kind='stable')
+        if boundaries is None:
+            boundaries = np.quantile(self._durations, np.linspace(0, 1, n_buckets + 1)[1:-1]) if len(order) else []
+        self._boundaries = np.unique(np.asarray(boundaries, dtype=np.float64))
+        buckets = np.searchsorted(self._boundaries, self._durations[order], side='right')
+        self._buckets = np.split(order, np.searchsorted(buckets, np.arange(1, len(self._boundaries) + 1)))
+        self._bucket_of = np.empty(len(order), dtype=np.int64)
+        self._bucket_of[order] = buckets
+        self._shuffle = shuffle
+        self._seed = seed
+        self._epoch = 0
+        default_rank, default_replicas = distributed_info()
+        self._num_replicas = num_replicas if num_replicas is not None else default_replicas
+        self._rank = rank if rank is not None else default_rank
+        self._batches = None
+
+    @classmethod
+    def from_dataset(cls, dataset, **kwargs)->'DurationBucketSampler':
+        # dataset: ASRDataset or its dataframe with a duration column
+        df = dataset.dataset if hasattr(dataset, 'dataset') else dataset
+        return(cls(df['duration'].to_numpy(), **kwargs))
+
+    def set_epoch(self, epoch:int):
+        self._epoch = epoch
+        self._batches = None
+
+    def batches(self)->List[List[int]]:
+        # batches of this rank for the current epoch
+        if self._batches is not None:
+            return(self._batches)
+        rng = np.random.default_rng(self._seed + self._epoch)
+        batches = []
+        for bucket in self._buckets:
+            indices = rng.permutation(bucket) if self._shuffle else bucket
+            batch, longest = [], 0.0
+            for i in indices.tolist():
+                duration = self._durations[i]
+                if batch and max(longest, duration) * (len(batch) + 1) > self._budget:
+                    batches.append(batch)
+                    batch, longest = [], 0.0
+                batch.append(i)
+                longest = max(longest, duration)
+            if batch:
+                batches.append(batch)
+        if self._shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        # every rank builds the same batches & takes its share, padded by cycling so that ranks get as many
+        # batches, even with fewer batches than ranks
+        padding = -len(batches) % self._num_replicas
+        if padding and batches:
+            batches += [batches[i % len(batches)] for i in range(padding)]
+        self._batches = batches[self._rank::self._num_replicas]
+        return(self._batches)
+
+    def stats(self)->Dict[str, object]:
+        # padding efficiency (audio / padded audio) of the current epoch, overall & per bucket, to tune boundaries
+        buckets = [{'max_duration': float(b), 'utterances': 0, 'batches': 0, 'seconds': 0.0, 'padded_seconds': 0.0}
+            for b in self._boundaries.tolist() + [float('inf')]]
+        for batch in self.batches():
+            durations = self._durations[batch]
+            bucket = buckets[self._bucket_of[batch[0]]]
+            bucket['utterances'] += len(batch)
+            bucket['batches'] += 1
+            bucket['seconds'] += float(durations.sum())
+            bucket['padded_seconds'] += float(durations.max()) * len(batch)
+        for bucket in buckets:
+            bucket['efficiency'] = bucket['seconds'] / bucket['padded_seconds'] if bucket['padded_seconds'] else 1.0
+        seconds = sum(bucket['seconds'] for bucket in buckets)
+        padded_seconds = sum(bucket['padded_seconds'] for bucket in buckets)
+        return({'batches': len(self.batches()), 'utterances': sum(bucket['utterances'] for bucket in buckets),
+            'seconds': seconds, 'padded_seconds': padded_seconds,
+            'efficiency': seconds / padded_seconds if padded_seconds else 1.0, 'buckets': buckets})
+
+    def __iter__(self)->Iterator[List[int]]:
+        stats = self.stats()
+        logger.info("epoch {}: {} batches, padding efficiency {:.1%}".format(self._epoch, stats['batches'],
+            stats['efficiency']))
+        return(iter(self.batches()))
+
+    def __len__(self)->int:
+        return(len(self.batches()))
@@ -1,11 +1,24 @@
 #!/usr/bin/env python
 # (c) 2020 Sylvain Le Groux <slegroux@ccrma.stanford.edu>
 
-from typing import List, Set, Dict
+from typing import Iterable, Iterator, List, Set, Dict
+from collections.abc import Sequence
+from array import array
+import csv
+import glob
+import gzip
+import io
+import itertools
+import json
 import math
+import mmap
+import os
+import shutil
+import tempfile
+import weakref
+from pathlib import Path
 import numpy as np
 import logging
-from collections import Counter
 # from IPython import embed
 
 logger = logging.getLogger('language_modeling')
@@ -25,55 +38,340 @@ logger.addHandler(fh)
 logger.addHandler(ch)
 
 
+BOS = '<s>'
+EOS = '</s>'
+UNK = '<unk>'
+# log10 probability of <unk> in ARPA LMs without it
+UNK_LOGPROB = -99.0
+# default memory budget in bytes of the n-gram count buffers
+MEMORY = 1 << 30
+# sentences per block of a streamed corpus
+BLOCK_SIZE = 100000
+# bytes read at a time from ARPA files
+ARPA_BLOCK_BYTES = 1 << 22
+
+
+def encode_sentences(sentences:Iterable[List[str]], index:Dict[str, int]=None)->tuple:
+    # (index, tokens, offsets): word -> id mapping extended with new words, flat int32 token ids & int64
+    # sentence offsets, sentence i being tokens[offsets[i]:offsets[i+1]]
+    if index is None:
+        index = {BOS: 0, EOS: 1}
+    tokens = array('i')
+    offsets = array('q', [0])
+    for sentence in sentences:
+        tokens.extend([index.setdefault(w, len(index)) for w in sentence])
+        offsets.append(len(tokens))
+    return(index, np.frombuffer(tokens, dtype=np.int32), np.frombuffer(offsets, dtype=np.int64))
+
+
+class CorpusView(Sequence):
+    # sentences of an encoded corpus as lists of words, decoded on access
+    def __init__(self, words:List[str], tokens:np.ndarray, offsets:np.ndarray):
+        self._words = words
+        self._tokens = tokens
+        self._offsets = offsets
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return([self[j] for j in range(*i.indices(len(self)))])
+        if i < 0:
+            i += len(self)
+        words = self._words
+        return([words[t] for t in self._tokens[self._offsets[i]:self._offsets[i + 1]].tolist()])
+
+    def __len__(self)->int:
+        return(len(self._offsets) - 1)
+
+    def __eq__(self, other)->bool:
+        return(list(self) == list(other))
+
+    @property
+    def encoded(self)->tuple:
+        return(self._words, self._tokens, self._offsets)
+
+
+def expand_paths(paths)->List[str]:
+    # files of a path, a glob or a list of them. missing files are errors, not empty corpora
+    if isinstance(paths, (str, os.PathLike)):
+        paths = [paths]
+    expanded = []
+    for path in paths:
+        path = str(path)
+        if glob.has_magic(path):
+            matches = sorted(glob.glob(path))
+            if not matches:
+                raise FileNotFoundError("no file matches {}".format(path))
+            expanded += matches
+        elif not os.path.isfile(path):
+            raise FileNotFoundError("no such file {}".format(path))
+        else:
+            expanded.append(path)
+    return(expanded)
+
+
+def iter_lines(path:str)->Iterator[bytes]:
+    # lines of a file read through a memory map, or decompressed on the fly for .gz files
+    if path.endswith('.gz'):
+        with gzip.open(path, 'rb') as f:
+            yield from f
+        return
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            yield from iter(mm.readline, b'')
+
+
+def read_sentences(paths, add_bos:bool=True, add_eos:bool=True)->Iterator[List[str]]:
+    # lowercased sentences of every line of the files of paths
+    bos = [BOS] if add_bos else []
+    eos = [EOS] if add_eos else []
+    for path in expand_paths(paths):
+        for line in iter_lines(path):
+            yield(bos + line.decode('utf-8').lower().split() + eos)
+
+
+class CorpusStream(object):
+    # corpus read lazily from files, a glob or a list of them, plain or gzipped. every pass over the sentences
+    # also computes the vocab & number of sentences, & Unigram/Bigram/NGram count it block by block without
+    # holding it in memory
+    def __init__(self, paths, add_bos:bool=True, add_eos:bool=True, block_size:int=BLOCK_SIZE):
+        self._paths = expand_paths(paths)
+        self._add_bos = add_bos
+        self._add_eos = add_eos
+        self._block_size = block_size
+        self._words = None
+        self._num_sentences = None
+
+    def __iter__(self)->Iterator[List[str]]:
+        vocab = {BOS: None, EOS: None}
+        n = 0
+        for sentence in read_sentences(self._paths, self._add_bos, self._add_eos):
+            n += 1
+            for w in sentence:
+                vocab[w] = None
+            yield(sentence)
+        self._words, self._num_sentences = list(vocab), n
+
+    def blocks(self, index:Dict[str, int]=None)->Iterator[tuple]:
+        # (tokens, offsets) of blocks of block_size sentences, word ids from index which is extended in place
+        if index is None:
+            index = {BOS: 0, EOS: 1}
+        sentences = iter(self)
+        while True:
+            block = list(itertools.islice(sentences, self._block_size))
+            if not block:
+                break
+            _, tokens, offsets = encode_sentences(block, index)
+            yield(tokens, offsets)
+
+    def counts(self, order:int=2)->tuple:
+        # (words, unigram counts, (bigram keys, counts) if order > 1) in a single pass
+        index = {BOS: 0, EOS: 1}
+        unigrams = np.zeros(0, dtype=np.int64)
+        keys, counts = [], []
+        pending = 0
+        for tokens, offsets in self.blocks(index):
+            block = np.bincount(tokens, minlength=len(index))
+            block[:len(unigrams)] += unigrams
+            unigrams = block
+            if order > 1:
+                # ids packed on 32 bits while the vocabulary grows
+                block_keys, block_counts = count_pairs(tokens, offsets, 1 << 32)
+                keys.append(block_keys)
+                counts.append(block_counts)
+                pending += len(block_keys)
+                if pending > 4 * self._block_size:
+                    reduced_keys, reduced_counts = _reduce(np.concatenate(keys), np.concatenate(counts))
+                    keys, counts, pending = [reduced_keys], [reduced_counts], len(reduced_keys)
+        V = len(index)
+        unigrams = np.concatenate([unigrams, np.zeros(V - len(unigrams), dtype=np.int64)])
+        pairs = None
+        if order > 1:
+            pairs = _reduce(np.concatenate(keys or [np.zeros(0, dtype=np.int64)]),
+                np.concatenate(counts or [np.zeros(0, dtype=np.int64)]))
+            pairs = ((pairs[0] >> 32) * V + (pairs[0] & 0xffffffff), pairs[1])
+        return(list(index), unigrams, pairs)
+
+    @property
+    def corpus(self)->'CorpusStream':
+        return(self)
+
+    @property
+    def paths(self)->List[str]:
+        return(self._paths)
+
+    @property
+    def vocab(self)->Set[str]:
+        # computed by the first pass over the corpus
+        if self._words is None:
+            for _ in self:
+                pass
+        return(set(self._words))
+
+    @property
+    def num_unique_words(self)->int:
+        return(len(self.vocab))
+
+    @property
+    def num_sentences(self)->int:
+        if self._num_sentences is None:
+            self.vocab
+        return(self._num_sentences)
+
+
 class Corpus(object):
     def __init__(self, path:str, add_bos:bool=True, add_eos:bool=True):
+        # path: file, glob or list of files, plain or gzipped
+        # sentences are stored as one flat int32 array of word ids with sentence offsets
         logger.info('Parse and format corpus')
-        self._corpus = []
-        self._vocab = set()
+        self._index = {BOS: 0, EOS: 1}
+        self._tokens = np.zeros(0, dtype=np.int32)
+        self._offsets = np.zeros(1, dtype=np.int64)
         self._path = path
-        self._num_sentences = 0
         self.parse_and_format_corpus(self._path, add_bos, add_eos)
 
     def parse_and_format_corpus(self, path:str, add_bos:bool=True, add_eos:bool=True):
         try:
-            with open(path, 'r', encoding='utf-8') as f:
-                for line in f:
-                    self._num_sentences += 1
-                    l = line.strip().split()
-                    l = [ w.lower() for w in l ]
-                    for w in l:
-                        self._vocab.add(w)
-                    if add_eos:
-                        l.append('</s>')
-                    if add_bos:
-                        l.insert(0,'<s>')
-                    self._corpus.append(l)
+            self._index, self._tokens, self._offsets = encode_sentences(read_sentences(path, add_bos, add_eos),
+                self._index)
         except IOError as e:
             logger.error(str(e))
+            raise
+        self._words = list(self._index)
 
     @property
     def corpus(self)->List[List[str]]:
-        return(self._corpus)
+        return(CorpusView(self._words, self._tokens, self._offsets))
+
+    @property
+    def tokens(self)->np.ndarray:
+        return(self._tokens)
+
+    @property
+    def offsets(self)->np.ndarray:
+        return(self._offsets)
+
+    @property
+    def words(self)->List[str]:
+        # word of each id
+        return(self._words)
+
+    @property
+    def index(self)->Dict[str, int]:
+        # id of each word
+        return(self._index)
 
     @property
     def vocab(self)->Set[str]:
-        for sym in ['<s>', '</s>']:
-            self._vocab.add(sym)
-        return(self._vocab)
+        return(set(self._words))
 
     @property
     def num_unique_words(self)->int:
-        return(len(self.vocab))
+        return(len(self._words))
 
     @property
     def num_sentences(self)->int:
-        return(self._num_sentences)
+        return(len(self._offsets) - 1)
+
+
+def _encoded(corpus)->tuple:
+    # (words, tokens, offsets) of a Corpus, a corpus view or a list of sentences
+    if isinstance(corpus, Corpus):
+        return(corpus.words, corpus.tokens, corpus.offsets)
+    if isinstance(corpus, CorpusView):
+        return(corpus.encoded)
+    index, tokens, offsets = encode_sentences(corpus)
+    return(list(index), tokens, offsets)
+
+
+def count_pairs(tokens:np.ndarray, offsets:np.ndarray, vocab_size:int)->tuple:
+    # (sorted keys w1 * V + w2, counts) of the pairs of consecutive tokens inside sentences
+    inside = np.ones(max(len(tokens) - 1, 0), dtype=bool)
+    ends = offsets[1:-1] - 1
+    inside[ends[(ends >= 0) & (ends < len(inside))]] = False
+    pairs = tokens[:-1][inside].astype(np.int64) * vocab_size + tokens[1:][inside]
+    return(np.unique(pairs, return_counts=True))
+
+
+def shard_file(path:str, n_shards:int)->List[tuple]:
+    # (start, end) byte ranges splitting a file in about n_shards pieces on line boundaries
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, 'rb') as f:
+        for i in range(1, n_shards):
+            f.seek(max(size * i // n_shards, bounds[-1]))
+            f.readline()
+            bounds.append(min(f.tell(), size))
+    bounds.append(size)
+    return([(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if end > start])
+
+
+def _count_shard(args)->tuple:
+    # words of the shard joined by newlines, unigram counts & bigram (keys, counts) by shard word id
+    path, start, end, add_bos, add_eos, bigrams = args
+    bos = [BOS] if add_bos else []
+    eos = [EOS] if add_eos else []
+
+    def lines():
+        with open(path, 'rb') as f:
+            f.seek(start)
+            while f.tell() < end:
+                line = f.readline()
+                if not line:
+                    break
+                yield(bos + line.decode('utf-8').lower().split() + eos)
+
+    index, tokens, offsets = encode_sentences(lines())
+    unigrams = np.bincount(tokens, minlength=len(index))
+    pairs = count_pairs(tokens, offsets, len(index)) if bigrams else None
+    return('\n'.join(index), unigrams, pairs)
+
+
+def count_file(path:str, add_bos:bool=True, add_eos:bool=True, n_jobs:int=None, bigrams:bool=True)->tuple:
+    # (words, unigram counts, (bigram keys, counts)) of a corpus file counted by byte range shards in n_jobs
+    # processes. partial counts come back as arrays over shard vocabularies & are remapped to the vocabulary
+    # of the whole file, whose ids are in order of first occurrence like in Corpus
+    from concurrent.futures import ProcessPoolExecutor
+    if not n_jobs or n_jobs < 1:
+        n_jobs = os.cpu_count()
+    jobs = [(path, start, end, add_bos, add_eos, bigrams) for start, end in shard_file(path, n_jobs)]
+    if n_jobs > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            results = list(executor.map(_count_shard, jobs))
+    else:
+        results = [_count_shard(job) for job in jobs]
+    index = {BOS: 0, EOS: 1}
+    remaps = [np.array([index.setdefault(w, len(index)) for w in words.split('\n')], dtype=np.int64)
+        for words, _, _ in results]
+    V = len(index)
+    unigrams = np.zeros(V, dtype=np.int64)
+    keys, counts = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+    for remap, (_, shard_unigrams, pairs) in zip(remaps, results):
+        np.add.at(unigrams, remap, shard_unigrams)
+        if pairs is not None:
+            shard_keys, shard_counts = pairs
+            keys.append(remap[shard_keys // len(remap)] * V + remap[shard_keys % len(remap)])
+            counts.append(shard_counts)
+    pairs = _reduce(np.concatenate(keys), np.concatenate(counts)) if bigrams else None
+    return(list(index), unigrams, pairs)
 
 
 class Unigram(object):
+    # order of the counts of a streamed corpus
+    _order = 1
+
     def __init__(self, corpus:List[List[str]]):
+        # corpus: Corpus, Corpus.corpus, CorpusStream or list of sentences
         logger.info("read corpus")
         self._corpus = corpus
+        self._stream_counts = None
+        if isinstance(corpus, CorpusStream):
+            # a single pass counts everything, the corpus is never held in memory
+            self._words, unigrams, pairs = corpus.counts(self._order)
+            self._stream_counts = (unigrams, pairs)
+        else:
+            self._words, self._tokens, self._offsets = _encoded(corpus)
         self._unigram_counter = {}
         self._probs = {}
         self._tot_count = 0
@@ -81,20 +379,37 @@ class Unigram(object):
         self.count_unigrams()
     
     def count_unigrams(self):
-        for sentence in self._corpus:
-            for word in sentence:
-                self._tot_count += 1
-                if word in self._unigram_counter:
-                    self._unigram_counter[word] += 1
-                else:
-                    self._unigram_counter[word] = 1
-    
+        if self._stream_counts is not None:
+            self._set_unigram_counts(self._stream_counts[0])
+        else:
+            self._set_unigram_counts(np.bincount(self._tokens, minlength=len(self._words)))
+
+    def _set_unigram_counts(self, counts:np.ndarray):
+        # counts: per word id
+        self._unigram_counts = counts
+        self._tot_count = int(counts.sum())
+        ids = np.flatnonzero(counts)
+        self._unigram_counter = {self._words[i]: c for i, c in zip(ids.tolist(), counts[ids].tolist())}
+        self._probs = {}
         for word in self._unigram_counter:
             self._probs[word] = self._unigram_counter[word] / self._tot_count
 
+    @classmethod
+    def from_file(cls, path:str, add_bos:bool=True, add_eos:bool=True, n_jobs:int=None)->'Unigram':
+        # counts a corpus file in n_jobs processes without loading the corpus, same results as Unigram(Corpus(path))
+        words, unigrams, _ = count_file(path, add_bos, add_eos, n_jobs, bigrams=False)
+        model = cls.__new__(cls)
+        model._corpus = None
+        model._words = words
+        model._set_unigram_counts(unigrams)
+        return(model)
+
     def generate(self)->float:
         return(np.random.choice(list(self._probs.keys()),p=list(self._probs.values())))
 
+    def to_arpa(self, path:str, discounts:List[float]=None):
+        CompiledLM.build(self, discounts).to_arpa(path)
+
     @property
     def counts(self)->Dict:
         return(self._unigram_counter)
@@ -109,18 +424,42 @@ class Unigram(object):
 
 
 class Bigram(Unigram):
+    _order = 2
+
     def __init__(self, corpus:List[List[str]]):
         Unigram.__init__(self, corpus)
-        self._corpus = corpus
-        self._bigram_counter = Counter()
+        self._bigram_counter = {}
         self.count_bigrams()
         self._probs = {}
         self.get_cond_probs()
 
     def count_bigrams(self):
-        for line in self._corpus:
-            self._bigram_counter.update([ (line[i], line[i+1]) for i in range(len(line)-1)])
-    
+        if self._stream_counts is not None:
+            self._set_bigram_counts(*self._stream_counts[1])
+        else:
+            self._set_bigram_counts(*count_pairs(self._tokens, self._offsets, len(self._words)))
+
+    def _set_bigram_counts(self, keys:np.ndarray, counts:np.ndarray):
+        # keys: sorted w1 * V + w2 of each bigram
+        V = len(self._words)
+        self._bigram_keys = keys
+        self._bigram_counts = counts
+        w = self._words
+        self._bigram_counter = {(w[k // V], w[k % V]): c for k, c in zip(keys.tolist(), counts.tolist())}
+
+    @classmethod
+    def from_file(cls, path:str, add_bos:bool=True, add_eos:bool=True, n_jobs:int=None)->'Bigram':
+        # counts a corpus file in n_jobs processes without loading the corpus, same results as Bigram(Corpus(path))
+        words, unigrams, bigrams = count_file(path, add_bos, add_eos, n_jobs)
+        model = cls.__new__(cls)
+        model._corpus = None
+        model._words = words
+        model._set_unigram_counts(unigrams)
+        model._set_bigram_counts(*bigrams)
+        model._probs = {}
+        model.get_cond_probs()
+        return(model)
+
     def get_cond_probs(self):
         # P(B|A) = C(A,B) / C(A)
         for k in self._bigram_counter:
@@ -136,4 +475,573 @@ class Bigram(Unigram):
     
     @property
     def probs(self)->Dict:
-        return(self._probs)
\ No newline at end of file
+        return(self._probs)
+
+
+def _reduce(keys:np.ndarray, counts:np.ndarray)->tuple:
+    # sorted unique keys & summed counts
+    order = np.argsort(keys, kind='stable')
+    keys, counts = keys[order], counts[order]
+    if len(keys) == 0:
+        return(keys, counts)
+    starts = np.concatenate([[0], np.flatnonzero(keys[1:] != keys[:-1]) + 1])
+    return(keys[starts], np.add.reduceat(counts, starts))
+
+
+def merge_runs(runs:List[tuple], block_size:int=1 << 20)->Iterator[tuple]:
+    # k-way merge of sorted & reduced runs of (keys, counts) arrays, typically memory-mapped from disk
+    # yields sorted & reduced blocks, the keys of a block being all smaller than those of the next blocks
+    positions = [0] * len(runs)
+    while True:
+        active = [r for r in range(len(runs)) if positions[r] < len(runs[r][0])]
+        if not active:
+            return
+        blocks = {r: (runs[r][0][positions[r]:positions[r] + block_size], runs[r][1][positions[r]:positions[r] + block_size])
+            for r in active}
+        # keys up to the smallest last key of the blocks of runs with more keys after their block can all be merged
+        bounded = [blocks[r][0][-1:] for r in active if positions[r] + block_size < len(runs[r][0])]
+        frontier = np.sort(np.concatenate(bounded))[:1] if bounded else None
+        keys, counts = [], []
+        for r in active:
+            n = len(blocks[r][0]) if frontier is None else int(np.searchsorted(blocks[r][0], frontier, side='right')[0])
+            keys.append(blocks[r][0][:n])
+            counts.append(blocks[r][1][:n])
+            positions[r] += n
+        yield(_reduce(np.concatenate(keys), np.concatenate(counts)))
+
+
+class NGram(object):
+    # counts of every n-gram of order 1 to order, computed in bounded memory like KenLM's lmplz: n-grams of
+    # word ids are packed into integer keys, accumulated in fixed size buffers that are sorted, reduced and
+    # spilled to disk as runs when full, then merged
+    def __init__(self, corpus=None, order:int=3, vocab_size:int=None, memory:int=MEMORY, tmp_dir:str=None):
+        # corpus: Corpus, Corpus.corpus, CorpusStream or list of sentences, counted right away if given
+        # vocab_size: bound on word ids, known from in-memory corpora. keys are uint64 when order x bits per id
+        # fit in 64 bits, byte strings of big endian 32 bit ids otherwise. streams assume 32 bit ids unless given
+        # memory: approximate budget in bytes of the in-memory buffers
+        self._order = order
+        self._words = None
+        stream = isinstance(corpus, CorpusStream)
+        if corpus is not None and not stream:
+            self._words, tokens, offsets = _encoded(corpus)
+            vocab_size = len(self._words)
+        self._width = max(1, (vocab_size - 1).bit_length()) if vocab_size else 32
+        self._buffer_size = max(1024, memory // (16 * order))
+        self._buffers = {n: [] for n in range(1, order + 1)}
+        self._buffered = {n: 0 for n in range(1, order + 1)}
+        self._runs = {n: [] for n in range(1, order + 1)}
+        self._counts = {}
+        self._tmp_dir = tempfile.mkdtemp(prefix='ngram-', dir=tmp_dir)
+        self._cleanup = weakref.finalize(self, shutil.rmtree, self._tmp_dir, True)
+        if stream:
+            index = {BOS: 0, EOS: 1}
+            for tokens, offsets in corpus.blocks(index):
+                self.add(tokens, offsets)
+            self._words = list(index)
+            self.finalize()
+        elif corpus is not None:
+            self.add(tokens, offsets)
+            self.finalize()
+
+    def _packed(self, n:int)->bool:
+        return(n * self._width <= 64)
+
+    def encode(self, ngrams:np.ndarray)->np.ndarray:
+        # (k, n) word ids to keys sorting like the n-grams
+        n = ngrams.shape[1]
+        if self._packed(n):
+            keys = np.zeros(len(ngrams), dtype=np.uint64)
+            for j in range(n):
+                keys |= ngrams[:, j].astype(np.uint64) << np.uint64(self._width * (n - 1 - j))
+            return(keys)
+        return(np.ascontiguousarray(ngrams.astype('>u4')).view('V{}'.format(4 * n)).ravel())
+
+    def decode(self, keys:np.ndarray, n:int)->np.ndarray:
+        # keys of n-grams to (k, n) int32 word ids
+        if self._packed(n):
+            mask = np.uint64((1 << self._width) - 1)
+            return(np.stack([(keys >> np.uint64(self._width * (n - 1 - j))) & mask for j in range(n)], axis=1)
+                .astype(np.int32).reshape(-1, n))
+        return(np.ascontiguousarray(keys).view('>u4').reshape(-1, n).astype(np.int32))
+
+    def add(self, tokens:np.ndarray, offsets:np.ndarray):
+        # block of encoded sentences: sentence i is tokens[offsets[i]:offsets[i+1]]
+        # counted in slices of whole sentences of about a buffer of tokens, so that the n-grams & keys
+        # computed at once stay within the memory budget whatever the size of the block
+        if self._counts:
+            raise ValueError("counts are final")
+        if len(tokens) and int(tokens.max()) >= 1 << self._width:
+            raise ValueError("word id {} does not fit in {} bits".format(int(tokens.max()), self._width))
+        offsets = np.asarray(offsets)
+        start = 0
+        while start < len(offsets) - 1:
+            # at least one sentence per slice, longer sentences than a buffer are counted alone
+            end = max(start + 1, int(np.searchsorted(offsets, offsets[start] + self._buffer_size, side='right')) - 1)
+            end = min(end, len(offsets) - 1)
+            self._add_slice(tokens[offsets[start]:offsets[end]], offsets[start:end + 1] - offsets[start])
+            start = end
+
+    def _add_slice(self, tokens:np.ndarray, offsets:np.ndarray):
+        sentence = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+        for n in range(1, self._order + 1):
+            if len(tokens) < n:
+                continue
+            # n-grams start where the sentence of their first & last word is the same
+            starts = np.flatnonzero(sentence[:len(tokens) - n + 1] == sentence[n - 1:])
+            self._buffer(n, self.encode(np.stack([tokens[starts + j] for j in range(n)], axis=1)))
+
+    def _buffer(self, n:int, keys:np.ndarray):
+        # buffers are spilled before they would exceed _buffer_size keys
+        if self._buffered[n] and self._buffered[n] + len(keys) > self._buffer_size:
+            self._spill(n)
+        self._buffers[n].append(keys)
+        self._buffered[n] += len(keys)
+        if self._buffered[n] >= self._buffer_size:
+            self._spill(n)
+
+    def _sorted_buffer(self, n:int)->tuple:
+        keys = np.concatenate(self._buffers[n]) if self._buffers[n] else self.encode(np.zeros((0, n), dtype=np.int32))
+        self._buffers[n], self._buffered[n] = [], 0
+        return(_reduce(keys, np.ones(len(keys), dtype=np.int64)))
+
+    def _spill(self, n:int):
+        keys, counts = self._sorted_buffer(n)
+        path = os.path.join(self._tmp_dir, '{}-{:05d}'.format(n, len(self._runs[n])))
+        np.save(path + '.keys.npy', keys)
+        np.save(path + '.counts.npy', counts)
+        self._runs[n].append(path)
+        logger.debug("spilled {} {}-grams to {}".format(len(keys), n, path))
+
+    def finalize(self):
+        # merges the runs of each order, into memory-mapped files when there are runs on disk
+        for n in range(1, self._order + 1):
+            if not self._runs[n]:
+                self._counts[n] = self._sorted_buffer(n)
+                continue
+            if self._buffered[n]:
+                self._spill(n)
+            runs = [(np.load(path + '.keys.npy', mmap_mode='r'), np.load(path + '.counts.npy', mmap_mode='r'))
+                for path in self._runs[n]]
+            path = os.path.join(self._tmp_dir, '{}-merged'.format(n))
+            total = 0
+            with open(path + '.keys', 'wb') as fk, open(path + '.counts', 'wb') as fc:
+                for keys, counts in merge_runs(runs):
+                    fk.write(keys.tobytes())
+                    fc.write(counts.astype(np.int64).tobytes())
+                    total += len(keys)
+            dtype = runs[0][0].dtype
+            for p in self._runs[n]:
+                os.remove(p + '.keys.npy')
+                os.remove(p + '.counts.npy')
+            self._runs[n] = []
+            self._counts[n] = (np.memmap(path + '.keys', dtype=dtype, mode='r', shape=(total,)) if total else
+                np.zeros(0, dtype=dtype), np.memmap(path + '.counts', dtype=np.int64, mode='r', shape=(total,)) if total
+                else np.zeros(0, dtype=np.int64))
+            logger.info("merged {} {}-grams".format(total, n))
+
+    def ngrams(self, n:int=None)->tuple:
+        # ((k, n) word ids, counts) of the n-grams of order n, sorted
+        n = n or self._order
+        keys, counts = self._counts[n]
+        return(self.decode(keys, n), counts)
+
+    def to_arpa(self, path:str, discounts:List[float]=None):
+        CompiledLM.build(self, discounts).to_arpa(path)
+
+    def keys(self, n:int=None)->tuple:
+        # (sorted keys, counts) of the n-grams of order n
+        return(self._counts[n or self._order])
+
+    @property
+    def order(self)->int:
+        return(self._order)
+
+    @property
+    def words(self)->List[str]:
+        return(self._words)
+
+    @property
+    def counts(self)->Dict:
+        # counts of the highest order n-grams by tuple of words
+        ids, counts = self.ngrams()
+        w = self._words
+        return({tuple(w[i] for i in ngram): c for ngram, c in zip(ids.tolist(), counts.tolist())})
+
+
+def lookup(keys:np.ndarray, queries:np.ndarray)->np.ndarray:
+    # rows of queries in sorted keys, -1 when missing
+    rows = np.searchsorted(keys, queries)
+    found = rows < len(keys)
+    found[found] = keys[rows[found]] == queries[found]
+    return(np.where(found, rows, -1))
+
+
+def _counts_by_order(model)->tuple:
+    # (words, [(sorted (k, n) word ids, counts) for n = 1 .. order]) of a Unigram, Bigram or NGram
+    if isinstance(model, NGram):
+        return(model.words, [model.ngrams(n) for n in range(1, model.order + 1)])
+    unigrams = np.flatnonzero(model._unigram_counts)
+    orders = [(unigrams.reshape(-1, 1).astype(np.int32), model._unigram_counts[unigrams])]
+    if isinstance(model, Bigram):
+        V = len(model._words)
+        orders.append((np.stack([model._bigram_keys // V, model._bigram_keys % V], axis=1).astype(np.int32),
+            model._bigram_counts))
+    return(model._words, orders)
+
+
+def discount(counts:np.ndarray)->float:
+    # absolute discount D = n1 / (n1 + 2 n2) from the number of n-grams seen once & twice
+    n1, n2 = int((counts == 1).sum()), int((counts == 2).sum())
+    return(n1 / (n1 + 2 * n2) if n1 and n2 else 0.5)
+
+
+class CompiledLM(object):
+    # backoff n-gram LM in arrays: per order n, sorted keys context_row * V + w where context_row is the row of
+    # the n-1 first words in order n-1 (w for unigrams), log10 probabilities & log10 backoff weights of the
+    # n-grams as contexts. successors of a context are contiguous, ptr-n arrays give their CSR ranges.
+    # probabilities are interpolated absolute discounting, stored like ARPA: unseen events back off
+    def __init__(self, words:List[str], keys:List[np.ndarray], logprobs:List[np.ndarray], backoffs:List[np.ndarray],
+            ptrs:List[np.ndarray], discounts:List[float]=None):
+        self._words = words
+        self._index = {w: i for i, w in enumerate(words)}
+        self._unk = self._index[UNK]
+        self._keys = keys
+        self._logprobs = logprobs
+        self._backoffs = backoffs
+        self._ptrs = ptrs
+        self._discounts = discounts
+
+    @classmethod
+    def build(cls, counts, discounts:List[float]=None)->'CompiledLM':
+        # counts: NGram, Bigram or Unigram. discounts per order, estimated from counts of counts by default
+        words, orders = _counts_by_order(counts)
+        words = list(words) + ([UNK] if UNK not in words else [])
+        V = len(words)
+        if discounts is None:
+            discounts = [discount(c) for _, c in orders]
+        # unigrams over the whole vocabulary, interpolated with the uniform distribution
+        c = np.zeros(V)
+        c[orders[0][0][:, 0]] = orders[0][1]
+        D = discounts[0]
+        probs = [np.maximum(c - D, 0) / c.sum() + D * (c > 0).sum() / c.sum() / V]
+        keys = [np.arange(V, dtype=np.int64)]
+        backoffs, ptrs = [], [np.zeros(0, dtype=np.int64)]
+        for n in range(2, len(orders) + 1):
+            ids, counts_n = orders[n - 1]
+            counts_n = np.asarray(counts_n, dtype=np.float64)
+            prefix = cls._rows(keys, ids[:, :-1], V)
+            suffix = cls._rows(keys, ids[:, 1:], V)
+            keys.append(prefix * V + ids[:, -1])
+            contexts, first, successors = np.unique(prefix, return_index=True, return_counts=True)
+            totals = np.add.reduceat(counts_n, first)
+            context = np.repeat(np.arange(len(contexts)), successors)
+            D = discounts[n - 1]
+            gamma = D * successors / totals
+            probs.append((counts_n - D) / totals[context] + gamma[context] * probs[n - 2][suffix])
+            backoff = np.ones(len(keys[n - 2]))
+            backoff[contexts] = gamma
+            backoffs.append(np.log10(backoff).astype(np.float32))
+            ptrs.append(np.searchsorted(keys[n - 1], np.arange(len(keys[n - 2]) + 1, dtype=np.int64) * V))
+        backoffs.append(np.zeros(len(keys[-1]), dtype=np.float32))
+        logprobs = [np.log10(p).astype(np.float32) for p in probs]
+        return(cls(words, keys, logprobs, backoffs, ptrs, discounts))
+
+    @staticmethod
+    def _rows(keys:List[np.ndarray], ids:np.ndarray, V:int)->np.ndarray:
+        # rows of the (k, m) n-grams ids in order m, -1 when missing
+        rows = ids[:, 0].astype(np.int64)
+        for j in range(1, ids.shape[1]):
+            rows = np.where(rows >= 0, lookup(keys[j], rows * V + ids[:, j]), -1)
+        return(rows)
+
+    def encode(self, sentences:Iterable[List[str]], bos:bool=True, eos:bool=True)->tuple:
+        # (tokens, offsets) of sentences, unknown words mapped to <unk>. <s> & </s> are added when missing
+        index, unk = self._index, self._unk
+        tokens, offsets = array('i'), array('q', [0])
+        for sentence in sentences:
+            if isinstance(sentence, str):
+                sentence = sentence.split()
+            if bos and (not sentence or sentence[0] != BOS):
+                tokens.append(index[BOS])
+            tokens.extend([index.get(w, unk) for w in sentence])
+            if eos and (not sentence or sentence[-1] != EOS):
+                tokens.append(index[EOS])
+            offsets.append(len(tokens))
+        return(np.frombuffer(tokens, dtype=np.int32), np.frombuffer(offsets, dtype=np.int64))
+
+    def token_logprobs(self, tokens:np.ndarray, offsets:np.ndarray)->np.ndarray:
+        # log10 p(token | history) of every token, nan for <s> starting a sentence. other first tokens get their unigram
+        V = len(self._words)
+        N = self.order
+        position = np.arange(len(tokens)) - np.repeat(offsets[:-1], np.diff(offsets))
+        # rows[m][t]: row in order m of the m-gram ending at t, -1 if missing or crossing the sentence start
+        rows = [None, tokens.astype(np.int64)]
+        for m in range(2, N + 1):
+            previous = np.concatenate([[-1], rows[m - 1][:-1]])
+            valid = (position >= m - 1) & (previous >= 0)
+            rows.append(np.where(valid, lookup(self._keys[m - 1], np.where(valid, previous, 0) * V + tokens), -1))
+        # longest n-gram found, plus the backoff weights of the longer contexts
+        logprobs = np.zeros(len(tokens))
+        found = np.zeros(len(tokens), dtype=bool)
+        for n in range(N, 0, -1):
+            hit = ~found & (rows[n] >= 0)
+            logprobs[hit] += self._logprobs[n - 1][rows[n][hit]]
+            found |= hit
+            if n > 1:
+                context = np.concatenate([[-1], rows[n - 1][:-1]])
+                backoff = ~found & (position >= n - 1) & (context >= 0)
+                logprobs[backoff] += self._backoffs[n - 2][context[backoff]]
+        logprobs[(position == 0) & (tokens == self._index.get(BOS, -1))] = np.nan
+        return(logprobs)
+
+    def score(self, sentences:Iterable[List[str]], bos:bool=True, eos:bool=True)->np.ndarray:
+        # log10 probability of each sentence
+        tokens, offsets = self.encode(sentences, bos, eos)
+        logprobs = np.nan_to_num(self.token_logprobs(tokens, offsets))
+        totals = np.concatenate([[0], np.cumsum(logprobs)])
+        return(totals[offsets[1:]] - totals[offsets[:-1]])
+
+    def perplexity(self, corpus, bos:bool=True, eos:bool=True, block_size:int=BLOCK_SIZE)->float:
+        # corpus: Corpus, CorpusStream or sentences, scored by blocks. <s> is not predicted, </s> is
+        total, count = 0.0, 0
+        sentences = iter(corpus.corpus if isinstance(corpus, Corpus) else corpus)
+        while True:
+            block = list(itertools.islice(sentences, block_size))
+            if not block:
+                break
+            logprobs = self.token_logprobs(*self.encode(block, bos, eos))
+            predicted = ~np.isnan(logprobs)
+            total += logprobs[predicted].sum()
+            count += int(predicted.sum())
+        return(10 ** (-total / count))
+
+    def successors(self, context:List[str])->tuple:
+        # (words, log10 probs) of the n-grams extending context, from the CSR successor range of the context
+        n = len(context) + 1
+        if n > self.order:
+            raise ValueError("context longer than order {}".format(self.order - 1))
+        row = self._rows(self._keys, np.array([[self._index.get(w, self._unk) for w in context]]), len(self._words))[0]
+        if row < 0:
+            return([], np.zeros(0, dtype=np.float32))
+        start, end = self._ptrs[n - 1][row], self._ptrs[n - 1][row + 1]
+        ids = self._keys[n - 1][start:end] % len(self._words)
+        return([self._words[i] for i in ids.tolist()], np.asarray(self._logprobs[n - 1][start:end]))
+
+    @classmethod
+    def _add_contexts(cls, keys:List[np.ndarray], logprobs:List[np.ndarray], backoffs:List[np.ndarray],
+            ids:np.ndarray, V:int):
+        # inserts the missing (k, m) n-grams ids in order m as blank entries like KenLM, after their own missing
+        # prefixes: backoff 0 and the backed-off logprob, so scores are unchanged. the keys of order m + 1 are
+        # renumbered to the new rows
+        m = ids.shape[1]
+        prefix = cls._rows(keys, ids[:, :-1], V)
+        if (prefix < 0).any():
+            cls._add_contexts(keys, logprobs, backoffs, np.unique(ids[prefix < 0, :-1], axis=0), V)
+            prefix = cls._rows(keys, ids[:, :-1], V)
+        # bo(w1..wm-1) + log10 p(wm | w2..wm-1), down to the longest suffix found
+        logprob = np.zeros(len(ids), dtype=np.float32)
+        found = np.zeros(len(ids), dtype=bool)
+        for j in range(m - 1):
+            context = cls._rows(keys, ids[:, j:m - 1], V)
+            hit = ~found & (context >= 0)
+            logprob[hit] += backoffs[m - j - 2][context[hit]]
+            suffix = cls._rows(keys, ids[:, j + 1:], V)
+            hit = ~found & (suffix >= 0)
+            logprob[hit] += logprobs[m - j - 2][suffix[hit]]
+            found |= hit
+        merged = np.concatenate([keys[m - 1], prefix * V + ids[:, -1]])
+        sort = np.argsort(merged, kind='stable')
+        logprobs[m - 1] = np.concatenate([logprobs[m - 1], logprob])[sort]
+        backoffs[m - 1] = np.concatenate([backoffs[m - 1], np.zeros(len(ids), dtype=np.float32)])[sort]
+        if m < len(keys):
+            rows = np.empty(len(merged), dtype=np.int64)
+            rows[sort] = np.arange(len(merged))
+            keys[m] = rows[keys[m] // V] * V + keys[m] % V
+        keys[m - 1] = merged[sort]
+
+    def ngram_ids(self, n:int)->np.ndarray:
+        # (k, n) word ids of the n-grams of order n, in key order
+        ids = self._keys[0].reshape(-1, 1)
+        for m in range(2, n + 1):
+            keys = np.asarray(self._keys[m - 1])
+            ids = np.concatenate([ids[keys // len(self._words)], (keys % len(self._words)).reshape(-1, 1)], axis=1)
+        return(ids.astype(np.int32))
+
+    def to_arpa(self, path:str, block_size:int=BLOCK_SIZE):
+        # ARPA backoff LM, gzipped if path ends with .gz
+        with _open_text(path, 'w') as f:
+            f.write('\\data\\\n')
+            for n in range(1, self.order + 1):
+                f.write('ngram {}={}\n'.format(n, len(self._keys[n - 1])))
+            for n in range(1, self.order + 1):
+                f.write('\n\\{}-grams:\n'.format(n))
+                ids = self.ngram_ids(n)
+                for start in range(0, len(ids), block_size):
+                    logprobs = self._logprobs[n - 1][start:start + block_size].tolist()
+                    backoffs = self._backoffs[n - 1][start:start + block_size].tolist()
+                    for ngram, logprob, backoff in zip(ids[start:start + block_size].tolist(), logprobs, backoffs):
+                        line = '{:.7g}\t{}'.format(logprob, ' '.join(self._words[i] for i in ngram))
+                        f.write(line + ('\t{:.7g}\n'.format(backoff) if n < self.order else '\n'))
+            f.write('\n\\end\\\n')
+
+    @classmethod
+    def from_arpa(cls, path:str, block_bytes:int=ARPA_BLOCK_BYTES)->'CompiledLM':
+        # streams an ARPA file (or .gz) section by section into arrays, n-grams are never held in dicts
+        sizes, sections = {}, {}
+        opener = gzip.open if str(path).endswith('.gz') else open
+        with opener(path, 'rb') as f:
+            for header, data in _arpa_blocks(f, block_bytes):
+                if header == b'\\data\\':
+                    for line in data.decode('utf-8').split('\n'):
+                        if line.startswith('ngram '):
+                            n, size = line[len('ngram '):].split('=')
+                            sizes[int(n)] = int(size)
+                elif header.endswith(b'-grams:'):
+                    n = int(header[1:-len(b'-grams:')])
+                    if n not in sections:
+                        if n != len(sections) + 1:
+                            raise ValueError("unexpected section {} in {}".format(header.decode('utf-8'), path))
+                        sections[n] = ([], [], [])
+                        # words of higher orders are mapped to ids with the vocab of the 1-grams
+                        vocab = _vocab_index(sections[1][0]) if n > 1 else None
+                    ids, logprob, backoff = _parse_arpa_block(data, n, vocab)
+                    if n == 1:
+                        sections[1][0].extend(ids)
+                    else:
+                        sections[n][0].append(ids)
+                    sections[n][1].append(logprob)
+                    sections[n][2].append(backoff)
+        order = max(sizes)
+        for n in range(1, order + 1):
+            read = sum(len(logprob) for logprob in sections.get(n, ([], [], []))[1])
+            if read != sizes[n]:
+                raise ValueError("expected {} {}-grams in {}, read {}".format(sizes[n], n, path, read))
+
+        words, keys, logprobs, backoffs, ptrs = sections[1][0], [], [], [], []
+        for n in range(1, order + 1):
+            logprob, backoff = np.concatenate(sections[n][1]), np.concatenate(sections[n][2])
+            if n == 1:
+                if UNK not in words:
+                    words.append(UNK)
+                    logprob = np.append(logprob, np.float32(UNK_LOGPROB))
+                    backoff = np.append(backoff, np.float32(0))
+                V = len(words)
+                keys.append(np.arange(V, dtype=np.int64))
+                ptrs.append(np.zeros(0, dtype=np.int64))
+            else:
+                ids = np.concatenate(sections[n][0])
+                sections[n] = None
+                prefix = cls._rows(keys, ids[:, :-1], V)
+                if (prefix < 0).any():
+                    # pruned ARPA files (SRILM) keep n-grams whose context was pruned
+                    missing = np.unique(ids[prefix < 0, :-1], axis=0)
+                    logger.warning("{} {}-grams missing from {} added as blank contexts".format(len(missing), n - 1, path))
+                    cls._add_contexts(keys, logprobs, backoffs, missing, V)
+                    prefix = cls._rows(keys, ids[:, :-1], V)
+                key = prefix * V + ids[:, -1]
+                del ids, prefix
+                sort = np.argsort(key, kind='stable')
+                keys.append(key[sort])
+                logprob, backoff = logprob[sort], backoff[sort]
+            logprobs.append(logprob)
+            backoffs.append(backoff if n < order else np.zeros(len(backoff), dtype=np.float32))
+        for n in range(2, order + 1):
+            ptrs.append(np.searchsorted(keys[n - 1], np.arange(len(keys[n - 2]) + 1, dtype=np.int64) * V))
+        logger.info("read {}-gram ARPA LM {} with {} words".format(order, path, len(words)))
+        return(cls(words, keys, logprobs, backoffs, ptrs))
+
+    def save(self, path:str):
+        out = Path(path)
+        out.mkdir(parents=True, exist_ok=True)
+        with open(str(out / 'meta.json'), 'w') as f:
+            json.dump({'order': self.order, 'vocab_size': len(self._words), 'discounts': self._discounts}, f)
+        with open(str(out / 'vocab.txt'), 'w', encoding='utf-8') as f:
+            f.write('\n'.join(self._words) + '\n')
+        for n in range(1, self.order + 1):
+            np.save(str(out / 'keys-{}.npy'.format(n)), self._keys[n - 1])
+            np.save(str(out / 'logprobs-{}.npy'.format(n)), self._logprobs[n - 1])
+            np.save(str(out / 'backoffs-{}.npy'.format(n)), self._backoffs[n - 1])
+            np.save(str(out / 'ptrs-{}.npy'.format(n)), self._ptrs[n - 1])
+
+    @classmethod
+    def load(cls, path:str)->'CompiledLM':
+        # arrays are memory-mapped read only: processes loading the same LM share its pages
+        src = Path(path)
+        with open(str(src / 'meta.json')) as f:
+            meta = json.load(f)
+        with open(str(src / 'vocab.txt'), encoding='utf-8') as f:
+            words = f.read().split('\n')[:meta['vocab_size']]
+        arrays = {name: [np.load(str(src / '{}-{}.npy'.format(name, n)), mmap_mode='r')
+            for n in range(1, meta['order'] + 1)] for name in ['keys', 'logprobs', 'backoffs', 'ptrs']}
+        return(cls(words, arrays['keys'], arrays['logprobs'], arrays['backoffs'], arrays['ptrs'], meta['discounts']))
+
+    @property
+    def order(self)->int:
+        return(len(self._keys))
+
+    @property
+    def words(self)->List[str]:
+        return(self._words)
+
+
+def _open_text(path:str, mode:str='r'):
+    if str(path).endswith('.gz'):
+        return(gzip.open(path, mode + 't', encoding='utf-8'))
+    return(open(path, mode, encoding='utf-8'))
+
+
+def _arpa_blocks(f, block_bytes:int=ARPA_BLOCK_BYTES)->Iterator[tuple]:
+    # (section header, bytes of complete lines) of a binary ARPA file, read block_bytes at a time.
+    # headers (\\data\\, \\n-grams:, \\end\\) are the only lines starting with a backslash
+    header, buffer = None, b''
+    while True:
+        chunk = f.read(block_bytes)
+        buffer += chunk
+        while True:
+            start = 0 if buffer.startswith(b'\\') else buffer.find(b'\n\\') + 1
+            if not start and not buffer.startswith(b'\\'):
+                break
+            end = buffer.find(b'\n', start)
+            if end < 0 and chunk:
+                break
+            if header is not None and buffer[:start].strip():
+                yield(header, buffer[:start])
+            end = len(buffer) if end < 0 else end
+            header, buffer = buffer[start:end].strip(), buffer[end + 1:]
+        if not chunk:
+            if header is not None and buffer.strip():
+                yield(header, buffer)
+            return
+        # complete lines of the current section, the last partial line stays in the buffer
+        last = buffer.rfind(b'\n') + 1
+        if header is not None and buffer[:last].strip():
+            yield(header, buffer[:last])
+        buffer = buffer[last:]
+
+
+def _vocab_index(words:List[str]):
+    import pandas as pd
+    return(pd.Index(words))
+
+
+def _parse_arpa_block(data:bytes, n:int, vocab=None)->tuple:
+    # (word ids (k, n) or the words of 1-grams, log10 probs, log10 backoffs) of the n-gram lines in data,
+    # tokenized by the C parser of pandas. words are read as categoricals, whose categories are mapped to ids
+    # with the hashed vocab index of the 1-grams
+    import pandas as pd
+    # a first dummy line with a backoff fixes the number of columns when no line of the block has one
+    data = b'0' + b' -' * n + b' 0\n' + data
+    dtype = {j: 'category' if n > 1 else object for j in range(1, n + 1)}
+    dtype.update({0: np.float32, n + 1: np.float32})
+    df = pd.read_csv(io.BytesIO(data), sep=r'\s+', header=None, names=list(range(n + 2)), dtype=dtype,
+        keep_default_na=False, na_values={n + 1: ['']}, quoting=csv.QUOTE_NONE, encoding='utf-8', engine='c').iloc[1:]
+    logprobs = df[0].to_numpy()
+    backoffs = np.nan_to_num(df[n + 1].to_numpy())
+    if n == 1:
+        return(df[1].tolist(), logprobs, backoffs)
+    ids = np.empty((len(df), n), dtype=np.int32)
+    for j in range(1, n + 1):
+        ids[:, j - 1] = vocab.get_indexer(df[j].cat.categories)[df[j].cat.codes.to_numpy()]
+    if (ids < 0).any():
+        raise ValueError("{}-grams with words missing from the 1-grams".format(n))
+    return(ids, logprobs, backoffs)
@@ -0,0 +1,246 @@
+# (c) 2020 Sylvain Le Groux <slegroux@ccrma.stanford.edu>
+
+# header-only metadata of audio files: sample rate, channels, frames, duration & codec
+# are read from RIFF/WAVE chunks, FLAC STREAMINFO and MP3 frame headers without decoding.
+# anything else falls back to torchaudio.
+
+import logging
+import os
+import struct
+
+logger = logging.getLogger(__name__)
+
+EMPTY_INFO = {'sr': None, 'channels': None, 'frames': None, 'duration': None, 'codec': None}
+
+# wav format tags (mmreg.h) named like torchaudio encodings
+WAV_CODECS = {1: 'PCM_S', 3: 'PCM_F', 6: 'ALAW', 7: 'ULAW'}
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+# mp3 header tables indexed by [version][layer] / [version]
+# version: 0 MPEG 2.5, 2 MPEG 2, 3 MPEG 1 ; layer: 1 layer III, 2 layer II, 3 layer I
+MP3_BITRATES = {
+    (3, 3): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (3, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (3, 1): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (2, 3): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (2, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (2, 1): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+MP3_SAMPLE_RATES = {3: [44100, 48000, 32000], 2: [22050, 24000, 16000], 0: [11025, 12000, 8000]}
+
+
+def probe(path:str)->dict:
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(12)
+            f.seek(0)
+            if head[:4] == b'RIFF' and head[8:12] == b'WAVE':
+                info = probe_wav(f)
+            elif head[:4] == b'fLaC' or (head[:3] == b'ID3' and _skip_id3(f) and f.read(4) == b'fLaC'):
+                f.seek(0)
+                info = probe_flac(f)
+            elif path.lower().endswith('.mp3'):
+                info = probe_mp3(f)
+            else:
+                info = None
+    except IOError as e:
+        logger.exception(str(e))
+        return(dict(EMPTY_INFO))
+    except (ValueError, struct.error) as e:
+        logger.debug("header probe of {} failed: {}".format(path, e))
+        info = None
+    if info is None:
+        return(torchaudio_info(path))
+    return(info)
+
+
+def torchaudio_info(path:str)->dict:
+    import torchaudio
+    try:
+        info = torchaudio.info(path)
+    except IOError as e:
+        logger.exception(str(e))
+        return(dict(EMPTY_INFO))
+    if isinstance(info, tuple):
+        # legacy sox backend: (signal info, encoding info) with length counted over all channels
+        sr, channels = info[0].rate, info[0].channels
+        frames = info[0].length // max(channels, 1)
+        codec = os.path.splitext(path)[1].lstrip('.').upper()
+    else:
+        sr, channels, frames = info.sample_rate, info.num_channels, info.num_frames
+        codec = info.encoding
+    return(_info(sr, channels, frames, codec))
+
+
+def _info(sr:int, channels:int, frames:int, codec:str)->dict:
+    return({'sr': sr, 'channels': channels, 'frames': frames, 'duration': frames / sr, 'codec': codec})
+
+
+def wav_layout(f)->dict:
+    # fmt fields & position of the data chunk of a RIFF/WAVE file object, None if not a wav file
+    f.seek(0, os.SEEK_END)
+    file_size = f.tell()
+    f.seek(0)
+    header = f.read(12)
+    if len(header) < 12 or header[:4] != b'RIFF' or header[8:12] != b'WAVE':
+        return(None)
+    fmt = None
+    while True:
+        chunk = f.read(8)
+        if len(chunk) < 8:
+            raise ValueError("no data chunk")
+        chunk_id, size = chunk[:4], struct.unpack('<I', chunk[4:])[0]
+        if chunk_id == b'fmt ':
+            body = f.read(size)
+            tag, channels, sr, byte_rate, block_align, bits = struct.unpack('<HHIIHH', body[:16])
+            if tag == WAVE_FORMAT_EXTENSIBLE and len(body) >= 26:
+                # sub format guid starts with the actual format tag
+                tag = struct.unpack('<H', body[24:26])[0]
+            fmt = {'tag': tag, 'channels': channels, 'sr': sr, 'block_align': block_align, 'bits': bits}
+            if size & 1:
+                f.seek(1, os.SEEK_CUR)
+        elif chunk_id == b'data':
+            if fmt is None:
+                raise ValueError("data chunk before fmt chunk")
+            offset = f.tell()
+            # streamed files may leave the size unset
+            size = min(size, file_size - offset)
+            layout = dict(fmt)
+            layout.update({'offset': offset, 'size': size, 'frames': size // fmt['block_align']})
+            return(layout)
+        else:
+            # chunks are word aligned
+            f.seek(size + (size & 1), os.SEEK_CUR)
+
+
+def probe_wav(f)->dict:
+    layout = wav_layout(f)
+    if layout is None or layout['tag'] not in WAV_CODECS:
+        return(None)
+    codec = WAV_CODECS[layout['tag']]
+    if codec == 'PCM_S' and layout['bits'] == 8:
+        codec = 'PCM_U'
+    return(_info(layout['sr'], layout['channels'], layout['frames'], codec))
+
+
+def pcm_layout(path:str)->dict:
+    # layout of 16 bit PCM wav files that can be memory-mapped, None otherwise
+    with open(path, 'rb') as f:
+        try:
+            layout = wav_layout(f)
+        except (ValueError, struct.error):
+            return(None)
+    if layout is None or layout['tag'] != 1 or layout['bits'] != 16:
+        return(None)
+    return(layout)
+
+
+def _skip_id3(f)->bool:
+    # position f after an ID3v2 tag, if any
+    header = f.read(10)
+    if len(header) < 10 or header[:3] != b'ID3':
+        f.seek(-len(header), os.SEEK_CUR)
+        return(True)
+    # sync safe integer: 7 bits per byte
+    size = (header[6] << 21) | (header[7] << 14) | (header[8] << 7) | header[9]
+    if header[5] & 0x10:
+        # footer present
+        size += 10
+    f.seek(size, os.SEEK_CUR)
+    return(True)
+
+
+def probe_flac(f)->dict:
+    _skip_id3(f)
+    if f.read(4) != b'fLaC':
+        raise ValueError("missing flac marker")
+    while True:
+        header = f.read(4)
+        if len(header) < 4:
+            raise ValueError("missing STREAMINFO block")
+        last, kind = header[0] & 0x80, header[0] & 0x7F
+        size = int.from_bytes(header[1:], 'big')
+        if kind == 0:
+            block = f.read(size)
+            # 20 bits sample rate | 3 bits channels-1 | 5 bits bps-1 | 36 bits total samples
+            bits = int.from_bytes(block[10:18], 'big')
+            sr = bits >> 44
+            channels = ((bits >> 41) & 0x7) + 1
+            frames = bits & 0xFFFFFFFFF
+            if sr == 0 or frames == 0:
+                # unknown length, needs decoding
+                return(None)
+            return(_info(sr, channels, frames, 'FLAC'))
+        if last:
+            raise ValueError("missing STREAMINFO block")
+        f.seek(size, os.SEEK_CUR)
+
+
+def _mp3_frame(header:bytes):
+    # (frame length in bytes, samples per frame, sample rate, channels, version, layer) or None
+    if len(header) < 4 or header[0] != 0xFF or (header[1] & 0xE0) != 0xE0:
+        return(None)
+    version = (header[1] >> 3) & 0x3
+    layer = (header[1] >> 1) & 0x3
+    bitrate_index = header[2] >> 4
+    sr_index = (header[2] >> 2) & 0x3
+    if version == 1 or layer == 0 or bitrate_index in (0, 15) or sr_index == 3:
+        return(None)
+    padding = (header[2] >> 1) & 0x1
+    channels = 1 if (header[3] >> 6) == 3 else 2
+    bitrate = MP3_BITRATES[(3 if version == 3 else 2, layer)][bitrate_index] * 1000
+    sr = MP3_SAMPLE_RATES[version][sr_index]
+    if layer == 3:
+        samples = 384
+        length = (12 * bitrate // sr + padding) * 4
+    elif layer == 2 or version == 3:
+        samples = 1152
+        length = 144 * bitrate // sr + padding
+    else:
+        # layer III of MPEG 2 & 2.5
+        samples = 576
+        length = 72 * bitrate // sr + padding
+    return(length, samples, sr, channels, version, layer)
+
+
+def probe_mp3(f)->dict:
+    _skip_id3(f)
+    # look for the first frame sync in case of junk before the audio
+    start = f.tell()
+    data = f.read(64 * 1024)
+    first = None
+    for i in range(len(data) - 4):
+        frame = _mp3_frame(data[i:i+4])
+        if frame is not None:
+            first = (start + i, frame)
+            break
+    if first is None:
+        raise ValueError("no mp3 frame found")
+    position, (length, samples, sr, channels, version, layer) = first
+    f.seek(position)
+    frame_data = f.read(length)
+
+    # Xing/Info (lame) or VBRI headers hold the number of frames
+    if layer == 1:
+        if version == 3:
+            side = 17 if channels == 1 else 32
+        else:
+            side = 9 if channels == 1 else 17
+        tag = frame_data[4 + side:4 + side + 12]
+        if tag[:4] in (b'Xing', b'Info') and struct.unpack('>I', tag[4:8])[0] & 0x1:
+            n_frames = struct.unpack('>I', tag[8:12])[0]
+            return(_info(sr, channels, n_frames * samples, 'MP3'))
+    if frame_data[36:40] == b'VBRI':
+        n_frames = struct.unpack('>I', frame_data[50:54])[0]
+        return(_info(sr, channels, n_frames * samples, 'MP3'))
+
+    # otherwise walk the frame headers
+    n_frames = 0
+    while True:
+        f.seek(position)
+        frame = _mp3_frame(f.read(4))
+        if frame is None:
+            break
+        n_frames += 1
+        position += frame[0]
+    return(_info(sr, channels, n_frames * samples, 'MP3'))
@@ -0,0 +1,104 @@
+# (c) 2020 Sylvain Le Groux <slegroux@ccrma.stanford.edu>
+
+# packed waveform store: 16 bit mono samples of every utterance concatenated in memory-mapped
+# shards, with an index of (shard, offset, length) per dataset uuid. reads are zero-copy views.
+
+import json
+import logging
+from pathlib import Path
+from typing import List
+from slgasr.fileio import MemmapCache, bounded_map, load_pcm16
+
+logger = logging.getLogger(__name__)
+
+# samples per shard file (512MB of int16)
+SHARD_SIZE = 1 << 28
+
+
+def _load(args):
+    path, sr = args
+    return(load_pcm16(path, sr))
+
+
+class WaveformStore(object):
+    def __init__(self, path:str):
+        import numpy as np
+        self._path = Path(path)
+        with open(str(self._path / 'meta.json')) as f:
+            meta = json.load(f)
+        self._sr = meta['sr']
+        self._shard_names = meta['shards']
+        index = np.load(str(self._path / 'index.npz'))
+        self._uuids = index['uuids']
+        self._shard = index['shard']
+        self._offset = index['offset']
+        self._length = index['length']
+        self._rows = {uuid: i for i, uuid in enumerate(self._uuids.tolist())}
+        self._memmaps = MemmapCache('<i2')
+
+    @classmethod
+    def build(cls, dataset, path:str, sr:int=16000, shard_size:int=SHARD_SIZE, n_jobs:int=1)->'WaveformStore':
+        # dataset: ASRDataset or its dataframe with uuid & audio_path columns
+        import numpy as np
+        df = dataset.dataset if hasattr(dataset, 'dataset') else dataset
+        uuids = df['uuid'].tolist()
+        jobs = [(audio_path, sr) for audio_path in df['audio_path'].tolist()]
+        out = Path(path)
+        out.mkdir(parents=True, exist_ok=True)
+
+        shard_names = []
+        shard = np.zeros(len(uuids), dtype=np.int32)
+        offset = np.zeros(len(uuids), dtype=np.int64)
+        length = np.zeros(len(uuids), dtype=np.int64)
+        results = bounded_map(_load, jobs, n_jobs)
+        f = None
+        position = 0
+        try:
+            for i, samples in enumerate(results):
+                if f is None or (position > 0 and position + len(samples) > shard_size):
+                    if f is not None:
+                        f.close()
+                    shard_names.append('shard-{:05d}.pcm'.format(len(shard_names)))
+                    f = open(str(out / shard_names[-1]), 'wb')
+                    position = 0
+                f.write(samples.astype('<i2').tobytes())
+                shard[i], offset[i], length[i] = len(shard_names) - 1, position, len(samples)
+                position += len(samples)
+        finally:
+            if f is not None:
+                f.close()
+            results.close()
+        np.savez(str(out / 'index.npz'), uuids=np.array(uuids, dtype=str), shard=shard, offset=offset, length=length)
+        with open(str(out / 'meta.json'), 'w') as f:
+            json.dump({'sr': sr, 'dtype': 'int16', 'shards': shard_names}, f)
+        logger.info("stored {} waveforms in {} shards".format(len(uuids), len(shard_names)))
+        return(cls(path))
+
+    def _memmap(self, shard:int)->'np.memmap':
+        return(self._memmaps.get(str(self._path / self._shard_names[shard])))
+
+    def get_array(self, uuid:str)->'np.ndarray':
+        i = self._rows[uuid]
+        start = self._offset[i]
+        return(self._memmap(self._shard[i])[start:start + self._length[i]])
+
+    def __getitem__(self, uuid:str)->'torch.Tensor':
+        import torch
+        return(torch.from_numpy(self.get_array(uuid)))
+
+    def __contains__(self, uuid:str)->bool:
+        return(uuid in self._rows)
+
+    def __len__(self)->int:
+        return(len(self._uuids))
+
+    def length(self, uuid:str)->int:
+        return(int(self._length[self._rows[uuid]]))
+
+    @property
+    def uuids(self)->List[str]:
+        return(self._uuids.tolist())
+
+    @property
+    def sr(self)->int:
+        return(self._sr)
@@ -8,12 +8,28 @@ import pytest
 # from data_heroico import HeroicoTranscripts, HeroicoWavFile
 # from data_common_voice import CommonVoiceDF
 from slgasr.data import TextNormalizer, Audio, Transcript, Audios, Transcripts, TranscriptsCSV
+from slgasr.data import get_normalizer, normalizer_stats, normalize_texts, probe_audio_files, AudioInfoCache
 from slgasr.data import ASRDataset, ASRDatasetCSV
 import numpy as np
-from IPython import embed
 from pathlib import Path
+import subprocess
+import sys
 
 DATA_FOLDER= str(Path(__file__).parent.parent / "data/tests")
+# cumulative time budget for `import slgasr.data` in microseconds
+IMPORT_BUDGET = 150000
+
+def test_import_time():
+    res = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import slgasr.data'],
+        stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    # import time: self [us] | cumulative | imported package
+    times = {}
+    for line in res.stderr.splitlines()[1:]:
+        _, cumulative, name = line.split('|')
+        times[name.strip()] = int(cumulative)
+    assert times['slgasr.data'] < IMPORT_BUDGET
+    for module in ['pandas', 'torch', 'torchaudio', 'spacy', 'enchant', 'swifter', 'IPython']:
+        assert module not in times
 
 def test_text_normalizer():
     normalizer = TextNormalizer()
@@ -26,8 +42,37 @@ def test_text_normalizer():
     assert normalizer.normalize('Scusi, che cosa ha detto?') == 'scusi che cosa ha detto'
     normalizer = TextNormalizer(lang='fr')
     assert normalizer.normalize('Ca roule ma poule?') == 'ca roule ma poule'
+    texts = ['Scusi, che cosa ha detto?', '[Speaker 1] Ciao!\\n', 'que saudade!']
+    normalizer = TextNormalizer(lang='it')
+    assert list(normalizer.normalize_batch(texts, batch_size=2)) == [normalizer.normalize(t) for t in texts]
     # "[Silence] \n[Speaker 1] Que pena Jaime, es que tuve [partial sentence] eh, perdón, que pena Javier, es que estoy aquí con Jaime, con un compañero.\n[Speaker 2] Ah, todo bien.\n[Sepaker 1] ¿[Crosstalk] un minuto?"
 
+def test_normalizer_registry():
+    normalizer = get_normalizer('es', 'MX')
+    assert get_normalizer('es', 'MX') is normalizer
+    # Transcripts default to country None, Transcript to US: still one model per language
+    assert get_normalizer('es', None) is normalizer and get_normalizer('es', 'US') is normalizer
+    assert normalizer.normalize('¿Hola!') == 'hola'
+    assert normalizer_stats()['es'] > 0
+
+def test_normalizer_registry_cache_size():
+    assert get_normalizer('pt', cache_size=0).cache_info() is None
+    assert get_normalizer('fr', cache_size=10).cache_info()['max_size'] == 10
+
+def test_normalizer_cache(tmp_path):
+    cache = str(tmp_path / 'normalized.sqlite')
+    normalizer = TextNormalizer(lang='es', cache_size=10, cache_path=cache)
+    assert list(normalizer.normalize_batch(['¿Hola!', '¿Hola!', 'Adiós.'])) == ['hola', 'hola', 'adiós']
+    assert normalizer.normalize('¿Hola!') == 'hola'
+    assert normalizer.cache_info()['hits'] == 1
+    normalizer = TextNormalizer(lang='es', cache_path=cache)
+    assert normalizer.normalize('Adiós.') == 'adiós'
+    assert (normalizer.cache_info()['disk_hits'], normalizer.cache_info()['misses']) == (1, 0)
+
+def test_normalize_texts():
+    texts = ['¿Hola!', 'Adiós.', '[Speaker 1] Hola amigos', '¿Hola!'] * 10
+    assert normalize_texts(texts, lang='es', n_jobs=2, chunk_size=3) == normalize_texts(texts, lang='es', n_jobs=1)
+
 # fixture to init global variables
 @pytest.fixture(scope="module")
 def data_():
@@ -55,6 +100,18 @@ def test_mp3(data_):
     assert (w.path, w.sr, w.duration, w.lang, w.country) == \
         (str(Path(data_['mp3file']).absolute()), 16000, 3.636, 'fr', 'CA')
 
+def test_lazy_audio(data_):
+    a = Audios(data_['audios'], lang='es', country='MX')
+    aa = a.audios
+    assert 'data' not in aa.columns
+    w = aa.audio[0]
+    assert (w.frames, w.channels) == (56645, 1)
+    assert w.memmap().shape == (56645, 1)
+    assert w.data.shape == (1, 56645)
+    assert Audio(data_['mp3file']).memmap() is None
+    a = Audios(data_['audios'], lang='es', country='MX', load_data=True)
+    assert a.audios.data[0].shape == (1, 56645)
+
 def test_transcript(data_):
     t = Transcript(data_['transcript'], lang='es', normalize=True, encoding='utf-8')
     t.lang = 'es'
@@ -83,6 +140,23 @@ def test_audios(data_):
     assert aa.lang[0] == 'es'
     assert aa.country[0] == 'MX'
 
+def test_audios_cache(data_, tmp_path):
+    cache = str(tmp_path / 'audio_info.sqlite')
+    a = Audios(data_['audios'], lang='es', country='MX', n_jobs=2, cache_path=cache)
+    path = a.audios.path[0]
+    st = Path(path).stat()
+    cached = AudioInfoCache(cache).get_many({path: (st.st_size, st.st_mtime_ns)})
+    assert cached[path]['frames'] == a.audios.frames[0]
+    b = Audios(data_['audios'], lang='es', country='MX', n_jobs=2, cache_path=cache)
+    assert b.audios.duration.tolist() == a.audios.duration.tolist()
+    # stale entries are ignored
+    with AudioInfoCache(cache) as c:
+        assert c.get_many({path: (st.st_size + 1, st.st_mtime_ns)}) == {}
+    # broken links do not abort the scan
+    (tmp_path / 'broken.wav').symlink_to(tmp_path / 'missing.wav')
+    infos = probe_audio_files([path, str(tmp_path / 'broken.wav')], cache_path=cache)
+    assert infos[0]['frames'] == a.audios.frames[0] and infos[1]['sr'] is None
+
 def test_asr_dataset(data_):
     t = Transcripts(data_['transcripts'], normalize=True, lang='es', country='MX')
     a = Audios(data_['audios'], lang='es', country='MX')
@@ -104,6 +178,102 @@ def test_csv(csv_data):
     assert dataset.df.iloc[0].text == 'pero en un lugar para nosotros solos'
     dataset.export2kaldi(('/tmp/kaldi_csv'))
 
+def test_incremental_export(tmp_path):
+    import pandas as pd
+    import shutil
+    wavs = []
+    for i in range(3):
+        wavs.append(str(tmp_path / 'a{}.wav'.format(i)))
+        shutil.copy(DATA_FOLDER + '/dimex100/s058/audio_editado/comunes/s05810.wav', wavs[-1])
+    audios = pd.DataFrame({'id': ['0', '1', '2'], 'sid': ['s1', 's1', 's2'], 'path': wavs, 'audio': None, 'sr': 16000,
+        'duration': 3.5, 'lang': 'es', 'country': 'MX'})
+    transcripts = pd.DataFrame({'id': ['0', '1', '2'], 'text': ['uno', 'dos', 'tres'], 'path': ''})
+    ds = ASRDataset(audios, transcripts)
+    assert ds.dataset['uuid'].tolist() == ASRDataset(audios, transcripts).dataset['uuid'].tolist()
+    kaldi = str(tmp_path / 'kaldi')
+    delta = ds.export2kaldi(kaldi, materialize=True)
+    assert (len(delta['added']), delta['changed'], delta['removed']) == (3, [], [])
+    assert ds.export2kaldi(kaldi, materialize=True) == {'added': [], 'changed': [], 'removed': []}
+    # new audio content, one utterance gone
+    shutil.copy(DATA_FOLDER + '/common_voice/clips_16k/common_voice_es_18403002.wav', wavs[0])
+    ds = ASRDataset(audios[:2], transcripts)
+    delta = ds.export2kaldi(kaldi, materialize=True)
+    assert delta['added'] == [] and len(delta['changed']) == 1 and delta['removed'][0].startswith('s2-')
+    assert len(list((tmp_path / 'kaldi/wavs').iterdir())) == 2
+    # archives only hold the delta
+    delta = ds.export2kaldi(kaldi, materialize=True, archive=True)
+    assert len(delta['changed']) == 2 and list((tmp_path / 'kaldi/wavs').iterdir()) == []
+    shutil.copy(DATA_FOLDER + '/dimex100/s058/audio_editado/comunes/s05810.wav', wavs[1])
+    ds.export2kaldi(kaldi, materialize=True, archive=True)
+    assert sorted(p.name for p in (tmp_path / 'kaldi').glob('*.ark')) == ['wav-00000.ark', 'wav-00001.ark']
+    # pipes to the source audio: nothing is removed
+    ds.export2kaldi(kaldi, materialize=False)
+    assert len(list((tmp_path / 'kaldi').glob('*.ark'))) == 2
+
+def test_export_keeps_corpus_files(tmp_path):
+    # corpus root with its own wavs/ & wav.ark (LJSpeech-like layout) used as kaldi data dir
+    import pandas as pd
+    import shutil
+    (tmp_path / 'wavs').mkdir()
+    wavs = [str(tmp_path / 'wavs/a.wav'), str(tmp_path / 'wavs/b.wav')]
+    for wav in wavs:
+        shutil.copy(DATA_FOLDER + '/dimex100/s058/audio_editado/comunes/s05810.wav', wav)
+    (tmp_path / 'wav.ark').write_bytes(b'not ours')
+    audios = pd.DataFrame({'id': ['0', '1'], 'sid': ['s1', 's1'], 'path': wavs, 'audio': None, 'sr': 16000,
+        'duration': 3.5, 'lang': 'es', 'country': 'MX'})
+    transcripts = pd.DataFrame({'id': ['0', '1'], 'text': ['uno', 'dos'], 'path': ''})
+    ds = ASRDataset(audios, transcripts)
+    ds.export2kaldi(str(tmp_path))
+    ds.export2kaldi(str(tmp_path), materialize=True, archive=True)
+    ds.export2kaldi(str(tmp_path), materialize=True)
+    names = {p.name for p in (tmp_path / 'wavs').iterdir()}
+    assert len(names) == 4 and {'a.wav', 'b.wav'} <= names
+    assert (tmp_path / 'wav.ark').read_bytes() == b'not ours' and not (tmp_path / 'wav-00000.ark').exists()
+
+def test_save_load(tmp_path):
+    import pandas as pd
+    n = 1000
+    audios = pd.DataFrame({'id': [str(i) for i in range(n)], 'sid': ['s{}'.format(i % 10) for i in range(n)],
+        'path': ['/data/{}.wav'.format(i) for i in range(n)], 'audio': None, 'sr': 16000,
+        'duration': [i / 10 for i in range(n)], 'lang': 'es', 'country': 'MX'})
+    transcripts = pd.DataFrame({'id': [str(i) for i in range(n)], 'text': ['texto {}'.format(i) for i in range(n)], 'path': ''})
+    ds = ASRDataset(audios, transcripts)
+    ds.save(str(tmp_path / 'catalog.parquet'), row_group_size=100)
+    loaded = ASRDataset.load(str(tmp_path / 'catalog.parquet'))
+    assert 'audio' not in loaded.dataset.columns and str(loaded.dataset['sid'].dtype) == 'category'
+    # numeric columns are views on the arrow buffers
+    assert not loaded.dataset['duration'].to_numpy().flags.owndata
+    expected = ds.dataset.drop(columns=['audio']).reset_index(drop=True)
+    pd.testing.assert_frame_equal(loaded.dataset.astype({'sid': str, 'lang': str, 'country': str}), expected)
+    loaded = ASRDataset.load(str(tmp_path / 'catalog.parquet'), columns=['uuid', 'audio_path', 'duration'],
+        filters=[('duration', '<', 20)])
+    assert list(loaded.dataset.columns) == ['uuid', 'audio_path', 'duration'] and len(loaded.dataset) == 200
+    assert loaded.dataset['uuid'].tolist() == ds.dataset['uuid'].tolist()[:200]
+
+def test_csv_stream(tmp_path):
+    # duplicated (text, sid) pairs end up in different chunks
+    rows = [('spk{}'.format(i % 3), 'clip{}.mp3'.format(i), 'sentence {}'.format(i % 7)) for i in range(30)]
+    tsv = tmp_path / 'validated.tsv'
+    tsv.write_text('client_id\tpath\tsentence\n' + ''.join('\t'.join(row) + '\n' for row in rows))
+    dataset = ASRDatasetCSV(str(tsv), normalize=False, prepend_audio_path='/clips', chunksize=4)
+    assert len(dataset.df) == 21 and dataset.df['uuid'].is_unique
+    n = ASRDatasetCSV.stream2kaldi(str(tsv), str(tmp_path / 'kaldi'), chunksize=4, normalize=False,
+        prepend_audio_path='/clips')
+    assert n == 21
+    text = (tmp_path / 'kaldi/text').read_text().splitlines()
+    assert sorted(line.split(' ', 1)[1] for line in text) == sorted(dataset.df['text'])
+    spk2utt = [line.split() for line in (tmp_path / 'kaldi/spk2utt').read_text().splitlines()]
+    assert [(line[0], len(line) - 1) for line in spk2utt] == [('spk0', 7), ('spk1', 7), ('spk2', 7)]
+    assert sorted(tmp_path.joinpath('kaldi').iterdir()) == sorted(tmp_path / 'kaldi' / f for f in ['spk2utt', 'text', 'utt2spk', 'wav.scp'])
+
+@pytest.mark.parametrize("chunksize", [None, 4])
+def test_csv_empty(tmp_path, chunksize):
+    # empty dev/test splits: header only
+    tsv = tmp_path / 'dev.tsv'
+    tsv.write_text('client_id\tpath\tsentence\n')
+    dataset = ASRDatasetCSV(str(tsv), normalize=False, prepend_audio_path='/clips', chunksize=chunksize)
+    assert len(dataset.df) == 0 and 'text' in dataset.df.columns
+
 @pytest.fixture(scope="module")
 def libri_data():
     data = {
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# (c) 2020 Sylvain Le Groux <slegroux@ccrma.stanford.edu>
+
+import pytest
+from slgasr.features import FeatureStore, compute_features, feature_config
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import shutil
+import struct
+
+DATA_FOLDER= str(Path(__file__).parent.parent / "data/tests")
+
+@pytest.fixture
+def dataset(tmp_path):
+    wavs = [DATA_FOLDER + '/dimex100/s058/audio_editado/comunes/s05810.wav',
+        DATA_FOLDER + '/common_voice/clips_16k/common_voice_es_18403002.wav',
+        DATA_FOLDER + '/dimex100/s058/audio_editado/comunes/s05810_bis.wav']
+    paths = []
+    for i, wav in enumerate(wavs):
+        paths.append(str(tmp_path / '{}.wav'.format(i)))
+        shutil.copy(wav, paths[-1])
+    return(pd.DataFrame({'uuid': ['u0', 'u1', 'u2'], 'sid': ['s1', 's2', 's1'], 'audio_path': paths}))
+
+def read_scp(path):
+    # kaldi binary float matrices pointed at by an scp file
+    matrices = {}
+    for line in open(path):
+        key, entry = line.split()
+        ark, offset = entry.rsplit(':', 1)
+        with open(ark, 'rb') as f:
+            f.seek(int(offset))
+            header = f.read(15)
+            assert header[:2] == b'\0B'
+            rows, cols = struct.unpack('<i', header[6:10])[0], struct.unpack('<i', header[11:15])[0]
+            dtype = '<f4' if header[2:5] == b'FM ' else '<f8'
+            matrices[key] = np.frombuffer(f.read(rows * cols * np.dtype(dtype).itemsize), dtype).reshape(rows, cols)
+    return(matrices)
+
+def test_feature_store(dataset, tmp_path):
+    store = FeatureStore.build(dataset, str(tmp_path / 'feats'), n_shards=2, n_jobs=2, num_mel_bins=40)
+    assert (len(store), store.dim) == (3, 40)
+    expected = compute_features(dataset['audio_path'][1], feature_config('fbank', 16000, num_mel_bins=40))
+    assert np.array_equal(store.get_array('u1'), expected)
+    feats = read_scp(str(tmp_path / 'feats/feats.scp'))
+    assert sorted(feats) == ['s1-u0', 's1-u2', 's2-u1']
+    for utt, matrix in feats.items():
+        assert np.array_equal(matrix, store.get_array(utt.split('-', 1)[1]))
+    cmvn = read_scp(str(tmp_path / 'feats/cmvn.scp'))
+    assert cmvn['s1'].shape == (2, 41) and cmvn['s1'][0, -1] == store.frames('u0') + store.frames('u2')
+    normalized = store.apply_cmvn(np.concatenate([store.get_array('u0'), store.get_array('u2')]), 's1', norm_vars=True)
+    assert np.allclose(normalized.mean(axis=0), 0, atol=1e-3) and np.allclose(normalized.std(axis=0), 1, atol=1e-2)
+
+def test_feature_store_cache(dataset, tmp_path):
+    path = tmp_path / 'feats'
+    FeatureStore.build(dataset, str(path), n_shards=2, num_mel_bins=40)
+    shards = {p.name: p.stat().st_mtime_ns for p in path.glob('feats-*.ark')}
+    FeatureStore.build(dataset, str(path), n_shards=2, num_mel_bins=40)
+    assert {p.name: p.stat().st_mtime_ns for p in path.glob('feats-*.ark')} == shards
+    # only the shard of the modified audio file is recomputed
+    shutil.copy(dataset['audio_path'][0], dataset['audio_path'][1])
+    store = FeatureStore.build(dataset, str(path), n_shards=2, num_mel_bins=40)
+    rebuilt = {p.name for p in path.glob('feats-*.ark')}
+    assert len(rebuilt) == 2 and len(rebuilt & set(shards)) == 1
+    assert np.array_equal(store.get_array('u1'), store.get_array('u0'))
+    # new config, new shards
+    store = FeatureStore.build(dataset, str(path), feature='mfcc', n_shards=2)
+    assert not {p.name for p in path.glob('feats-*.ark')} & rebuilt and store.dim == 13
@@ -0,0 +1,24 @@
+#!/usr/bin/env python
+# (c) 2020 Sylvain Le Groux <slegroux@ccrma.stanford.edu>
+
+import pytest
+from slgasr.fileio import PENDING_PER_JOB, MemmapCache, bounded_map, file_stat
+import numpy as np
+import pickle
+
+def test_bounded_map():
+    jobs = iter(range(-50, 50))
+    results = bounded_map(abs, jobs, n_jobs=2)
+    assert next(results) == 50
+    # jobs are only submitted as results are consumed: 2 workers x PENDING_PER_JOB in flight
+    assert next(jobs) == -50 + 2 * PENDING_PER_JOB
+    assert list(results) == [abs(i) for i in range(-49, 50) if i != -50 + 2 * PENDING_PER_JOB]
+
+def test_memmap_cache(tmp_path):
+    path = str(tmp_path / 'shard.pcm')
+    np.arange(10, dtype='<i2').tofile(path)
+    assert file_stat(path)[0] == 20 and file_stat(str(tmp_path / 'missing')) == (-1, -1)
+    cache = MemmapCache('<i2')
+    assert cache.get(path) is cache.get(path) and cache.get(path)[3] == 3
+    # pickled caches (dataloader workers) open their own memmaps
+    assert pickle.loads(pickle.dumps(cache)).get(path).tolist() == list(range(10))
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# (c) 2020 Sylvain Le Groux <slegroux@ccrma.stanford.edu>
+
+import pytest
+from slgasr.kaldi import KaldiDataDir, kaldi_order
+from slgasr.probe import probe
+from pathlib import Path
+import wave
+
+DATA_FOLDER= str(Path(__file__).parent.parent / "data/tests")
+
+@pytest.fixture(scope="module")
+def utterances():
+    data_ = {
+        'utt_ids': ['spk2-b', 'spk1-b', 'spk1-a'],
+        'sids': ['spk2', 'spk1', 'spk1'],
+        'audio_paths': ['/data/c.wav', '/data/b.wav', '/data/a.wav'],
+        'texts': ['hola "amigos"', 'que  tal\n', 'adiós'],
+        'durations': [1.5, 2.0, 3.25]
+        }
+    return data_
+
+def read(path):
+    with open(path, encoding='utf-8') as f:
+        return(f.read().splitlines())
+
+def test_kaldi_order():
+    assert kaldi_order(['b', 'B', 'a-1', 'a']) == [1, 3, 2, 0]
+
+def test_kaldi_data_dir(utterances, tmp_path):
+    d = KaldiDataDir(str(tmp_path / 'data'))
+    d.write(**utterances, wav_template='sox {} -t wav - |')
+    assert read(d.path + '/wav.scp') == ['spk1-a sox /data/a.wav -t wav - |', 'spk1-b sox /data/b.wav -t wav - |',
+        'spk2-b sox /data/c.wav -t wav - |']
+    assert read(d.path + '/text') == ['spk1-a adiós', 'spk1-b que tal', 'spk2-b hola "amigos"']
+    assert read(d.path + '/utt2spk') == ['spk1-a spk1', 'spk1-b spk1', 'spk2-b spk2']
+    assert read(d.path + '/spk2utt') == ['spk1 spk1-a spk1-b', 'spk2 spk2-b']
+    assert read(d.path + '/utt2dur') == ['spk1-a 3.2500', 'spk1-b 2.0000', 'spk2-b 1.5000']
+    assert read(d.path + '/reco2dur') == read(d.path + '/utt2dur')
+
+def test_missing_durations(utterances, tmp_path):
+    d = KaldiDataDir(str(tmp_path / 'data'))
+    d.write(**utterances)
+    d.write(**dict(utterances, durations=[1.5, None, float('nan')]))
+    assert len(read(d.path + '/wav.scp')) == 3 and len(read(d.path + '/text')) == 3
+    assert not (tmp_path / 'data/utt2dur').exists() and not (tmp_path / 'data/reco2dur').exists()
+
+@pytest.mark.parametrize("archive", [False, True])
+def test_materialize(tmp_path, archive):
+    wavs = [DATA_FOLDER + '/dimex100/s058/audio_editado/comunes/s05810.wav',
+        DATA_FOLDER + '/common_voice/clips_16k/common_voice_es_18403002.wav']
+    d = KaldiDataDir(str(tmp_path / 'data'))
+    entries = d.materialize(['b', 'a'], wavs, sr=16000, n_jobs=2, archive=archive)
+    for entry, frames in zip(entries, [56645, 50688]):
+        if archive:
+            ark, offset = entry.rsplit(':', 1)
+            with open(ark, 'rb') as f:
+                f.seek(int(offset))
+                w = wave.open(f)
+                assert (w.getframerate(), w.getnchannels(), w.getnframes()) == (16000, 1, frames)
+        else:
+            assert probe(entry)['frames'] == frames
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# (c) 2020 Sylvain Le Groux <slegroux@ccrma.stanford.edu>
+
+import pytest
+from pathlib import Path
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tarfile
+
+DATA_FOLDER= str(Path(__file__).parent.parent / "data/tests")
+SCRIPT = str(Path(__file__).parent.parent / "bin/get_librispeech_data.py")
+REPO_ROOT = str(Path(__file__).parent.parent.parent)
+
+# sox.Transformer runs the sox binary
+pytestmark = pytest.mark.skipif(shutil.which('sox') is None, reason="sox is not installed")
+
+def get_librispeech_data(data_root, source):
+    subprocess.run([sys.executable, SCRIPT, '--data_root', data_root, '--data_sets', 'dev_clean',
+        '--source', source, '--jobs', '2'], check=True,
+        env=dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [REPO_ROOT, os.environ.get('PYTHONPATH')]))))
+    with open(data_root + '/dev-clean.json') as f:
+        return([json.loads(line) for line in f])
+
+def test_local_folder(tmp_path):
+    manifest = get_librispeech_data(str(tmp_path), DATA_FOLDER + '/librispeech')
+    assert [Path(m['audio_filepath']).name for m in manifest] == ['1272-135031-0000.wav', '1272-135031-0001.wav']
+    assert [m['duration'] for m in manifest] == [10.885, 11.13]
+    assert manifest[1]['text'].startswith('he has gone and gone for good')
+
+def test_local_tarball_resume(tmp_path):
+    tarball = str(tmp_path / 'dev-clean.tar.gz')
+    with tarfile.open(tarball, 'w:gz') as tar:
+        tar.add(DATA_FOLDER + '/librispeech', arcname='LibriSpeech/dev-clean')
+    data_root = str(tmp_path / 'data')
+    manifest = get_librispeech_data(data_root, tarball)
+    # interrupted run: one entry in the checkpoint, followed by a truncated line
+    Path(data_root + '/dev-clean.json').unlink()
+    with open(data_root + '/dev-clean.json.partial', 'w') as f:
+        f.write(json.dumps(manifest[0]) + '\n{"audio_fi')
+    Path(manifest[1]['audio_filepath']).unlink()
+    assert get_librispeech_data(data_root, tarball) == manifest
+
+def test_stream_url(tmp_path):
+    tarball = tmp_path / 'dev-clean.tar.gz'
+    with tarfile.open(str(tarball), 'w:gz') as tar:
+        tar.add(DATA_FOLDER + '/librispeech', arcname='LibriSpeech/dev-clean')
+    manifest = get_librispeech_data(str(tmp_path / 'data'), tarball.as_uri())
+    assert [m['duration'] for m in manifest] == [10.885, 11.13]
+    # the archive is extracted while converting
+    assert (tmp_path / 'data/LibriSpeech/dev-clean/1272/135031/1272-135031.trans.txt').exists()
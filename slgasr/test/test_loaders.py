@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# (c) 2020 Sylvain Le Groux <slegroux@ccrma.stanford.edu>
+
+import pytest
+from slgasr.loaders import ASRTorchDataset, ASRIterableDataset, DurationBucketSampler, collate_pad
+from slgasr.store import WaveformStore
+from pathlib import Path
+import pandas as pd
+import numpy as np
+import torch
+
+DATA_FOLDER= str(Path(__file__).parent.parent / "data/tests")
+
+@pytest.fixture(scope="module")
+def dataset():
+    return(pd.DataFrame({
+        'uuid': ['a', 'b', 'c', 'd', 'e'],
+        'audio_path': [DATA_FOLDER + '/dimex100/s058/audio_editado/comunes/s05810.wav',
+            DATA_FOLDER + '/common_voice/clips_16k/common_voice_es_18403002.wav'] * 2
+            + [DATA_FOLDER + '/dimex100/s058/audio_editado/comunes/s05810_bis.wav'],
+        'text': ['uno', 'dos', 'tres', 'cuatro', 'cinco']
+        }))
+
+def test_map_dataset(dataset, tmp_path):
+    ds = ASRTorchDataset(dataset)
+    waveform, sr, text, uuid = ds[1]
+    assert (tuple(waveform.shape), sr, text, uuid) == ((1, 50688), 16000, 'dos', 'b')
+    assert waveform.abs().max() <= 1.0
+    store = WaveformStore.build(dataset, str(tmp_path / 'store'))
+    assert torch.equal(ASRTorchDataset(dataset, store=store)[1][0], waveform)
+
+def test_iterable_dataset(dataset):
+    ds = ASRIterableDataset(dataset, shuffle=True, seed=1, prefetch=2)
+    epoch0 = [item[3] for item in ds]
+    assert sorted(epoch0) == ['a', 'b', 'c', 'd', 'e'] and epoch0 == [item[3] for item in ds]
+    ds.set_epoch(1)
+    assert sorted(item[3] for item in ds) == sorted(epoch0)
+    # dataloader workers get disjoint shards: every utterance exactly once per epoch
+    loader = torch.utils.data.DataLoader(ASRIterableDataset(dataset), batch_size=None, num_workers=2)
+    assert sorted(item[3] for item in loader) == ['a', 'b', 'c', 'd', 'e']
+
+def test_iterable_dataset_distributed(dataset, monkeypatch):
+    # ranks are padded to the same length
+    shards = []
+    for rank in range(2):
+        monkeypatch.setattr('slgasr.loaders.distributed_info', lambda: (rank, 2))
+        shards.append(ASRIterableDataset(dataset).shard().tolist())
+    assert len(shards[0]) == len(shards[1]) == 3 and set(shards[0] + shards[1]) == set(range(5))
+
+def test_collate_pad(dataset):
+    loader = torch.utils.data.DataLoader(ASRTorchDataset(dataset), batch_size=2, collate_fn=collate_pad)
+    waveforms, lengths, sr, texts, uuids = next(iter(loader))
+    assert tuple(waveforms.shape) == (2, 56645) and lengths.tolist() == [56645, 50688]
+    assert waveforms[1, 50688:].abs().sum() == 0 and uuids == ['a', 'b']
+
+@pytest.fixture(scope="module")
+def durations():
+    return(np.random.default_rng(0).uniform(1, 30, 1000))
+
+def test_bucket_sampler(durations):
+    sampler = DurationBucketSampler(durations, max_seconds=120, seed=3)
+    batches = list(sampler)
+    assert sorted(i for batch in batches for i in batch) == list(range(1000))
+    assert all(len(batch) * durations[batch].max() <= 120 for batch in batches)
+    assert list(sampler) == batches
+    sampler.set_epoch(1)
+    assert list(sampler) != batches and len(sampler) == len(list(sampler))
+    # far less padding than random batches of the same average size
+    stats = sampler.stats()
+    random_batches = np.array_split(np.random.default_rng(0).permutation(1000), stats['batches'])
+    random_efficiency = durations.sum() / sum(len(b) * durations[b].max() for b in random_batches)
+    assert stats['efficiency'] > 0.9 > random_efficiency and len(stats['buckets']) == 10
+    assert sum(bucket['utterances'] for bucket in stats['buckets']) == 1000
+    # frames budget at 16kHz
+    assert len(DurationBucketSampler(durations, max_frames=120 * 16000, seed=3)) == len(batches)
+
+def test_bucket_sampler_distributed(durations):
+    ranks = [DurationBucketSampler(durations, max_seconds=120, num_replicas=2, rank=rank) for rank in range(2)]
+    batches = [list(sampler) for sampler in ranks]
+    assert len(batches[0]) == len(batches[1])
+    assert {i for rank in batches for batch in rank for i in batch} == set(range(1000))
+
+def test_bucket_sampler_edge_cases():
+    # fewer batches than ranks: every rank still gets one
+    ranks = [list(DurationBucketSampler([1.0, 2.0], max_seconds=10, num_replicas=4, rank=rank)) for rank in range(4)]
+    assert all(len(batches) == 1 for batches in ranks)
+    # utterances without duration are not piled into one batch
+    batches = list(DurationBucketSampler([1.0, None, float('nan'), 1.0], max_seconds=10, shuffle=False))
+    assert sorted(len(batch) for batch in batches) == [1, 1, 2]
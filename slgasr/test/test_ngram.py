@@ -2,8 +2,9 @@
 # (c) 2020 Sylvain Le Groux <slegroux@ccrma.stanford.edu>
 
 import pytest
-from slgasr.ngram import Corpus, Unigram, Bigram
-from IPython import embed
+from slgasr.ngram import Corpus, CorpusStream, Unigram, Bigram, NGram, CompiledLM
+import gzip
+import numpy as np
 import os
 from pathlib import Path
 
@@ -34,6 +35,36 @@ def test_corpus(data):
         ['i', 'do', 'not', 'like', 'green', 'eggs', 'and', 'ham']
     ]
 
+def test_encoded_corpus(data):
+    c = Corpus(data['corpus'])
+    assert c.tokens.dtype == np.int32 and c.offsets.tolist() == [0, 5, 10, 20]
+    assert [c.words[i] for i in c.tokens[5:10]] == ['<s>', 'sam', 'i', 'am', '</s>']
+    assert c.corpus[-1][1:3] == ['i', 'do'] and len(c.corpus) == 3
+    # plain lists of sentences are still accepted
+    assert Bigram(list(c.corpus)).counts == Bigram(c).counts == Bigram(c.corpus).counts
+
+def test_missing_corpus(data):
+    with pytest.raises(IOError):
+        Corpus(DATA_FOLDER + '/lm/missing.txt')
+    with pytest.raises(IOError):
+        CorpusStream(DATA_FOLDER + '/lm/missing*.txt')
+
+def test_corpus_stream(data, tmp_path):
+    # the small corpus split over a plain & a gzipped file
+    lines = Path(data['corpus']).read_text().splitlines(keepends=True)
+    (tmp_path / 'a.txt').write_text(''.join(lines[:2]))
+    with gzip.open(str(tmp_path / 'b.txt.gz'), 'wt') as f:
+        f.write(''.join(lines[2:]))
+    c = Corpus(data['corpus'])
+    stream = CorpusStream(str(tmp_path / '*'), block_size=2)
+    assert list(stream) == c.corpus
+    assert (stream.vocab, stream.num_sentences) == (c.vocab, c.num_sentences)
+    assert Corpus([str(tmp_path / 'a.txt'), str(tmp_path / 'b.txt.gz')]).corpus == c.corpus
+    for model in [Unigram, Bigram]:
+        m, expected = model(stream), model(c)
+        assert (m.counts, m.probs, m.tot_count) == (expected.counts, expected.probs, expected.tot_count)
+    assert NGram(stream, order=3).counts == NGram(c, order=3).counts
+
 def test_vocab(data):
     c = Corpus(data['corpus'])
     assert c.vocab == {'eggs', 'sam', 'do', '</s>', 'like', 'not', 'green', 'ham', '<s>', 'and', 'i', 'am'}
@@ -86,3 +117,131 @@ def test_large_corpus(data):
     assert b.probs[('all', 'the')] == 1.0
     # p(jury|the)
     assert b.probs[('the', 'jury')] == 0.08333333333333333
+
+@pytest.mark.parametrize("n_jobs", [1, 3])
+def test_parallel_counts(data, n_jobs):
+    for path, eos in [(data['corpus'], True), (data['large_corpus'], False)]:
+        c = Corpus(path, add_bos=eos, add_eos=eos)
+        u, b = Unigram(c), Bigram(c)
+        pu, pb = Unigram.from_file(path, add_bos=eos, add_eos=eos, n_jobs=n_jobs), Bigram.from_file(path, add_bos=eos, add_eos=eos, n_jobs=n_jobs)
+        assert (pu.counts, pu.probs, pu.tot_count) == (u.counts, u.probs, u.tot_count)
+        assert (pb.counts, pb.probs, pb.tot_count) == (b.counts, b.probs, b.tot_count)
+
+def test_ngram(data):
+    c = Corpus(data['large_corpus'], add_eos=False, add_bos=False)
+    assert NGram(c, order=2).counts == Bigram(c).counts
+    ngram = NGram(c, order=4)
+    ids, counts = ngram.ngrams(1)
+    assert {c.words[i]: count for (i,), count in zip(ids.tolist(), counts.tolist())} == Unigram(c).counts
+    # tiny buffers: every order is spilled to many runs & merged from disk
+    spilled = NGram(c, order=4, memory=16 * 4 * 1024)
+    # 32 bit ids do not fit 64 bit keys for trigrams & 4-grams
+    unpacked = NGram(order=4, vocab_size=1 << 32, memory=16 * 4 * 1024)
+    unpacked.add(c.tokens, c.offsets)
+    unpacked.finalize()
+    for n in range(1, 5):
+        ids, counts = ngram.ngrams(n)
+        for other in [spilled, unpacked]:
+            assert np.array_equal(other.ngrams(n)[0], ids) and np.array_equal(other.ngrams(n)[1], counts)
+    assert counts.sum() == sum(max(0, (end - start) - 3) for start, end in zip(c.offsets[:-1], c.offsets[1:]))
+
+class PeakNGram(NGram):
+    # records the peak number of keys held in buffers
+    peak = 0
+
+    def _buffer(self, n, keys):
+        super()._buffer(n, keys)
+        PeakNGram.peak = max(PeakNGram.peak, sum(self._buffered.values()))
+
+def test_ngram_memory(data, caplog):
+    # the budget holds for in-memory corpora counted in a single add, 20x brown_100 here
+    import logging
+    import tracemalloc
+    # captured spill logs would count in the traced memory
+    caplog.set_level(logging.WARNING, logger='language_modeling')
+    c = Corpus(data['large_corpus'], add_eos=False, add_bos=False)
+    tokens = np.tile(c.tokens, 20)
+    offsets = np.concatenate([c.offsets[:-1] + i * len(c.tokens) for i in range(20)] + [[len(tokens)]])
+    memory = 16 * 4 * 1024
+    ngram = PeakNGram(order=4, vocab_size=len(c.words), memory=memory)
+    tracemalloc.start()
+    ngram.add(tokens, offsets)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    ngram.finalize()
+    # a few times the budget, far less than the n-grams of the whole corpus
+    assert PeakNGram.peak * 16 <= memory and peak < 3 * memory < 4 * 4 * len(tokens)
+    assert ngram.keys(4)[1].sum() == 20 * NGram(c, order=4).keys(4)[1].sum()
+
+@pytest.fixture(scope="module")
+def lm(data):
+    c = Corpus(data['large_corpus'], add_eos=False, add_bos=False)
+    return(CompiledLM.build(NGram(c, order=3)))
+
+def test_compiled_lm(data, lm):
+    # p(.|h) sums to one for seen, partly seen & unseen histories
+    for context in [['<s>', 'the'], ['the', 'jury'], ['zzz', 'the'], ['zzz', 'yyy']]:
+        tokens, offsets = lm.encode([context + [w] for w in lm.words], bos=False, eos=False)
+        assert np.isclose((10 ** lm.token_logprobs(tokens, offsets)[offsets[1:] - 1]).sum(), 1, atol=1e-4)
+    c = Corpus(data['large_corpus'], add_eos=False, add_bos=False)
+    assert lm.perplexity(c) < lm.perplexity([['the', 'zzz', 'jury', 'of', 'of']]) and lm.perplexity(c) < 15
+    scores = lm.score([['the', 'jury', 'said'], 'the jury said', ['said', 'the', 'jury']])
+    assert scores[0] == scores[1] > scores[2]
+    words, logprobs = lm.successors(['the', 'jury'])
+    assert 'said' in words and (10 ** logprobs).sum() < 1
+
+def test_compiled_lm_bigram(data):
+    c = Corpus(data['corpus'])
+    lm = CompiledLM.build(Bigram(c), discounts=[0.5, 0.5])
+    # p(am|i) = (2 - 0.5) / 3 + 0.5 * 2 / 3 * p(am)
+    p_am = (2 - 0.5) / 20 + 0.5 * 12 / 20 / 13
+    p_am_i = (2 - 0.5) / 3 + 0.5 * 2 / 3 * p_am
+    # without <s>, the first word is scored by its unigram
+    p_i = (3 - 0.5) / 20 + 0.5 * 12 / 20 / 13
+    assert np.isclose(10 ** lm.score(['i am'], bos=False, eos=False)[0], p_i * p_am_i)
+    assert np.isclose(lm.score(['<s> i am'], eos=False)[0] - lm.score(['<s> i'], eos=False)[0], np.log10(p_am_i))
+
+def test_compiled_lm_save_load(data, lm, tmp_path):
+    lm.save(str(tmp_path / 'lm'))
+    loaded = CompiledLM.load(str(tmp_path / 'lm'))
+    assert isinstance(loaded._keys[2], np.memmap) and loaded.words == lm.words
+    c = Corpus(data['large_corpus'], add_eos=False, add_bos=False)
+    assert np.array_equal(loaded.score(c.corpus), lm.score(c.corpus))
+
+@pytest.mark.parametrize("name", ['lm.arpa', 'lm.arpa.gz'])
+def test_arpa(data, lm, tmp_path, name):
+    lm.to_arpa(str(tmp_path / name))
+    loaded = CompiledLM.from_arpa(str(tmp_path / name))
+    assert loaded.words == lm.words and all(np.array_equal(a, b) for a, b in zip(loaded._keys, lm._keys))
+    c = Corpus(data['large_corpus'], add_eos=False, add_bos=False)
+    assert np.allclose(loaded.score(c.corpus), lm.score(c.corpus), atol=1e-4)
+    if name == 'lm.arpa':
+        lines = open(str(tmp_path / name)).read().split('\n')
+        assert lines[:4] == ['\\data\\'] + ['ngram {}={}'.format(n, len(lm._keys[n - 1])) for n in range(1, 4)]
+
+def test_arpa_bigram(data, tmp_path):
+    b = Bigram(Corpus(data['corpus']))
+    b.to_arpa(str(tmp_path / 'bigram.arpa'))
+    # arpa files of other toolkits: unsorted n-grams & no <unk>
+    arpa = ['\\data\\', 'ngram 1=3', 'ngram 2=2', '', '\\1-grams:', '-0.5\tb\t-0.1', '-0.3\ta\t-0.2',
+        '-0.4\t</s>', '', '\\2-grams:', '-0.2\tb a', '-0.1\ta b', '', '\\end\\']
+    (tmp_path / 'other.arpa').write_text('\n'.join(arpa) + '\n')
+    lm = CompiledLM.from_arpa(str(tmp_path / 'other.arpa'))
+    assert lm.words == ['b', 'a', '</s>', '<unk>'] and lm.order == 2
+    # p(b), p(a|b), then backoff: gamma(a) p(</s>)
+    assert np.isclose(lm.score(['b a </s>'], bos=False, eos=False), [-0.5 - 0.2 - 0.2 - 0.4]).all()
+    assert np.isclose(lm.perplexity(['b a </s>'], bos=False, eos=False), 10 ** ((0.5 + 0.2 + 0.2 + 0.4) / 3))
+    assert CompiledLM.from_arpa(str(tmp_path / 'bigram.arpa')).words == CompiledLM.build(b).words
+
+def test_arpa_pruned(tmp_path):
+    # pruned like SRILM: 'a b c' without 'a b', 'c a b c' without 'c a b' nor 'c a'
+    arpa = ['\\data\\', 'ngram 1=5', 'ngram 2=2', 'ngram 3=1', 'ngram 4=1', '', '\\1-grams:', '-99\t<s>\t-0.3',
+        '-0.6\ta\t-0.2', '-0.7\tb\t-0.1', '-0.8\tc\t-0.15', '-0.9\t</s>', '', '\\2-grams:', '-0.2\t<s> a\t-0.05',
+        '-0.3\tb c\t-0.02', '', '\\3-grams:', '-0.1\ta b c\t-0.01', '', '\\4-grams:', '-0.05\tc a b c', '', '\\end\\']
+    (tmp_path / 'pruned.arpa').write_text('\n'.join(arpa) + '\n')
+    lm = CompiledLM.from_arpa(str(tmp_path / 'pruned.arpa'))
+    assert [len(k) for k in lm._keys] == [6, 4, 2, 1] and lm.order == 4
+    assert lm.successors(['a', 'b'])[0] == ['c'] and lm.successors(['c', 'a', 'b'])[0] == ['c']
+    # blank contexts back off: p(a|c) = bo(c) p(a), p(b|c a) = p(b|a) = bo(a) p(b), p(a|a b) = bo(b) p(a)
+    assert np.allclose(lm.score(['c a b c', 'a b a'], bos=False, eos=False),
+        [-0.8 - 0.15 - 0.6 - 0.2 - 0.7 - 0.05, -0.6 - 0.2 - 0.7 - 0.1 - 0.6])
@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+# (c) 2020 Sylvain Le Groux <slegroux@ccrma.stanford.edu>
+
+import pytest
+from slgasr.probe import probe, pcm_layout
+from pathlib import Path
+
+DATA_FOLDER= str(Path(__file__).parent.parent / "data/tests")
+
+@pytest.fixture(scope="module")
+def data():
+    data_ = {
+        'wav': DATA_FOLDER + '/dimex100/s058/audio_editado/comunes/s05810.wav',
+        'wav_22k': DATA_FOLDER + '/heroico/speech/Recordings_Spanish/1/1.wav',
+        'mp3': DATA_FOLDER + '/dimex100/s058/audio_editado/comunes/s05810.mp3',
+        'flac': DATA_FOLDER + '/librispeech/1272/135031/1272-135031-0000.flac'
+        }
+    return data_
+
+def test_probe_wav(data):
+    assert probe(data['wav']) == {'sr': 16000, 'channels': 1, 'frames': 56645, 'duration': 3.5403125, 'codec': 'PCM_S'}
+    layout = pcm_layout(data['wav_22k'])
+    assert (layout['sr'], layout['offset'], layout['frames']) == (22050, 46, 42176)
+
+def test_probe_flac(data):
+    assert probe(data['flac']) == {'sr': 16000, 'channels': 1, 'frames': 174160, 'duration': 10.885, 'codec': 'FLAC'}
+    assert pcm_layout(data['flac']) is None
+
+def test_probe_mp3(data):
+    assert probe(data['mp3']) == {'sr': 16000, 'channels': 1, 'frames': 58176, 'duration': 3.636, 'codec': 'MP3'}
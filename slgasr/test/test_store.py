@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+# (c) 2020 Sylvain Le Groux <slegroux@ccrma.stanford.edu>
+
+import pytest
+from slgasr.store import WaveformStore
+from pathlib import Path
+import pandas as pd
+import pickle
+
+DATA_FOLDER= str(Path(__file__).parent.parent / "data/tests")
+
+@pytest.fixture(scope="module")
+def dataset():
+    return(pd.DataFrame({
+        'uuid': ['a', 'b', 'c'],
+        'audio_path': [DATA_FOLDER + '/dimex100/s058/audio_editado/comunes/s05810.wav',
+            DATA_FOLDER + '/common_voice/clips_16k/common_voice_es_18403002.wav',
+            DATA_FOLDER + '/dimex100/s058/audio_editado/comunes/s05810_bis.wav']
+        }))
+
+def test_waveform_store(dataset, tmp_path):
+    # small shards to get one waveform per shard
+    store = WaveformStore.build(dataset, str(tmp_path / 'store'), shard_size=60000, n_jobs=2)
+    assert len(store) == 3 and 'b' in store
+    assert [store.length(uuid) for uuid in store.uuids] == [56645, 50688, 56645]
+    a = store.get_array('a')
+    assert a.shape == (56645,) and a.dtype == 'int16'
+    assert (a == store.get_array('c')).all()
+    # workers get their own memmaps
+    store = pickle.loads(pickle.dumps(store))
+    assert store.get_array('b').shape == (50688,)
+
+def test_waveform_store_torch(dataset, tmp_path):
+    store = WaveformStore.build(dataset, str(tmp_path / 'store'))
+    w = store['a']
+    assert (tuple(w.shape), str(w.dtype)) == ((56645,), 'torch.int16')
+    # tensors are views on the memory-mapped shard
+    assert w.data_ptr() == store['a'].data_ptr()